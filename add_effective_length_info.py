@@ -1,31 +1,75 @@
 from os import listdir, path
+from typing import List
 from agn_utils import AgnSimulationInfo
-import subprocess
 from paths_in_this_machine import root_simulations_directory, update_effective_length_6_columns
+from ray_tracing_utils import build_clouds_ray_tracer
+from escape_lines_utils import write_escape_lines_sidecar
+from job_runner_utils import Job, run_jobs, print_jobs_summary
 
-root_dir = root_simulations_directory
+USE_EXTERNAL_EFFECTIVE_LENGTH_TOOL = False
+"""Rewrite the simulation files with the external update_effective_length_6_columns tool
+instead of writing the escape lines sidecar files.
+"""
 
-print('=====================================')
-for sim_dir in listdir(root_dir):
-    sim_root_dir = path.join(root_dir, sim_dir)
-    if sim_dir == 'past' or path.isfile(sim_root_dir) or 'data' not in listdir(sim_root_dir):
-        print(f'Unknown path:: {sim_root_dir}')
-        continue
-    print(f'processing sim dir: {sim_dir}')
+
+def add_escape_lines(sim_root_dir: str) -> List[str]:
+    """Writes the escape lines sidecar files of all the simulation files
+    of the simulation, with one tracer of its clouds.
+
+    Returns:
+        List[str]: the paths to the sidecar files
+    """
     sim_info = AgnSimulationInfo.build_agn_simulation_info(
         sim_root_dir=sim_root_dir)
-    print(sim_info)
-    rv = subprocess.call([update_effective_length_6_columns,
-                          str(sim_info.r_clouds/100),
-                          str(sim_info.n_clouds),
-                          str(sim_info.r1/100),
-                          str(sim_info.r2/100),
-                          str(sim_info.theta),
-                          sim_info.clouds_file_path,
-                          *sim_info.simulation_files])
-
-    if rv != 0:
-        print(f'There was a problem with {sim_dir}')
-        exit(-1)
+
+    tracer = build_clouds_ray_tracer(
+        sim_info) if not sim_info.is_smooth else None
+
+    return [write_escape_lines_sidecar(sim_info=sim_info, simulation_filepath=simulation_file, tracer=tracer)
+            for simulation_file in sim_info.simulation_files]
+
+
+def main():
+    root_dir = root_simulations_directory
+
+    external_jobs = []
 
     print('=====================================')
+    for sim_dir in listdir(root_dir):
+        sim_root_dir = path.join(root_dir, sim_dir)
+        if sim_dir == 'past' or path.isfile(sim_root_dir) or 'data' not in listdir(sim_root_dir):
+            print(f'Unknown path:: {sim_root_dir}')
+            continue
+        print(f'processing sim dir: {sim_dir}')
+        sim_info = AgnSimulationInfo.build_agn_simulation_info(
+            sim_root_dir=sim_root_dir)
+        print(sim_info)
+
+        if USE_EXTERNAL_EFFECTIVE_LENGTH_TOOL:
+            # one job per simulation file, so the files are processed concurrently
+            external_jobs += [Job(label=f'{sim_dir} {path.basename(simulation_file)}',
+                                  args=[update_effective_length_6_columns,
+                                        str(sim_info.r_clouds/100),
+                                        str(sim_info.n_clouds),
+                                        str(sim_info.r1/100),
+                                        str(sim_info.r2/100),
+                                        str(sim_info.theta),
+                                        sim_info.clouds_file_path,
+                                        simulation_file])
+                              for simulation_file in sim_info.simulation_files]
+        else:
+            for sidecar_filepath in add_escape_lines(sim_root_dir):
+                print(f'escape lines: {sidecar_filepath}')
+
+        print('=====================================')
+
+    if external_jobs:
+        results = run_jobs(external_jobs)
+        print_jobs_summary(results)
+
+        if not all(result.succeeded for result in results):
+            exit(-1)
+
+
+if __name__ == '__main__':
+    main()
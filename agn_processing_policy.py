@@ -17,3 +17,7 @@ HV_FEKALPHA_ABSORPTION_LEFT_LEFT = 6500
 HV_FEKALPHA_ABSORPTION_RIGHT_LEFT = 7140 
 HV_FEKALPHA_ABSORPTION_RIGHT_RIGHT = 7400# original:7350
 TOTAL_DIRECTIONS = 500_000
+MAX_TOTAL_DIRECTIONS = 2_000_000
+NH_CONVERGENCE_BATCH_SIZE = 50_000
+NH_CONVERGENCE_TOLERANCE = 0.02
+NH_CONVERGENCE_MIN_BIN_FRACTION = 0.01
@@ -21,10 +21,32 @@ AGN_EFFECTIVE_LENGTHS_DIR_LABEL = 'effective_lengths'
 AGN_EFFECTIVE_LENGTHS_LABEL = AGN_EFFECTIVE_LENGTHS_DIR_LABEL
 
 
+AGN_EFFECTIVE_LENGTHS_SIDECAR_SUFFIX = '.npy'
+"""Suffix of the binary (memory-mappable) copy of an effective lengths file.
+"""
+
+
+AGN_ESCAPE_LINES_SIDECAR_SUFFIX = '.escape.npy'
+"""Suffix of the binary file with the escape-line effective lengths of a simulation file.
+"""
+
+
 def get_effective_lengths_directions_filename(angle_interval_label: str):
     return f'{AGN_EFFECTIVE_LENGTHS_DIR_LABEL}_{angle_interval_label}'
 
 
+def get_effective_lengths_sidecar_filepath(effective_lengths_filepath: str):
+    return f'{effective_lengths_filepath}{AGN_EFFECTIVE_LENGTHS_SIDECAR_SUFFIX}'
+
+
+def is_effective_lengths_sidecar(effective_lengths_filename: str):
+    return effective_lengths_filename.endswith(AGN_EFFECTIVE_LENGTHS_SIDECAR_SUFFIX)
+
+
+def get_escape_lines_sidecar_filepath(simulation_filepath: str):
+    return f'{simulation_filepath}{AGN_ESCAPE_LINES_SIDECAR_SUFFIX}'
+
+
 def get_effective_lengths_label_from_filename(effective_lengths_filename: str):
     return effective_lengths_filename.split(sep='_')[-1]
 
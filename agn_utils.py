@@ -227,6 +227,8 @@ def get_angle_effective_lengths_map(effective_lengths_dir: str) -> Dict[str, str
 
     the_map = {}
     for effective_lengths_filename_i in os.listdir(effective_lengths_dir):
+        if is_effective_lengths_sidecar(effective_lengths_filename_i):
+            continue
         the_map[get_effective_lengths_label_from_filename(
             effective_lengths_filename=effective_lengths_filename_i)] = os.path.join(effective_lengths_dir, effective_lengths_filename_i)
 
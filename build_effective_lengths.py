@@ -1,47 +1,128 @@
 from os import listdir, path, mkdir, path
 from agn_utils import AgnSimulationInfo, AGN_EFFECTIVE_LENGTHS_DIR_LABEL, AGN_VIEWING_DIRECTIONS_DEG, get_effective_lengths_directions_filename
-import subprocess
+from functools import partial
 from paths_in_this_machine import create_nh_distribution, root_dirs
 from agn_processing_policy import TOTAL_DIRECTIONS
+from colum_density_utils import write_effective_lengths_sidecar
+from ray_tracing_utils import CloudsRayTracer, build_clouds_ray_tracer, compute_effective_lengths_for_simulation, compute_effective_lengths_until_converged, write_effective_lengths
+from job_runner_utils import Job, run_jobs, print_jobs_summary
 
+USE_EXTERNAL_NH_DISTRIBUTION_TOOL = False
+"""Use the external create_nh_distribution tool instead of the in-process ray tracer.
+"""
 
+USE_ADAPTIVE_DIRECTIONS = True
+"""Sample the directions until the column density distribution converges,
+instead of always sampling TOTAL_DIRECTIONS directions.
+"""
 
-for root_dir in root_dirs:
-    print('=====================================')
-    for sim_dir in listdir(root_dir):
-        sim_root_dir = path.join(root_dir, sim_dir)
-        if sim_dir == 'past' or path.isfile(sim_root_dir) or 'data' not in listdir(sim_root_dir):
-            print(f'Unknown path:: {sim_root_dir}')
-            continue
-        print(f'processing sim dir: {sim_dir}')
-        sim_info = AgnSimulationInfo.build_agn_simulation_info(
-            sim_root_dir=sim_root_dir)
 
-        print(sim_info)
+def get_effective_lengths_filepath(sim_root_dir: str, alpha: str) -> str:
+    return path.join(sim_root_dir, AGN_EFFECTIVE_LENGTHS_DIR_LABEL, get_effective_lengths_directions_filename(alpha))
 
-        directions_dir = path.join(
-            sim_root_dir, AGN_EFFECTIVE_LENGTHS_DIR_LABEL)
 
-        if not path.exists(directions_dir):
-            mkdir(directions_dir)
+def build_effective_lengths(sim_root_dir: str, alpha: str, tracer: CloudsRayTracer = None, use_adaptive_directions: bool = USE_ADAPTIVE_DIRECTIONS,
+                            n_workers: int = None) -> str:
+    """Computes the effective lengths of the simulation for the given viewing angle,
+    and writes them (and their binary sidecar).
 
-        for alpha in AGN_VIEWING_DIRECTIONS_DEG:
-            outputfile = path.join(
-                directions_dir, get_effective_lengths_directions_filename(alpha))
+    Args:
+        sim_root_dir (str): the simulation root directory
+        alpha (str): the viewing angle label, see AGN_VIEWING_DIRECTIONS_DEG
+        tracer (CloudsRayTracer, optional): the tracer of the clouds, built if it is not given. Defaults to None.
+        use_adaptive_directions (bool, optional): see USE_ADAPTIVE_DIRECTIONS. Defaults to USE_ADAPTIVE_DIRECTIONS.
+        n_workers (int, optional): number of processes tracing the directions, 1 when the caller
+            already runs in a worker process. Defaults to os.cpu_count().
 
-            rv = subprocess.call([create_nh_distribution,
-                                  str(sim_info.r_clouds/100),
-                                  str(sim_info.n_clouds),
-                                  str(sim_info.r1/100),
-                                  str(sim_info.r2/100),
-                                  outputfile,
-                                  f'{TOTAL_DIRECTIONS}',
-                                  f'{AGN_VIEWING_DIRECTIONS_DEG[alpha].beg}',
-                                  f'{AGN_VIEWING_DIRECTIONS_DEG[alpha].length}',
-                                  sim_info.clouds_file_path])
+    Returns:
+        str: the path to the effective lengths file
+    """
+    sim_info = AgnSimulationInfo.build_agn_simulation_info(
+        sim_root_dir=sim_root_dir)
 
-            if rv != 0:
-                print(f'There was a problem with {sim_dir}')
-                exit(-1)
+    if tracer is None and not sim_info.is_smooth:
+        tracer = build_clouds_ray_tracer(sim_info)
 
+    outputfile = get_effective_lengths_filepath(sim_root_dir, alpha)
+
+    if not path.exists(path.dirname(outputfile)):
+        mkdir(path.dirname(outputfile))
+
+    if use_adaptive_directions:
+        effective_lengths, _ = compute_effective_lengths_until_converged(sim_info=sim_info,
+                                                                         alpha=AGN_VIEWING_DIRECTIONS_DEG[alpha],
+                                                                         tracer=tracer,
+                                                                         n_workers=n_workers,
+                                                                         verbose=True)
+    else:
+        effective_lengths, _ = compute_effective_lengths_for_simulation(sim_info=sim_info,
+                                                                        alpha=AGN_VIEWING_DIRECTIONS_DEG[alpha],
+                                                                        n_directions=TOTAL_DIRECTIONS,
+                                                                        tracer=tracer,
+                                                                        n_workers=n_workers)
+
+    write_effective_lengths(outputfile, effective_lengths)
+    write_effective_lengths_sidecar(outputfile, effective_lengths)
+
+    return outputfile
+
+
+def main():
+    external_jobs = []
+
+    for root_dir in root_dirs:
         print('=====================================')
+        for sim_dir in listdir(root_dir):
+            sim_root_dir = path.join(root_dir, sim_dir)
+            if sim_dir == 'past' or path.isfile(sim_root_dir) or 'data' not in listdir(sim_root_dir):
+                print(f'Unknown path:: {sim_root_dir}')
+                continue
+            print(f'processing sim dir: {sim_dir}')
+            sim_info = AgnSimulationInfo.build_agn_simulation_info(
+                sim_root_dir=sim_root_dir)
+
+            print(sim_info)
+
+            directions_dir = path.join(
+                sim_root_dir, AGN_EFFECTIVE_LENGTHS_DIR_LABEL)
+
+            if not path.exists(directions_dir):
+                mkdir(directions_dir)
+
+            use_external_tool = USE_EXTERNAL_NH_DISTRIBUTION_TOOL
+
+            tracer = build_clouds_ray_tracer(
+                sim_info) if not use_external_tool and not sim_info.is_smooth else None
+
+            for alpha in AGN_VIEWING_DIRECTIONS_DEG:
+                outputfile = get_effective_lengths_filepath(sim_root_dir, alpha)
+
+                if use_external_tool:
+                    external_jobs.append(Job(label=f'{sim_dir} {alpha}',
+                                             args=[create_nh_distribution,
+                                                   str(sim_info.r_clouds/100),
+                                                   str(sim_info.n_clouds),
+                                                   str(sim_info.r1/100),
+                                                   str(sim_info.r2/100),
+                                                   outputfile,
+                                                   f'{TOTAL_DIRECTIONS}',
+                                                   f'{AGN_VIEWING_DIRECTIONS_DEG[alpha].beg}',
+                                                   f'{AGN_VIEWING_DIRECTIONS_DEG[alpha].length}',
+                                                   sim_info.clouds_file_path],
+                                             on_success=partial(write_effective_lengths_sidecar, outputfile)))
+                    continue
+
+                build_effective_lengths(sim_root_dir, alpha, tracer=tracer)
+
+            print('=====================================')
+
+    if external_jobs:
+        results = run_jobs(external_jobs)
+        print_jobs_summary(results)
+
+        if not all(result.succeeded for result in results):
+            exit(-1)
+
+
+if __name__ == '__main__':
+    main()
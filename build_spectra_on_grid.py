@@ -7,7 +7,10 @@ only valid simulations, and not other directories.
 
 The resulting spectra will be stored in 
     
-    /sim-root-dir/THETA_{angleInterval}_nh_grid_{nh_intervals}_{nh_left}_{nh_right}/
+    /sim-root-dir/THETA_{angleInterval}_nh_grid_{nh_intervals}_{nh_left}_{nh_right}_v{labellingVersion}/
+
+The labelling version (see SPECTRA_LABELLING_VERSION) keeps the spectra
+directories printed with an older NH labelling from being reused.
 """
 
 
@@ -19,42 +22,79 @@ import matplotlib.pyplot as plt
 from flux_density_utils import *
 from paths_in_this_machine import *
 from paths_in_this_machine import root_dirs
+from spectral_data_utils import get_spectra_directory_name_for_label
 
-for root_dir in root_dirs:
 
-    print("============================================")
+def get_spectra_on_grid_dir(sim_root_dir: str, alpha_label: str, grid: ColumnDensityGrid = DEFAULT_NH_GRID) -> str:
+    return os.path.join(sim_root_dir,
+                        get_spectra_directory_name_for_label(alpha_label=alpha_label, grid=grid))
 
-    for sim_dir_name in os.listdir(root_dir):
 
-        sim_dir = os.path.join(root_dir, sim_dir_name)
+def build_spectra_on_grid(sim_root_dir: str, alpha_label: str, builder: SpectraBuilder = None) -> str:
+    """Builds the spectra of the simulation for the given viewing angle and
+    prints them into the spectra directory, see get_spectra_on_grid_dir().
 
-        if sim_dir_name == 'past' or os.path.isfile(sim_dir) or 'data' not in os.listdir(sim_dir):
-            print(f'Unknown directory name: {sim_dir}')
-            continue
+    Args:
+        sim_root_dir (str): the simulation root directory
+        alpha_label (str): the viewing angle label, see AGN_VIEWING_DIRECTIONS_DEG
+        builder (SpectraBuilder, optional): the builder of the simulation, built if it is not given. Defaults to None.
 
+    Returns:
+        str: the spectra directory
+    """
+    if builder is None:
         sim_info = AgnSimulationInfo.build_agn_simulation_info(
-            sim_root_dir=sim_dir)
+            sim_root_dir=sim_root_dir)
 
-        print(sim_info)
+        builder = SpectraBuilder(sim_info=sim_info,
+                                 photon_registration_policy=NHPhotonRegistrationPolicy(simulation_info=sim_info))
 
-        reg_policy = NHPhotonRegistrationPolicy(simulation_info=sim_info)
+    output_dir = get_spectra_on_grid_dir(sim_root_dir, alpha_label,
+                                         grid=builder.registration_policy.grid)
 
-        builder = SpectraBuilder(sim_info=sim_info,
-                                 photon_registration_policy=reg_policy)
+    alpha = AGN_VIEWING_DIRECTIONS_DEG[alpha_label]
+
+    spectra = builder.build(translate_zenit(alpha.from_deg_to_rad()))
+
+    print_spectra(output_dir=output_dir,
+                  spectra=spectra)
 
-        for alpha_label in AGN_VIEWING_DIRECTIONS_DEG:
+    return output_dir
+
+
+def main():
+    for root_dir in root_dirs:
+
+        print("============================================")
 
-            output_dir = os.path.join(sim_info.sim_root_dir,
-                                      f'THETA_{alpha_label}_nh_grid_{reg_policy.grid.n_intervals}_{reg_policy.grid.left:0.2g}_{reg_policy.grid.right:0.2g}')
+        for sim_dir_name in os.listdir(root_dir):
 
-            if os.path.exists(output_dir):
+            sim_dir = os.path.join(root_dir, sim_dir_name)
+
+            if sim_dir_name == 'past' or os.path.isfile(sim_dir) or 'data' not in os.listdir(sim_dir):
+                print(f'Unknown directory name: {sim_dir}')
                 continue
 
-            alpha = AGN_VIEWING_DIRECTIONS_DEG[alpha_label]
+            sim_info = AgnSimulationInfo.build_agn_simulation_info(
+                sim_root_dir=sim_dir)
 
-            spectra = builder.build(translate_zenit(alpha.from_deg_to_rad()))
+            print(sim_info)
 
-            print_spectra(output_dir=output_dir,
-                          spectra=spectra)
+            reg_policy = NHPhotonRegistrationPolicy(simulation_info=sim_info)
 
-        print("============================================")
+            builder = SpectraBuilder(sim_info=sim_info,
+                                     photon_registration_policy=reg_policy)
+
+            for alpha_label in AGN_VIEWING_DIRECTIONS_DEG:
+
+                if os.path.exists(get_spectra_on_grid_dir(sim_info.sim_root_dir, alpha_label, grid=reg_policy.grid)):
+                    continue
+
+                build_spectra_on_grid(sim_info.sim_root_dir, alpha_label,
+                                      builder=builder)
+
+            print("============================================")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,155 +4,126 @@ from where we will extract the sum spectra and flux densities
 obtained from the simulations processed spectra.
 """
 from spectral_data_utils import *
-from colum_density_utils import get_all_effective_lengths, build_nh_list_from_effective_lengths, ColumnDensityDistribution
+from colum_density_utils import build_nh_histogram_from_effective_lengths_files, ColumnDensityDistribution
 from dataclasses import dataclass
 from spectrum_utils import PoissonSpectrumCountFactory, generate_source_spectrum_count_file, print_spectra
 from flux_density_utils import FluxDensityBuilder, FULL_TORUS_ANGLE_DEG
+from smooth_torus_utils import build_smooth_torus_nh_histogram
 
-for nh_aver in [1e22, 2e22, 5e22, 8e22, 1e23, 2e23, 5e23, 1e24]:
-    for n_aver in [-1, 2, 3, 4, 5, 8]:
-        for a_fe in [0.5, 0.7, 1, 1.5, 2]:
-            for alpha in [AngularInterval(60, 15), AngularInterval(75, 15)]:
-                sims_root_dir = simulations_root_dir(nh_aver=nh_aver)
+SPECTRAL_DATA_NH_AVERS = [1e22, 2e22, 5e22, 8e22, 1e23, 2e23, 5e23, 1e24]
+SPECTRAL_DATA_N_AVERS = [-1, 2, 3, 4, 5, 8]
+SPECTRAL_DATA_A_FES = [0.5, 0.7, 1, 1.5, 2]
+SPECTRAL_DATA_ALPHAS = [AngularInterval(60, 15), AngularInterval(75, 15)]
 
-                simulations = get_simulations_in_sims_root_dir(sims_root_dir=sims_root_dir,
-                                                               n_aver=n_aver, a_fe=a_fe)
 
-                if len(simulations) == 0:
-                    continue
+def get_alpha_label(alpha: AngularInterval) -> str:
+    for k in AGN_VIEWING_DIRECTIONS_DEG:
+        if AGN_VIEWING_DIRECTIONS_DEG[k] == alpha:
+            return k
 
-                print(f'Processing {sims_root_dir}')
 
-                n_photons = get_total_n_photons(simulations=simulations)
+def get_spectral_data_dir(sims_root_dir: str) -> str:
+    return os.path.join(sims_root_dir, 'spectral_data')
 
-                all_effective_lengths = get_all_effective_lengths(
-                    effective_lengths_filepaths=get_direction_filepaths(simulations=simulations, alpha=alpha))
 
-                nh_list_all = build_nh_list_from_effective_lengths(
-                    effective_lengths=all_effective_lengths, sim_info=simulations[0])
+def get_spectral_data_label_prefix(sims_root_dir: str, n_aver: int, a_fe: float, alpha: AngularInterval) -> str:
+    """Returns the common prefix of the labels of the spectral data files of the given combination.
+    """
+    return f'{get_nh_aver_label(sims_root_dir=sims_root_dir)}_{n_aver}_{IRON_ABUNDANCES[a_fe]}_{get_alpha_label(alpha)}_{NH_INTERVALS}_{LEFT_NH:0.2g}_{RIGHT_NH:0.2g}_'
 
-                nh_grid = ColumnDensityGrid(
-                    left_nh=LEFT_NH, right_nh=RIGHT_NH, n_intervals=NH_INTERVALS)
-                nh_distribution = ColumnDensityDistribution(
-                    nh_grid=nh_grid, nh_list=nh_list_all)
 
-                spectra_dirs = get_spectra_directories(
-                    simulations=simulations, alpha=alpha, grid=nh_grid)
+def build_spectral_data(nh_aver: float, n_aver: int, a_fe: float, alpha: AngularInterval) -> bool:
+    """Builds the spectral data files (spectra and flux densities of every component)
+    of the simulations of the given combination.
 
-                grouped_spectra_files = get_grouped_spectra_files(
-                    spectra_dirs=spectra_dirs)
+    Returns:
+        bool: False if there are no simulations of the combination
+    """
+    sims_root_dir = simulations_root_dir(nh_aver=nh_aver)
 
-                grouped_spectra = group_spectra(
-                    grouped_spectra_files=grouped_spectra_files)
+    simulations = get_simulations_in_sims_root_dir(sims_root_dir=sims_root_dir,
+                                                   n_aver=n_aver, a_fe=a_fe)
 
-                source_spectrum_file_path = generate_source_spectrum_count_file(
-                    num_of_photons=n_photons, bins=HV_N_INTERVALS)
+    if len(simulations) == 0:
+        return False
 
-                source_spectrum = PoissonSpectrumCountFactory.build_spectrum_count(
-                    source_spectrum_file_path)
+    print(f'Processing {sims_root_dir}')
 
-                source_flux_density = FluxDensityBuilder.build_norm_flux_density(norm_spectrum=source_spectrum,
-                                                                                 angle_interval=FULL_TORUS_ANGLE_DEG.from_deg_to_rad())
+    n_photons = get_total_n_photons(simulations=simulations)
 
-                continuum_spectra = build_continuum_spectra_map(
-                    grouped_spectra=grouped_spectra)
+    nh_grid = ColumnDensityGrid(
+        left_nh=LEFT_NH, right_nh=RIGHT_NH, n_intervals=NH_INTERVALS)
 
-                data_map = build_key_spectrum_flux_density_map(
-                    grouped_spectra=continuum_spectra,
-                    nh_distribution=nh_distribution,
-                    source_spectrum=source_spectrum,
-                    alpha_deg=alpha)
+    if all(simulation.is_smooth for simulation in simulations):
+        nh_histogram = build_smooth_torus_nh_histogram(
+            sim_info=simulations[0], alpha=alpha, nh_grid=nh_grid)
+    else:
+        nh_histogram = build_nh_histogram_from_effective_lengths_files(
+            effective_lengths_filepaths=get_direction_filepaths(
+                simulations=simulations, alpha=alpha),
+            sim_info=simulations[0],
+            nh_grid=nh_grid)
 
-                alpha_lbl = None
+    nh_distribution = ColumnDensityDistribution(
+        nh_grid=nh_grid, histogram=nh_histogram)
 
-                for k in AGN_VIEWING_DIRECTIONS_DEG:
-                    if AGN_VIEWING_DIRECTIONS_DEG[k] == alpha:
-                        alpha_lbl = k
-                        break
+    spectra_dirs = get_spectra_directories(
+        simulations=simulations, alpha=alpha, grid=nh_grid)
 
-                for kind in data_map:
-                    label = f'{get_nh_aver_label(sims_root_dir=sims_root_dir)}_{n_aver}_{IRON_ABUNDANCES[a_fe]}_{alpha_lbl}_{NH_INTERVALS}_{LEFT_NH:0.2g}_{RIGHT_NH:0.2g}_{kind}'
+    grouped_spectra_files = get_grouped_spectra_files(
+        spectra_dirs=spectra_dirs)
 
-                    spectral_data_dir = os.path.join(
-                        sims_root_dir, 'spectral_data')
+    grouped_spectra = group_spectra(
+        grouped_spectra_files=grouped_spectra_files)
 
-                    if not os.path.exists(spectral_data_dir):
-                        os.mkdir(spectral_data_dir)
+    source_spectrum_file_path = generate_source_spectrum_count_file(
+        num_of_photons=n_photons, bins=HV_N_INTERVALS)
 
-                    print_spectra(spectral_data_dir, {
-                        label+'.spectrum': data_map[kind][0]})
+    source_spectrum = PoissonSpectrumCountFactory.build_spectrum_count(
+        source_spectrum_file_path)
 
-                    print_spectra(spectral_data_dir, {
-                        label+'.fluxdensity': data_map[kind][1]})
+    source_flux_density = FluxDensityBuilder.build_norm_flux_density(norm_spectrum=source_spectrum,
+                                                                     angle_interval=FULL_TORUS_ANGLE_DEG.from_deg_to_rad())
 
-                fekalpha_spectra = build_fekalpha_spectra_map(
-                    grouped_spectra=grouped_spectra)
+    component_spectra = build_component_spectra_maps(
+        grouped_spectra=grouped_spectra)
 
-                data_map = build_key_spectrum_flux_density_map(
-                    grouped_spectra=fekalpha_spectra,
-                    nh_distribution=nh_distribution,
-                    source_spectrum=source_spectrum,
-                    alpha_deg=alpha)
+    spectral_data_dir = get_spectral_data_dir(sims_root_dir)
 
-                for kind in data_map:
-                    label = f'{get_nh_aver_label(sims_root_dir=sims_root_dir)}_{n_aver}_{IRON_ABUNDANCES[a_fe]}_{alpha_lbl}_{NH_INTERVALS}_{LEFT_NH:0.2g}_{RIGHT_NH:0.2g}_{kind}'
+    if not os.path.exists(spectral_data_dir):
+        os.mkdir(spectral_data_dir)
 
-                    spectral_data_dir = os.path.join(
-                        sims_root_dir, 'spectral_data')
+    label_prefix = get_spectral_data_label_prefix(sims_root_dir=sims_root_dir,
+                                                  n_aver=n_aver, a_fe=a_fe, alpha=alpha)
 
-                    if not os.path.exists(spectral_data_dir):
-                        os.mkdir(spectral_data_dir)
+    for component_label in component_spectra:
 
-                    print_spectra(spectral_data_dir, {
-                        label+'.spectrum': data_map[kind][0]})
+        data_map = build_key_spectrum_flux_density_map(
+            grouped_spectra=component_spectra[component_label],
+            nh_distribution=nh_distribution,
+            source_spectrum=source_spectrum,
+            alpha_deg=alpha)
 
-                    print_spectra(spectral_data_dir, {
-                        label+'.fluxdensity': data_map[kind][1]})
+        for kind in data_map:
+            label = f'{label_prefix}{kind}'
 
-                transmitted_spectra = build_transmitted_spectra_map(
-                    grouped_spectra=grouped_spectra)
+            print_spectra(spectral_data_dir, {
+                label+'.spectrum': data_map[kind][0]})
 
-                data_map = build_key_spectrum_flux_density_map(
-                    grouped_spectra=transmitted_spectra,
-                    nh_distribution=nh_distribution,
-                    source_spectrum=source_spectrum,
-                    alpha_deg=alpha)
+            print_spectra(spectral_data_dir, {
+                label+'.fluxdensity': data_map[kind][1]})
 
-                for kind in data_map:
-                    label = f'{get_nh_aver_label(sims_root_dir=sims_root_dir)}_{n_aver}_{IRON_ABUNDANCES[a_fe]}_{alpha_lbl}_{NH_INTERVALS}_{LEFT_NH:0.2g}_{RIGHT_NH:0.2g}_{kind}'
+    return True
 
-                    spectral_data_dir = os.path.join(
-                        sims_root_dir, 'spectral_data')
 
-                    if not os.path.exists(spectral_data_dir):
-                        os.mkdir(spectral_data_dir)
+def main():
+    for nh_aver in SPECTRAL_DATA_NH_AVERS:
+        for n_aver in SPECTRAL_DATA_N_AVERS:
+            for a_fe in SPECTRAL_DATA_A_FES:
+                for alpha in SPECTRAL_DATA_ALPHAS:
+                    build_spectral_data(nh_aver=nh_aver, n_aver=n_aver,
+                                        a_fe=a_fe, alpha=alpha)
 
-                    print_spectra(spectral_data_dir, {
-                        label+'.spectrum': data_map[kind][0]})
 
-                    print_spectra(spectral_data_dir, {
-                        label+'.fluxdensity': data_map[kind][1]})
-
-                compton_spectra = build_compton_spectra_map(
-                    grouped_spectra=grouped_spectra)
-
-                data_map = build_key_spectrum_flux_density_map(
-                    grouped_spectra=compton_spectra,
-                    nh_distribution=nh_distribution,
-                    source_spectrum=source_spectrum,
-                    alpha_deg=alpha)
-
-                for kind in data_map:
-                    label = f'{get_nh_aver_label(sims_root_dir=sims_root_dir)}_{n_aver}_{IRON_ABUNDANCES[a_fe]}_{alpha_lbl}_{NH_INTERVALS}_{LEFT_NH:0.2g}_{RIGHT_NH:0.2g}_{kind}'
-
-                    spectral_data_dir = os.path.join(
-                        sims_root_dir, 'spectral_data')
-
-                    if not os.path.exists(spectral_data_dir):
-                        os.mkdir(spectral_data_dir)
-
-                    print_spectra(spectral_data_dir, {
-                        label+'.spectrum': data_map[kind][0]})
-
-                    print_spectra(spectral_data_dir, {
-                        label+'.fluxdensity': data_map[kind][1]})
+if __name__ == '__main__':
+    main()
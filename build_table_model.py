@@ -0,0 +1,67 @@
+"""
+This script builds the table models (see table_model_utils) of the clumpy
+and of the smooth tori from the spectral_data/ directories, and exports them
+as OGIP table models:
+
+    /repo-directory/table_model_{nh_intervals}_{nh_left}_{nh_right}/
+    /repo-directory/smooth_table_model_{nh_intervals}_{nh_left}_{nh_right}/
+
+A table model with grid points without spectral data is only exported if
+TABLE_MODEL_FILL_VALUE is set, and the directory of a family without flux
+densities (for example no smooth torus simulations) is left empty.
+"""
+from typing import List
+from table_model_utils import build_table_model_files, has_table_model_flux_densities, write_ogip_table_model, TableModel
+from colum_density_utils import DEFAULT_NH_GRID
+from do_measurements import get_considered_root_dirs
+from paths_in_this_machine import repo_directory
+import os
+
+TABLE_MODEL_NAME = 'agntorus'
+
+SMOOTH_TABLE_MODEL_NAME = 'agnsmooth'
+
+TABLE_MODEL_FILL_VALUE = None
+"""The exported spectrum of the grid points without spectral data (XSPEC interpolates
+toward it), None to not export a sparse table model
+"""
+
+
+def get_table_model_dir(smooth: bool = False) -> str:
+    return os.path.join(repo_directory,
+                        f'{"smooth_" if smooth else ""}table_model_{DEFAULT_NH_GRID.n_intervals}_{DEFAULT_NH_GRID.left:0.2g}_{DEFAULT_NH_GRID.right:0.2g}')
+
+
+def get_ogip_table_model_filepath(smooth: bool = False) -> str:
+    return os.path.join(get_table_model_dir(smooth), f'{SMOOTH_TABLE_MODEL_NAME if smooth else TABLE_MODEL_NAME}.fits')
+
+
+def build_table_model() -> List[TableModel]:
+    models = []
+    for smooth in (False, True):
+        if not has_table_model_flux_densities(*get_considered_root_dirs(), smooth=smooth):
+            print(f'table model: there are no {"smooth" if smooth else "clumpy"} torus flux densities, '
+                  f'{get_table_model_dir(smooth)} is left empty')
+            # the directory is the output of the pipeline task, it must exist
+            os.makedirs(get_table_model_dir(smooth), exist_ok=True)
+            continue
+
+        model = build_table_model_files(get_table_model_dir(smooth),
+                                        *get_considered_root_dirs(),
+                                        smooth=smooth)
+
+        if model.missing_points > 0 and TABLE_MODEL_FILL_VALUE is None:
+            print(f'table model: {model.missing_points} grid point(s) without spectral data, '
+                  f'{get_ogip_table_model_filepath(smooth)} is not exported')
+        else:
+            write_ogip_table_model(model, get_ogip_table_model_filepath(smooth),
+                                   model_name=SMOOTH_TABLE_MODEL_NAME if smooth else TABLE_MODEL_NAME,
+                                   fill_value=TABLE_MODEL_FILL_VALUE)
+
+        models.append(model)
+
+    return models
+
+
+if __name__ == '__main__':
+    build_table_model()
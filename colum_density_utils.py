@@ -36,8 +36,10 @@ print(*[f'{nh_i:>8.3g}: {nh_distribution.get_distribution_value_for_nh(nh_i):>8.
 
 from utils import *
 import pint
-from agn_simulation_policy import AGN_SIMULATION_UNITS, AGN_PROCESSING_UNITS
-from agn_processing_policy import LEFT_NH, NH_INTERVALS, RIGHT_NH
+import os
+from functools import lru_cache
+from agn_simulation_policy import AGN_SIMULATION_UNITS, AGN_PROCESSING_UNITS, get_effective_lengths_sidecar_filepath
+from agn_processing_policy import LEFT_NH, NH_INTERVALS, RIGHT_NH, NH_CONVERGENCE_MIN_BIN_FRACTION
 from agn_utils import AgnSimulationInfo
 from typing import Final
 
@@ -112,13 +114,92 @@ class ColumnDensityGrid:
     def index(self, nh: float):
         """Get the grid index of the given column density.
 
+        The index is not validated, so column densities out of
+        the grid give indexes out of [0, n_intervals).
+
+        Args:
+            nh (float): the column density, it can also be an array of column densities
+
+        Returns:
+            int | np.ndarray: the index (or indexes for an array of column densities)
+        """
+        if np.ndim(nh) == 0:
+            if(nh <= 0):
+                return 0
+
+            return int((np.log10(nh)-np.log10(self.left))/self.d_nh)
+
+        nh = np.asarray(nh, dtype=float)
+        indexes = np.zeros(nh.shape, dtype=np.int64)
+        positive = nh > 0
+        indexes[positive] = np.trunc(
+            (np.log10(nh[positive])-np.log10(self.left))/self.d_nh)
+        return indexes
+
+    @property
+    def underflow_index(self) -> int:
+        """The bin index of the column densities below the grid (nh < left, including nh = 0).
+        """
+        return -1
+
+    @property
+    def overflow_index(self) -> int:
+        """The bin index of the column densities above the grid (right < nh).
+        """
+        return self.n_intervals
+
+    def bin_index(self, nh: float):
+        """Get the bin of the given column density, with the bins of histogram():
+        its grid index if it is in [left, right] (the right-most value belongs to
+        the last bin), else underflow_index or overflow_index.
+
+        Args:
+            nh (float): the column density, it can also be an array of column densities
+
+        Returns:
+            int | np.ndarray: the bin index (or indexes for an array of column densities)
+        """
+        nh_values = np.asarray(nh, dtype=float)
+
+        indexes = np.clip(self.index(nh_values), 0, self.n_intervals-1)
+        indexes = np.where(nh_values < self.left, self.underflow_index,
+                           np.where(self.right < nh_values, self.overflow_index, indexes))
+
+        return int(indexes) if np.ndim(nh) == 0 else indexes
+
+    def bin_nh(self, index: int) -> float:
+        """Get a column density of the given bin (see bin_index()): the mid-value of a grid bin,
+        0 for the underflow bin and inf for the overflow bin.
+        """
+        if index == self.underflow_index:
+            return 0.0
+        if index == self.overflow_index:
+            return np.inf
+        return self.nh_list[index]
+
+    def histogram(self, nh_values: np.ndarray) -> Tuple[np.ndarray, int, int]:
+        """Counts the given column densities on the grid.
+
+        The values in [left, right] are counted in their grid bins (the right-most
+        value belongs to the last bin), the rest are counted apart as underflow
+        (nh < left) and overflow (right < nh).
+
         Args:
-            nh (float): the column density
+            nh_values (np.ndarray): the column densities
+
+        Returns:
+            Tuple[np.ndarray, int, int]: counts, underflow, overflow
         """
-        if(nh <= 0):
-            return 0
+        nh_values = np.asarray(nh_values, dtype=float)
 
-        return int((np.log10(nh)-np.log10(self.left))/self.d_nh)
+        indexes = self.bin_index(nh_values)
+        underflow = int(np.count_nonzero(indexes == self.underflow_index))
+        overflow = int(np.count_nonzero(indexes == self.overflow_index))
+
+        counts = np.bincount(indexes[(0 <= indexes) & (indexes < self.n_intervals)],
+                             minlength=self.n_intervals).astype(float)
+
+        return counts, underflow, overflow
 
     def __str__(self):
         return f'{self.left:0.2g}:{self.right:0.2g}:{self.n_intervals}'
@@ -155,22 +236,139 @@ def get_hydrogen_concentration(aver_column_density: float,
     return aver_column_density/(filling_factor*(external_torus_radius-internal_torus_radius))
 
 
+@lru_cache(maxsize=None)
 def _get_multiplication_factor_to_translate_from_sim_to_processing_units(dimensionality: str) -> float:
     ureg = pint.UnitRegistry()
     return (1.0*ureg[AGN_SIMULATION_UNITS[dimensionality]]).to(ureg[AGN_PROCESSING_UNITS[dimensionality]]).magnitude
 
 
+EFFECTIVE_LENGTHS_CHUNK_SIZE = 1_000_000
+"""Number of effective lengths processed at once when streaming the effective lengths files.
+"""
+
+
+def write_effective_lengths_sidecar(path_to_effective_lengths_file: str, effective_lengths: np.ndarray = None) -> str:
+    """Writes the binary copy of the given effective lengths file, so that
+    it can be memory-mapped instead of parsed.
+
+    The values are kept in the simulation units.
+
+    Args:
+        path_to_effective_lengths_file (str): path to the effective lengths (text) file
+        effective_lengths (np.ndarray, optional): the content of the file, if it is already known. Defaults to None.
+
+    Returns:
+        str: path to the binary copy
+    """
+    if effective_lengths is None:
+        effective_lengths = np.loadtxt(path_to_effective_lengths_file, ndmin=1)
+
+    sidecar_filepath = get_effective_lengths_sidecar_filepath(
+        path_to_effective_lengths_file)
+    np.save(sidecar_filepath, np.asarray(effective_lengths, dtype=float))
+    return sidecar_filepath
+
+
+def _has_updated_sidecar(path_to_effective_lengths_file: str) -> bool:
+    sidecar_filepath = get_effective_lengths_sidecar_filepath(
+        path_to_effective_lengths_file)
+    return os.path.exists(sidecar_filepath) and os.path.getmtime(sidecar_filepath) >= os.path.getmtime(path_to_effective_lengths_file)
+
+
+def load_raw_effective_lengths(path_to_effective_lengths_file: str) -> np.ndarray:
+    """Returns the effective lengths of the given file in the simulation units.
+
+    If the binary copy of the file exists (and it is not older than the file), it is
+    memory-mapped, so the values are read only when they are used.
+
+    Args:
+        path_to_effective_lengths_file (str): path to the effective lengths file
+
+    Returns:
+        np.ndarray: the effective lengths (read-only if memory-mapped)
+    """
+    if _has_updated_sidecar(path_to_effective_lengths_file):
+        return np.load(get_effective_lengths_sidecar_filepath(path_to_effective_lengths_file), mmap_mode='r')
+
+    return np.loadtxt(path_to_effective_lengths_file, ndmin=1)
+
+
+def _count_effective_lengths(path_to_effective_lengths_file: str) -> int:
+    if _has_updated_sidecar(path_to_effective_lengths_file):
+        return len(load_raw_effective_lengths(path_to_effective_lengths_file))
+
+    n_lines = 0
+    with open(path_to_effective_lengths_file, 'rb') as file:
+        for line in file:
+            if line.strip():
+                n_lines += 1
+    return n_lines
+
+
 def get_effective_lengths(path_to_effective_lengths_file: str) -> np.ndarray:
-    data = np.loadtxt(path_to_effective_lengths_file)
+    data = load_raw_effective_lengths(path_to_effective_lengths_file)
     return data*_get_multiplication_factor_to_translate_from_sim_to_processing_units(dimensionality=LENGTH)
 
 
 def get_all_effective_lengths(effective_lengths_filepaths: List[str]) -> np.ndarray:
-    directions = []
-    for file_i in effective_lengths_filepaths:
-        directions += list(get_effective_lengths(path_to_effective_lengths_file=file_i))
+    """Returns the effective lengths of all the given files in one array.
 
-    return np.array(directions)
+    The files are streamed into a preallocated array, one file at a time.
+
+    Args:
+        effective_lengths_filepaths (List[str]): paths to the effective lengths files
+
+    Returns:
+        np.ndarray: the effective lengths in the processing units
+    """
+    n_directions = [_count_effective_lengths(
+        file_i) for file_i in effective_lengths_filepaths]
+
+    directions = np.empty(sum(n_directions))
+
+    position = 0
+    for file_i, n_directions_i in zip(effective_lengths_filepaths, n_directions):
+        directions[position:position +
+                   n_directions_i] = load_raw_effective_lengths(file_i)
+        position += n_directions_i
+
+    directions *= _get_multiplication_factor_to_translate_from_sim_to_processing_units(
+        dimensionality=LENGTH)
+
+    return directions
+
+
+def histogram_max_relative_change(previous_counts: np.ndarray, previous_total: float,
+                                  counts: np.ndarray, total: float,
+                                  min_bin_fraction: float = NH_CONVERGENCE_MIN_BIN_FRACTION) -> float:
+    """Measures how much a normalized histogram changed after adding more values.
+
+    Only the occupied bins are compared, ie the bins with a normalized count of at
+    least min_bin_fraction in the current histogram, because the relative change of
+    the (almost) empty bins is just noise.
+
+    Args:
+        previous_counts (np.ndarray): counts before adding the values
+        previous_total (float): total number of values before adding the values (underflow and overflow included)
+        counts (np.ndarray): counts after adding the values
+        total (float): total number of values after adding the values
+        min_bin_fraction (float, optional): smallest normalized count of an occupied bin. Defaults to NH_CONVERGENCE_MIN_BIN_FRACTION.
+
+    Returns:
+        float: the maximum relative change of the normalized counts, inf if there was no previous histogram
+    """
+    if previous_total == 0:
+        return np.inf
+
+    previous_fractions = previous_counts/previous_total
+    fractions = counts/total
+
+    occupied = fractions >= min_bin_fraction
+
+    if not np.any(occupied):
+        return 0.0
+
+    return float(np.max(np.abs(fractions[occupied] - previous_fractions[occupied])/fractions[occupied]))
 
 
 def build_nh_list_from_effective_lengths(effective_lengths: np.ndarray, sim_info: AgnSimulationInfo) -> np.ndarray:
@@ -183,39 +381,132 @@ def build_nh_list_from_effective_lengths(effective_lengths: np.ndarray, sim_info
     return effective_lengths*hydrogen_concentration
 
 
+def build_nh_histogram_from_effective_lengths_files(effective_lengths_filepaths: List[str],
+                                                    sim_info: AgnSimulationInfo,
+                                                    nh_grid: ColumnDensityGrid,
+                                                    chunk_size: int = EFFECTIVE_LENGTHS_CHUNK_SIZE) -> Histo:
+    """Builds the (not normalized) histogram of the column densities of the given
+    effective lengths files, without materializing all the column densities.
+
+    The files are processed by chunks, accumulating the counts, the mean and the
+    spread of the column densities, thus the returned histogram has no raw data.
+
+    Example:
+
+        histogram = build_nh_histogram_from_effective_lengths_files(
+            effective_lengths_filepaths=get_direction_filepaths(simulations=simulations, alpha=alpha),
+            sim_info=simulations[0],
+            nh_grid=DEFAULT_NH_GRID)
+
+        nh_distribution = ColumnDensityDistribution(nh_grid=DEFAULT_NH_GRID, histogram=histogram)
+
+    Args:
+        effective_lengths_filepaths (List[str]): paths to the effective lengths files
+        sim_info (AgnSimulationInfo): simulation info to translate the effective lengths into column densities
+        nh_grid (ColumnDensityGrid): the grid of the histogram
+        chunk_size (int, optional): number of values processed at once. Defaults to EFFECTIVE_LENGTHS_CHUNK_SIZE.
+
+    Returns:
+        Histo: the histogram of the column densities
+    """
+    to_processing_units = _get_multiplication_factor_to_translate_from_sim_to_processing_units(
+        dimensionality=LENGTH)
+
+    histogram = Histo(bins=np.array(nh_grid.nh_list),
+                      counts=np.zeros(nh_grid.n_intervals),
+                      counts_err=np.zeros(nh_grid.n_intervals),
+                      raw_data=None)
+
+    for file_i in effective_lengths_filepaths:
+        raw_effective_lengths = load_raw_effective_lengths(file_i)
+
+        for start in range(0, len(raw_effective_lengths), chunk_size):
+            nh_values = build_nh_list_from_effective_lengths(
+                effective_lengths=raw_effective_lengths[start:start +
+                                                        chunk_size]*to_processing_units,
+                sim_info=sim_info)
+
+            counts, underflow, overflow = nh_grid.histogram(nh_values)
+            histogram.counts += counts
+            histogram.underflow += underflow
+            histogram.overflow += overflow
+            histogram.add_raw_moments(nh_values)
+
+    histogram.counts_err = np.sqrt(histogram.counts)
+    histogram.underflow_err = histogram.underflow**0.5
+    histogram.overflow_err = histogram.overflow**0.5
+
+    return histogram
+
+
 class ColumnDensityDistribution:
+    """The normalized distribution of the column densities on the given grid.
+
+    The column densities out of the grid are not folded into the first
+    and last bins, they are kept in the underflow (nh < grid.left) and
+    overflow (grid.right < nh) bins. The distribution is normalized
+    to the total number of column densities, including those out of the grid.
 
-    def __init__(self, nh_grid: ColumnDensityGrid, nh_list: np.ndarray):
+    The photons are labelled with the same bins (see ColumnDensityGrid.bin_index()),
+    so the spectra of the underflow and overflow bins are normalized with
+    get_underflow() and get_overflow(), see ColumnDensityGrid.bin_nh().
+    """
+
+    def __init__(self, nh_grid: ColumnDensityGrid, nh_list: np.ndarray = None, histogram: Histo = None):
+        """Builds the distribution from the column densities or from their
+        (not normalized) histogram, see build_nh_histogram_from_effective_lengths_files().
+
+        Args:
+            nh_grid (ColumnDensityGrid): the grid of the distribution
+            nh_list (np.ndarray, optional): the column densities. Defaults to None.
+            histogram (Histo, optional): the histogram of the column densities on the grid, it will be normalized. Defaults to None.
+        """
         self.grid = nh_grid
-        self._histogram = Histo(bins=np.array(self.grid.nh_list), counts=np.zeros(
-            self.grid.n_intervals), counts_err=np.zeros(
-            self.grid.n_intervals), raw_data=nh_list)
-        self._build_histogram(histogram=self._histogram)
-
-    def _build_histogram(self, histogram: Histo):
-        for nh_i in histogram.raw_data:
-            if self.grid.left <= nh_i <= self.grid.right:
-                index = self.grid.index(nh_i)
-                histogram.counts[index] += 1
-                histogram.counts_err[index] = histogram.counts[index]**0.5
-            elif nh_i < self.grid.left:
-                index = 0
-                histogram.counts[index] += 1
-                histogram.counts_err[index] = histogram.counts[index]**0.5
-            elif self.grid.right < nh_i:
-                index = -1
-                histogram.counts[index] += 1
-                histogram.counts_err[index] = histogram.counts[index]**0.5
-
-        total_count = sum(histogram.counts)
-        histogram.counts /= total_count
-        histogram.counts_err /= total_count
+
+        if histogram is None:
+            histogram = Histo(bins=np.array(self.grid.nh_list), counts=np.zeros(
+                self.grid.n_intervals), counts_err=np.zeros(
+                self.grid.n_intervals), raw_data=nh_list)
+            histogram.counts, histogram.underflow, histogram.overflow = self.grid.histogram(
+                histogram.raw_data)
+
+        self._histogram = histogram
+        self._normalize_histogram(histogram=self._histogram)
+
+    def _normalize_histogram(self, histogram: Histo):
+        counts, underflow, overflow = histogram.counts, histogram.underflow, histogram.overflow
+
+        total_count = np.sum(counts) + underflow + overflow
+        histogram.counts = counts/total_count
+        histogram.counts_err = np.sqrt(counts)/total_count
+        histogram.underflow = underflow/total_count
+        histogram.underflow_err = underflow**0.5/total_count
+        histogram.overflow = overflow/total_count
+        histogram.overflow_err = overflow**0.5/total_count
 
     def get_distribution_value_for_nh(self, nh: float) -> float:
-        return self._histogram.counts[self.grid.index(nh=nh)]
+        if nh < self.grid.left:
+            return self._histogram.underflow
+        if self.grid.right < nh:
+            return self._histogram.overflow
+        return self._histogram.counts[min(self.grid.index(nh=nh), self.grid.n_intervals-1)]
 
     def get_distribution_value_err_for_nh(self, nh: float) -> float:
-        return self._histogram.counts_err[self.grid.index(nh=nh)]
+        if nh < self.grid.left:
+            return self._histogram.underflow_err
+        if self.grid.right < nh:
+            return self._histogram.overflow_err
+        return self._histogram.counts_err[min(self.grid.index(nh=nh), self.grid.n_intervals-1)]
+
+    def get_underflow(self) -> float:
+        """Fraction of the column densities below the grid.
+        """
+        return self._histogram.underflow
+
+    def get_overflow(self) -> float:
+        """Fraction of the column densities above the grid.
+        """
+        return self._histogram.overflow
 
     def get_mean(self):
         return self._histogram.mean()
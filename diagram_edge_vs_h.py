@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 from typing import Dict, Tuple, List
 import numpy as np
 from paths_in_this_machine import *
+from do_measurements import get_measurements_filepath
 from matplotlib.lines import Line2D
 from scipy.optimize import curve_fit
 from agn_art_utils import *
@@ -19,7 +20,7 @@ def fit_h_N_fit_m1(h, a, b, c):
 
 used_nh_aver = '24'
 
-data = load_data_from_file(MEASUREMENTS_FILEPATH)
+data = load_data_from_file(get_measurements_filepath())
 data = filter_data_by_nhaver(data=data, nh_aver=used_nh_aver)
 
 permitted_indices = [DEFAULT_NH_GRID.index(
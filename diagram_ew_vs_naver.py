@@ -2,7 +2,7 @@ from colum_density_utils import ValueAndError, ColumnDensityGrid
 from agn_processing_policy import *
 import matplotlib.pyplot as plt
 from measurable_utils import load_data_from_file, filter_data_by_nh, filter_data_by_nhaver, filter_data_by_viewing_angle, AngularInterval, filter_data_by_abundance
-from paths_in_this_machine import repo_directory, MEASUREMENTS_FILEPATH
+from do_measurements import get_measurements_filepath
 from scipy.optimize import curve_fit
 from agn_art_utils import *
 from matplotlib.pyplot import figure
@@ -19,7 +19,7 @@ figure(figsize=(8, 7), dpi=120)
 
 plt.grid()
 
-data = load_data_from_file(measurements_filepath=MEASUREMENTS_FILEPATH)
+data = load_data_from_file(measurements_filepath=get_measurements_filepath())
 data = filter_data_by_nh(data=data, nh_index=DEFAULT_NH_GRID.index(nh=1e24))
 data = filter_data_by_nhaver(data=data, nh_aver='24')
 data = filter_data_by_abundance(data=data, a_fe='1xfe')
@@ -1,4 +1,4 @@
-from measurable_utils import get_edge_vs_h, parse_measurement
+from measurable_utils import get_edge_vs_h
 from colum_density_utils import ColumnDensityGrid, DEFAULT_NH_GRID
 from agn_processing_policy import *
 from agn_simulation_policy import AGN_IRON_ABUNDANCE, AGN_NH_AVERAGE
@@ -9,7 +9,7 @@ import os
 from paths_in_this_machine import *
 from matplotlib.pyplot import figure
 from measurable_utils import AngularInterval, load_data_from_file, filter_data_by_nh, filter_data_by_viewing_angle
-from paths_in_this_machine import MEASUREMENTS_FILEPATH
+from do_measurements import get_measurements_filepath
 from agn_art_utils import *
 import random
 figure(figsize=(8, 7), dpi=120)
@@ -25,7 +25,7 @@ def fit_h_N_fit_m2(h, a, b, c, d):
 
 plt.grid()
 
-data = load_data_from_file(measurements_filepath=MEASUREMENTS_FILEPATH)
+data = load_data_from_file(measurements_filepath=get_measurements_filepath())
 data = filter_data_by_nh(data=data, nh_index=DEFAULT_NH_GRID.index(nh=1e23))
 data_60 = filter_data_by_viewing_angle(
     data=data, alpha=AngularInterval(60, 15))
@@ -4,9 +4,9 @@ import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from typing import Dict, List, Tuple, Final
 from agn_simulation_policy import AGN_NH_AVERAGE
-from measurable_utils import parse_measurement, get_shoulder_vs_nhaver
-from measurements import MeasurementKey, MeasurementValue, AngularInterval
-from paths_in_this_machine import repo_directory
+from measurable_utils import get_shoulder_vs_nhaver
+from measurements import MeasurementKey, MeasurementValue, AngularInterval, iterate_measurements
+from do_measurements import get_measurements_filepath
 import os
 from matplotlib.pyplot import figure
 
@@ -51,20 +51,18 @@ g = ColumnDensityGrid(left_nh=LEFT_NH, right_nh=RIGHT_NH,
 def get_shoulder_vs_ew(measurements_filepath: str, nh_id: int, a_fe: str) -> Dict[MeasurementKey, Tuple[ValueAndError, ValueAndError]]:
     data: Dict[MeasurementKey, Tuple[ValueAndError, ValueAndError]] = {}
 
-    with open(measurements_filepath) as measurements_file:
-        for line in measurements_file:
-            key, value = parse_measurement(measurement_line=line)
+    for key, value in iterate_measurements(measurements_filepath):
 
-            if nh_id != key.nh_index or a_fe != key.a_fe:
-                continue
+        if nh_id != key.nh_index or a_fe != key.a_fe:
+            continue
 
-            data[key] = (value.ew, value.shoulder)
+        data[key] = (value.ew, value.shoulder)
 
     return data
 
 
 data: Dict[MeasurementKey, Tuple[ValueAndError, ValueAndError]] = get_shoulder_vs_ew(
-    os.path.join(repo_directory, f"{g.n_intervals}_{g.left:0.2g}_{g.right:0.2g}_{HV_N_INTERVALS}.measurements"), nh_id=g.index(1e24), a_fe='1xfe')
+    get_measurements_filepath(), nh_id=g.index(1e24), a_fe='1xfe')
 
 colors_used = []
 nha_used = []
@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 from typing import Dict, List, Tuple
 from agn_simulation_policy import AGN_NH_AVERAGE, AGN_IRON_ABUNDANCE
 from measurable_utils import get_shoulder_vs_nhaver
-from paths_in_this_machine import repo_directory, MEASUREMENTS_FILEPATH
+from do_measurements import get_measurements_filepath
 import os
 from agn_art_utils import *
 import random
@@ -25,7 +25,7 @@ def fit_function(nh_aver, a, b, c, d, e):
 plt.grid()
 
 data: Dict[Tuple[str, str, bool, int], List[ValueAndError]] = get_shoulder_vs_nhaver(
-    os.path.join(repo_directory, MEASUREMENTS_FILEPATH))
+    get_measurements_filepath())
 
 x = []
 y = []
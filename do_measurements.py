@@ -1,17 +1,80 @@
 from measurements import *
 from colum_density_utils import ColumnDensityGrid
+from measurement_table_utils import MEASUREMENTS_TABLE_SUFFIX
 from paths_in_this_machine import root_dirs, repo_directory
 import os
 
+MEASUREMENT_NHS = [1e22, 2e22, 5e22, 8e22, 1e23,
+                   2e23, 5e23, 8e23, 1e24, 2e24, 4e24]
+
+MEASUREMENT_BOOTSTRAP_REPLICAS = 0
+"""Poisson replicas of the bootstrap intervals of ew, h and shoulder. 0 keeps the propagated
+errors; set it (for example to BOOTSTRAP_REPLICAS) to store the bootstrap intervals instead,
+the *_err columns are then their half widths.
+"""
+
 nh_grid = ColumnDensityGrid(
     left_nh=LEFT_NH, right_nh=RIGHT_NH, n_intervals=NH_INTERVALS)
-considered_nh_indexes = [nh_grid.index(
-    nh) for nh in [1e22, 2e22, 5e22, 8e22, 1e23, 2e23, 5e23, 8e23, 1e24, 2e24, 4e24]]
-considered_root_dirs = [os.path.join(
-    repo_directory, root_dir) for root_dir in root_dirs]
-output_filepath = os.path.join(
-    repo_directory, f"{nh_grid.n_intervals}_{nh_grid.left:0.2g}_{nh_grid.right:0.2g}.measurements")
-
-perform_measurements(considered_nh_indexes,
-                     output_filepath,
-                     *considered_root_dirs)
+
+
+def get_considered_root_dirs() -> List[str]:
+    return [os.path.join(repo_directory, root_dir) for root_dir in root_dirs]
+
+
+def get_measurements_filepath() -> str:
+    return os.path.join(
+        repo_directory, f"{nh_grid.n_intervals}_{nh_grid.left:0.2g}_{nh_grid.right:0.2g}.measurements{MEASUREMENTS_TABLE_SUFFIX}")
+
+
+def get_nh_bins_measurements_filepath() -> str:
+    return os.path.join(
+        repo_directory, f"{nh_grid.n_intervals}_{nh_grid.left:0.2g}_{nh_grid.right:0.2g}.nh_bins.measurements{MEASUREMENTS_TABLE_SUFFIX}")
+
+
+def get_line_measurements_filepath() -> str:
+    return os.path.join(
+        repo_directory, f"{nh_grid.n_intervals}_{nh_grid.left:0.2g}_{nh_grid.right:0.2g}.lines.measurements{MEASUREMENTS_TABLE_SUFFIX}")
+
+
+def do_line_measurements() -> Dict[str, int]:
+    """Measures every registered fluorescent line (see FLUORESCENT_LINES) of the MEASUREMENT_NHS keys.
+    """
+    measured_keys = perform_line_measurements([nh_grid.index(nh) for nh in MEASUREMENT_NHS],
+                                              get_line_measurements_filepath(),
+                                              *get_considered_root_dirs())
+
+    print(f'line measurements: {measured_keys}')
+
+    return measured_keys
+
+
+def do_nh_bins_measurements() -> Dict[str, NHBinsMeasurements]:
+    """Measures all the NH bins (not only MEASUREMENT_NHS) of every combination, see measure_all_nh_bins().
+    """
+    measurements = measure_all_nh_bins(*get_considered_root_dirs(),
+                                       n_nh_intervals=nh_grid.n_intervals)
+
+    write_nh_bins_measurements(get_nh_bins_measurements_filepath(),
+                               measurements)
+
+    return measurements
+
+
+def do_measurements(n_workers: int = os.cpu_count(), bootstrap_replicas: int = MEASUREMENT_BOOTSTRAP_REPLICAS) -> List[MeasurementFailure]:
+    output_filepath = get_measurements_filepath()
+
+    failures = perform_measurements([nh_grid.index(nh) for nh in MEASUREMENT_NHS],
+                                    output_filepath,
+                                    *get_considered_root_dirs(),
+                                    n_workers=n_workers,
+                                    bootstrap_replicas=bootstrap_replicas)
+
+    if failures:
+        print(
+            f'{len(failures)} measurement(s) failed, see {output_filepath}.failures')
+
+    return failures
+
+
+if __name__ == '__main__':
+    do_measurements()
@@ -0,0 +1,204 @@
+"""
+==================================
+
+Example: 'how to use the energy grid of the project'
+
+grid = EnergyGrid.build(left=HV_LEFT, right=HV_RIGHT, n_intervals=HV_N_INTERVALS)
+
+print(grid.centers[:10])
+print(grid.widths[:10])
+print(grid.index(np.array([1000, 6404.7, 7124])))
+print(grid.index_range(EnergyInterval(6300, 6500)))
+
+# the grid is interned, thus the identity check is enough to compare grids
+print(grid is DEFAULT_ENERGY_GRID)
+
+==================================
+"""
+from __future__ import annotations
+from utils import *
+from agn_processing_policy import HV_LEFT, HV_RIGHT, HV_N_INTERVALS
+from typing import Final, Dict
+
+
+def log_interval_index(value, left: float, right: float, num_of_intervals: int):
+    """Returns the interval index corresponding to the given value(s).
+    The whole value interval [left, right] is in a log10 scale.
+
+    The index is not validated, thus values out of the interval
+    give indexes out of [0, num_of_intervals).
+
+    Args:
+        value (float | np.ndarray): value(s) within the interval
+        left (float): left bound of the whole interval
+        right (float): right bound of the whole interval
+        num_of_intervals (int): number of bins
+
+    Returns:
+        int | np.ndarray: the index (or indexes for an array of values)
+    """
+    if np.ndim(value) == 0:
+        return int(num_of_intervals * (np.log10(value/left))/(np.log10(right/left)))
+
+    value = np.asarray(value, dtype=float)
+    indexes = np.full(value.shape, -1, dtype=np.int64)
+    positive = value > 0
+    indexes[positive] = np.trunc(
+        num_of_intervals * (np.log10(value[positive]/left))/(np.log10(right/left)))
+    return indexes
+
+
+class EnergyGrid:
+    """
+    This class represents the logarithmic energy grid on which
+    the spectra and flux densities of the project are defined.
+
+    The grid holds the edges, the centers and the widths of the
+    energy bins. It is immutable and interned: use EnergyGrid.build()
+    to get it, so that the same (left, right, n_intervals) always gives
+    the same object and the spectra can simply reference it.
+
+    Thus two spectra are on the same energy grid if
+
+        spectrum_a.grid is spectrum_b.grid
+    """
+
+    _instances: Dict[Tuple[float, float, int], EnergyGrid] = {}
+
+    def __init__(self, left: float, right: float, n_intervals: int):
+        """Don't create an instance yourself, use the factory method instead!
+
+        Args:
+            left (float): left-most bound of the grid
+            right (float): right-most bound of the grid
+            n_intervals (int): number of energy bins
+        """
+
+        d_hv_expo = (np.log10(right)-np.log10(left))/n_intervals
+        powers = 10**(d_hv_expo*np.arange(n_intervals+1))
+
+        edges = left*powers
+        widths = left*(powers[1:]-powers[:-1])
+        centers = edges[:-1] + (edges[1:]-edges[:-1])/2
+
+        for array in (edges, widths, centers):
+            array.setflags(write=False)
+
+        self._left = left
+        self._right = right
+        self._n_intervals = n_intervals
+        self._edges = edges
+        self._centers = centers
+        self._widths = widths
+
+    @staticmethod
+    def build(left: float = HV_LEFT, right: float = HV_RIGHT, n_intervals: int = HV_N_INTERVALS) -> EnergyGrid:
+        """This factory method returns the (interned) energy grid.
+
+        Args:
+            left (float, optional): left-most bound of the grid. Defaults to HV_LEFT.
+            right (float, optional): right-most bound of the grid. Defaults to HV_RIGHT.
+            n_intervals (int, optional): number of energy bins. Defaults to HV_N_INTERVALS.
+
+        Returns:
+            EnergyGrid: the energy grid
+        """
+        key = (float(left), float(right), int(n_intervals))
+
+        if key not in EnergyGrid._instances:
+            EnergyGrid._instances[key] = EnergyGrid(*key)
+
+        return EnergyGrid._instances[key]
+
+    @staticmethod
+    def find(centers: np.ndarray, rtol: float = DEFAULT_EPSILON) -> EnergyGrid:
+        """Returns the already built energy grid whose bin centers are the given ones.
+
+        This is useful for spectra that are read from files.
+
+        Args:
+            centers (np.ndarray): the x values of a spectrum
+            rtol (float, optional): relative tolerance to compare the centers. Defaults to DEFAULT_EPSILON.
+
+        Returns:
+            EnergyGrid: the matching grid, or None if there is no such grid.
+        """
+        for grid in EnergyGrid._instances.values():
+            if len(grid.centers) == len(centers) and np.allclose(grid.centers, centers, rtol=rtol, atol=0):
+                return grid
+
+        return None
+
+    @property
+    def left(self) -> float:
+        return self._left
+
+    @property
+    def right(self) -> float:
+        return self._right
+
+    @property
+    def n_intervals(self) -> int:
+        return self._n_intervals
+
+    @property
+    def edges(self) -> np.ndarray:
+        """the n_intervals+1 bounds of the energy bins
+        """
+        return self._edges
+
+    @property
+    def centers(self) -> np.ndarray:
+        """the mid-values of the energy bins
+        """
+        return self._centers
+
+    @property
+    def widths(self) -> np.ndarray:
+        """the widths of the energy bins [E_{i+1} - E_i]
+        """
+        return self._widths
+
+    @property
+    def interval(self) -> EnergyInterval:
+        return EnergyInterval(self._left, self._right)
+
+    def index(self, value):
+        """Get the bin index of the given energy (or array of energies).
+
+        The index is not validated, so energies out of the grid
+        give indexes out of [0, n_intervals).
+
+        Args:
+            value (float | np.ndarray): the energy
+
+        Returns:
+            int | np.ndarray: the bin index (or indexes)
+        """
+        return log_interval_index(value, self._left, self._right, self._n_intervals)
+
+    def index_range(self, energy_interval: Interval2D) -> Tuple[int, int]:
+        """Get the range of the bins whose centers are in the given
+        energy window [left, right].
+
+        Args:
+            energy_interval (Interval2D): the energy window
+
+        Returns:
+            Tuple[int, int]: start, stop such that centers[start:stop] is in the window
+        """
+        start = int(np.searchsorted(
+            self._centers, energy_interval.left, side='left'))
+        stop = int(np.searchsorted(
+            self._centers, energy_interval.right, side='right'))
+        return start, max(start, stop)
+
+    def __len__(self) -> int:
+        return self._n_intervals
+
+    def __str__(self):
+        return f'{self._left:0.2g}:{self._right:0.2g}:{self._n_intervals}'
+
+
+DEFAULT_ENERGY_GRID: Final[EnergyGrid] = EnergyGrid.build(
+    left=HV_LEFT, right=HV_RIGHT, n_intervals=HV_N_INTERVALS)
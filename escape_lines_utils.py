@@ -0,0 +1,199 @@
+"""
+This module computes the effective length and the number of clouds on the escape
+line of every registered photon, and stores them next to the simulation file,
+instead of rewriting the (huge) simulation files with the
+external update_effective_length_6_columns tool.
+
+The escape-line information of the simulation file
+
+    /sim-root-dir/data/thread_01.txt
+
+is stored in the binary file
+
+    /sim-root-dir/data/thread_01.txt.escape.npy
+
+with one record (n_clouds, effective_length) per photon line of the simulation file
+(see is_photon_line()), in the same order, and the effective lengths in the simulation units.
+The photon reader (see SpectraBuilder) joins it by the photon line number.
+
+==================================
+
+Example-01: 'how to compute the escape lines of a simulation'
+
+sim_info = AgnSimulationInfo.build_agn_simulation_info(
+    sim_root_dir="/path/to/sim_root_dir")
+
+tracer = build_clouds_ray_tracer(sim_info) if not sim_info.is_smooth else None
+
+for simulation_file in sim_info.simulation_files:
+    write_escape_lines_sidecar(sim_info=sim_info, simulation_filepath=simulation_file, tracer=tracer)
+
+==================================
+
+Example-02: 'how to read the escape lines of a simulation file'
+
+escape_lines = load_escape_lines(simulation_filepath="/sim-root-dir/data/thread_01.txt")
+
+print(escape_lines['n_clouds'][:10], escape_lines['effective_length'][:10])
+
+==================================
+"""
+from utils import *
+from agn_utils import AgnSimulationInfo, get_escape_lines_sidecar_filepath
+from ray_tracing_utils import CloudsRayTracer, trace_simulation_rays
+from itertools import islice
+from typing import Final
+import os
+
+ESCAPE_LINES_DTYPE: Final[np.dtype] = np.dtype(
+    [('n_clouds', np.int64), ('effective_length', np.float64)])
+"""The record of the escape line of a photon.
+"""
+
+ESCAPE_LINES_CHUNK_SIZE: Final[int] = 200_000
+"""Number of photons processed at once.
+"""
+
+_PHOTON_ESCAPE_COLUMNS: Final[Tuple[int, ...]] = (1, 2, 7, 8, 9)
+"""Columns of theta, phi and the escape position, see _photon_file_line_interpretation().
+"""
+
+
+def escape_directions(theta: np.ndarray, phi: np.ndarray) -> np.ndarray:
+    """Returns the unit vectors of the escape directions of the photons.
+
+    The photon angles follow the convention of the photon reader: phi is the
+    angle seen from the oxy plane (see translate_zenit()), and theta is
+    the polar angle in the oxy plane.
+
+    Args:
+        theta (np.ndarray): polar angles in the oxy plane
+        phi (np.ndarray): angles seen from the oxy plane
+
+    Returns:
+        np.ndarray: (n, 3) unit vectors
+    """
+    cos_phi = np.cos(phi)
+    return np.stack((cos_phi*np.cos(theta), cos_phi*np.sin(theta), np.sin(phi)), axis=1)
+
+
+def is_photon_line(line: str) -> bool:
+    """Returns whether the line of a simulation file is a photon, that is one of
+    the rows np.loadtxt() reads: neither blank nor a comment.
+    """
+    stripped = line.lstrip()
+    return bool(stripped) and not stripped.startswith('#')
+
+
+def _count_photon_lines(filepath: str) -> int:
+    with open(filepath) as file:
+        return sum(1 for line in file if is_photon_line(line))
+
+
+def _read_photon_escape_chunks(simulation_filepath: str, chunk_size: int):
+    with open(simulation_filepath) as file:
+        photon_lines = filter(is_photon_line, file)
+
+        while lines := list(islice(photon_lines, chunk_size)):
+            try:
+                chunk = np.loadtxt(
+                    lines, usecols=_PHOTON_ESCAPE_COLUMNS, ndmin=2)
+            except (ValueError, IndexError) as error:
+                raise ValueError(
+                    f'The simulation file {simulation_filepath} has photons without escape positions!') from error
+
+            if chunk.shape != (len(lines), len(_PHOTON_ESCAPE_COLUMNS)):
+                raise ValueError(
+                    f'The simulation file {simulation_filepath} has photons without escape positions!')
+
+            yield chunk
+
+
+def compute_escape_lines(sim_info: AgnSimulationInfo,
+                         simulation_filepath: str,
+                         out: np.ndarray,
+                         tracer: CloudsRayTracer = None,
+                         chunk_size: int = ESCAPE_LINES_CHUNK_SIZE):
+    """Traces the escape line of every photon of the simulation file, from
+    its escape position along its (theta, phi) direction, chunk by chunk.
+
+    Args:
+        sim_info (AgnSimulationInfo): the simulation info
+        simulation_filepath (str): path to the simulation file (with the escape positions)
+        out (np.ndarray): array of ESCAPE_LINES_DTYPE records, one per photon line of the file
+        tracer (CloudsRayTracer, optional): the tracer of the clouds of the simulation. Defaults to None.
+        chunk_size (int, optional): number of photons processed at once. Defaults to ESCAPE_LINES_CHUNK_SIZE.
+
+    Raises:
+        ValueError: if a photon of the simulation file has no escape position.
+    """
+    start = 0
+    for chunk in _read_photon_escape_chunks(simulation_filepath, chunk_size):
+        stop = start + len(chunk)
+
+        effective_lengths, n_clouds = trace_simulation_rays(sim_info=sim_info,
+                                                            origins=chunk[:, 2:5],
+                                                            directions=escape_directions(
+                                                                chunk[:, 0], chunk[:, 1]),
+                                                            tracer=tracer)
+
+        out['effective_length'][start:stop] = effective_lengths
+        out['n_clouds'][start:stop] = n_clouds
+        start = stop
+
+
+def write_escape_lines_sidecar(sim_info: AgnSimulationInfo,
+                               simulation_filepath: str,
+                               tracer: CloudsRayTracer = None,
+                               chunk_size: int = ESCAPE_LINES_CHUNK_SIZE) -> str:
+    """Computes the escape lines of the photons of the simulation file and
+    writes them (streaming) into its binary sidecar file.
+
+    Args:
+        sim_info (AgnSimulationInfo): the simulation info
+        simulation_filepath (str): path to the simulation file
+        tracer (CloudsRayTracer, optional): the tracer of the clouds of the simulation. Defaults to None.
+        chunk_size (int, optional): number of photons processed at once. Defaults to ESCAPE_LINES_CHUNK_SIZE.
+
+    Returns:
+        str: path to the sidecar file
+    """
+    sidecar_filepath = get_escape_lines_sidecar_filepath(simulation_filepath)
+
+    escape_lines = np.lib.format.open_memmap(sidecar_filepath, mode='w+',
+                                             dtype=ESCAPE_LINES_DTYPE,
+                                             shape=(_count_photon_lines(simulation_filepath),))
+    try:
+        compute_escape_lines(sim_info=sim_info,
+                             simulation_filepath=simulation_filepath,
+                             out=escape_lines,
+                             tracer=tracer,
+                             chunk_size=chunk_size)
+        escape_lines.flush()
+    except BaseException:
+        del escape_lines
+        os.remove(sidecar_filepath)
+        raise
+
+    return sidecar_filepath
+
+
+def has_updated_escape_lines(simulation_filepath: str) -> bool:
+    sidecar_filepath = get_escape_lines_sidecar_filepath(simulation_filepath)
+    return os.path.exists(sidecar_filepath) and os.path.getmtime(sidecar_filepath) >= os.path.getmtime(simulation_filepath)
+
+
+def load_escape_lines(simulation_filepath: str) -> np.ndarray:
+    """Memory-maps the escape lines of the given simulation file.
+
+    Args:
+        simulation_filepath (str): path to the simulation file
+
+    Returns:
+        np.ndarray: read-only ESCAPE_LINES_DTYPE records, one per photon line of the file, or None
+        if there is no sidecar file (or it is older than the simulation file).
+    """
+    if not has_updated_escape_lines(simulation_filepath):
+        return None
+
+    return np.load(get_escape_lines_sidecar_filepath(simulation_filepath), mmap_mode='r')
@@ -0,0 +1,182 @@
+"""
+A minimal FITS writer on top of numpy (no astropy): a primary header and
+binary table extensions, enough for the OGIP table models (see table_model_utils).
+
+The cards and the data are written in 2880-byte blocks, the data big-endian,
+see the FITS standard 4.0.
+
+==================================
+
+Example-01: 'how to write a binary table'
+
+with open('/path/to/file.fits', 'wb') as fits_file:
+    write_fits_header(fits_file, primary_header_cards({'ORIGIN': 'agn'}))
+
+    write_bintable(fits_file, extname='ENERGIES',
+                   columns=[FitsColumn('ENERG_LO', lo, unit='keV'), FitsColumn('ENERG_HI', hi, unit='keV')])
+
+==================================
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterable, List, Tuple
+import numpy as np
+
+FITS_BLOCK_SIZE = 2880
+
+FITS_CARD_SIZE = 80
+
+_FITS_FORMATS = {'f': ('E', '>f4'),
+                 'd': ('D', '>f8'),
+                 'i': ('J', '>i4'),
+                 'k': ('K', '>i8')}
+"""numpy kind (f, i) or explicit code -> (TFORM letter, big-endian dtype)
+"""
+
+
+@dataclass
+class FitsColumn:
+    name: str
+
+    data: np.ndarray
+    """(rows,) or (rows, n) numbers, or (rows,) strings. It can also be an object with
+    len() and slices that returns the rows lazily (for example from a memory-mapped array)
+    """
+
+    unit: str = None
+
+    format: str = None
+    """f (32 bits float), d (64 bits float), i (32 bits int), k (64 bits int), defaults to f or i
+    """
+
+    def get_tform_and_dtype(self) -> Tuple[str, str]:
+        # only the first row is read, the data can be any sequence of rows that supports slices
+        sample = np.asarray(self.data[:1])
+
+        if sample.dtype.kind in 'US':
+            strings = np.asarray(self.data).astype(str)
+            width = max([1] + [len(string) for string in strings])
+            return f'{width}A', f'S{width}'
+
+        letter, dtype = _FITS_FORMATS[self.format or (
+            'i' if sample.dtype.kind in 'iub' else 'f')]
+        repeat = int(np.prod(sample.shape[1:])) if sample.ndim > 1 else 1
+
+        return f'{repeat}{letter}', (f'({repeat},){dtype}' if sample.ndim > 1 else dtype)
+
+
+def _format_value(value) -> str:
+    if isinstance(value, (bool, np.bool_)):
+        return f'{"T" if value else "F":>20}'
+
+    if isinstance(value, (int, np.integer)):
+        return f'{int(value):>20}'
+
+    if isinstance(value, (float, np.floating)):
+        return f'{float(value):>20.10G}'
+
+    text = str(value).replace("'", "''")
+    return f"'{text:<8}'"
+
+
+def fits_card(keyword: str, value=None, comment: str = None) -> str:
+    """Returns the 80 characters card: KEYWORD = value / comment
+    """
+    if len(keyword) > 8:
+        raise ValueError(f'the keyword {keyword} is longer than 8 characters!')
+
+    card = f'{keyword:<8}' if value is None else f'{keyword:<8}= {_format_value(value)}'
+
+    if comment:
+        card += f' / {comment}'
+
+    if len(card) > FITS_CARD_SIZE:
+        raise ValueError(f'the card "{card}" is longer than 80 characters!')
+
+    return f'{card:<{FITS_CARD_SIZE}}'
+
+
+def _write_padded(fits_file: BinaryIO, data: bytes, padding: bytes):
+    fits_file.write(data)
+
+    remainder = len(data) % FITS_BLOCK_SIZE
+    if remainder:
+        fits_file.write(padding*(FITS_BLOCK_SIZE - remainder))
+
+
+def write_fits_header(fits_file: BinaryIO, cards: Iterable[str]):
+    _write_padded(fits_file,
+                  (''.join(cards) + fits_card('END')).encode('ascii'),
+                  padding=b' ')
+
+
+def primary_header_cards(keywords: Dict[str, object] = None) -> List[str]:
+    """The header of a primary HDU without data, with the given extra keywords.
+    """
+    return [fits_card('SIMPLE', True, 'file conforms to FITS standard'),
+            fits_card('BITPIX', 8),
+            fits_card('NAXIS', 0),
+            fits_card('EXTEND', True)] + \
+        [fits_card(keyword, value)
+         for keyword, value in (keywords or {}).items()]
+
+
+def write_bintable(fits_file: BinaryIO, extname: str, columns: List[FitsColumn], keywords: Dict[str, object] = None,
+                   chunk_size: int = 1024):
+    """Writes a binary table extension (header and data) with one row per element of the columns.
+
+    Args:
+        fits_file (BinaryIO): the file, opened in binary mode
+        extname (str): the EXTNAME of the extension
+        columns (List[FitsColumn]): the columns, all with the same number of rows
+        keywords (Dict[str, object], optional): extra header keywords. Defaults to None.
+        chunk_size (int, optional): rows converted to big-endian at once, the columns can be
+            memory-mapped arrays. Defaults to 1024.
+
+    Raises:
+        ValueError: if the columns don't have the same number of rows.
+    """
+    n_rows = len(columns[0].data)
+
+    if any(len(column.data) != n_rows for column in columns):
+        raise ValueError('the columns of a table must have the same number of rows!')
+
+    tforms, dtypes = zip(*[column.get_tform_and_dtype()
+                         for column in columns])
+    row_dtype = np.dtype([(f'c{i}', dtype) for i, dtype in enumerate(dtypes)])
+
+    cards = [fits_card('XTENSION', 'BINTABLE', 'binary table extension'),
+             fits_card('BITPIX', 8),
+             fits_card('NAXIS', 2),
+             fits_card('NAXIS1', row_dtype.itemsize, 'width of a row in bytes'),
+             fits_card('NAXIS2', n_rows, 'number of rows'),
+             fits_card('PCOUNT', 0),
+             fits_card('GCOUNT', 1),
+             fits_card('TFIELDS', len(columns))]
+
+    for i, (column, tform) in enumerate(zip(columns, tforms), start=1):
+        cards.append(fits_card(f'TTYPE{i}', column.name))
+        cards.append(fits_card(f'TFORM{i}', tform))
+        if column.unit:
+            cards.append(fits_card(f'TUNIT{i}', column.unit))
+
+    cards.append(fits_card('EXTNAME', extname))
+    cards += [fits_card(keyword, value)
+              for keyword, value in (keywords or {}).items()]
+
+    write_fits_header(fits_file, cards)
+
+    size = 0
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size, n_rows)
+        rows = np.empty(stop - start, dtype=row_dtype)
+        for i, column in enumerate(columns):
+            data = np.asarray(column.data[start:stop])
+            rows[f'c{i}'] = data.astype(str).astype(
+                dtypes[i]) if dtypes[i].startswith('S') else data.reshape(rows[f'c{i}'].shape)
+        fits_file.write(rows.tobytes())
+        size += rows.nbytes
+
+    remainder = size % FITS_BLOCK_SIZE
+    if remainder:
+        fits_file.write(b'\0'*(FITS_BLOCK_SIZE - remainder))
@@ -0,0 +1,179 @@
+"""
+This module measures the fluorescent lines tagged in the photon files
+(see FLUORESCENT_LINES_LABELS) from a registry: every line has its rest
+energy, the window of the continuum at the line, and the window of its
+compton shoulder. The spectral data of every registered line is written by
+build_spectral_data (see spectral_data_utils.SPECTRUM_COMPONENTS), so a new
+diagnostic only needs an entry in FLUORESCENT_LINES.
+
+For every line (and every key) the engine measures:
+
+    flux:       the flux of the line flux density
+    ew:         flux / (average of the continuum flux density on the continuum window)
+    shoulder:   (flux on the shoulder window) / flux
+
+the FeKalpha values are the ones of measurements.get_ew() and get_fekalpha_compton_shoulder().
+
+==================================
+
+Example-01: 'how to measure all the lines of many keys'
+
+measurements = measure_fluorescent_lines(line_fds={'FeKalpha': [fekalpha_fd_map[key] for key in keys],
+                                                   'NiKalpha': [nikalpha_fd_map[key] for key in keys]},
+                                         continuum_fds=[continuum_fd_map[key] for key in keys])
+
+print(measurements['NiKalpha'].ew.value, measurements['NiKalpha'].ew.err)
+
+==================================
+
+Example-02: 'how to register a line'
+
+FLUORESCENT_LINES['CoKalpha'] = build_fluorescent_line_info(label='CoKalpha', hv=6930)
+
+(the photon files must tag it, see FLUORESCENT_LINES_LABELS)
+
+==================================
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Final, Dict, List
+from flux_density_utils import FluxDensity, window_sums
+from agn_processing_policy import HV_LEFT, HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT, HV_FEKALPHA_SHOULDER_RIGHT
+from utils import EnergyInterval, UncertainArray
+
+FEKALPHA_HV = 6400
+"""FeKalpha rest energy (eV) of the HV_FEKALPHA_* windows
+"""
+
+CONTINUUM_HALF_WIDTH = (HV_CONTINUUM_AT_FEKALPHA_RIGHT -
+                        HV_CONTINUUM_AT_FEKALPHA_LEFT)/(2*FEKALPHA_HV)
+"""half width of the continuum windows, relative to the rest energy (the FeKalpha one)
+"""
+
+SHOULDER_GAP = (FEKALPHA_HV - HV_FEKALPHA_SHOULDER_RIGHT)/FEKALPHA_HV
+"""distance from the rest energy to the end of the shoulder windows, relative to the rest energy (the FeKalpha one)
+"""
+
+
+@dataclass(frozen=True)
+class FluorescentLineInfo:
+    label: str
+    """for example: FeKalpha, see FLUORESCENT_LINES_LABELS
+    """
+
+    hv: float
+    """rest energy (eV)
+    """
+
+    continuum_window: EnergyInterval
+    """where the continuum at the line is averaged
+    """
+
+    shoulder_window: EnergyInterval
+    """the energies of the compton shoulder of the line
+    """
+
+    @property
+    def input_name(self) -> str:
+        """The spectral data input of the line flux density, for example: fekalpha_fd
+        """
+        return f'{self.label.lower()}_fd'
+
+
+def build_fluorescent_line_info(label: str, hv: float) -> FluorescentLineInfo:
+    """Builds the line with the windows of FeKalpha scaled to its rest energy.
+    """
+    return FluorescentLineInfo(label=label,
+                               hv=hv,
+                               continuum_window=EnergyInterval(left=hv*(1-CONTINUUM_HALF_WIDTH),
+                                                               right=hv*(1+CONTINUUM_HALF_WIDTH)),
+                               shoulder_window=EnergyInterval(left=HV_LEFT, right=hv*(1-SHOULDER_GAP)))
+
+
+FLUORESCENT_LINES: Final[Dict[str, FluorescentLineInfo]] = {
+    **{label: build_fluorescent_line_info(label=label, hv=hv)
+       for label, hv in (('CKalpha', 277),
+                         ('NKalpha', 392),
+                         ('OKalpha', 525),
+                         ('NeKalpha', 849),
+                         ('NaKalpha', 1041),
+                         ('MgKalpha', 1254),
+                         ('AlKalpha', 1487),
+                         ('SiKalpha', 1740),
+                         ('SKalpha', 2308),
+                         ('ArKalpha', 2957),
+                         ('CaKalpha', 3691),
+                         ('CrKalpha', 5415))},
+    'FeKalpha': FluorescentLineInfo(label='FeKalpha',
+                                    hv=FEKALPHA_HV,
+                                    continuum_window=EnergyInterval(
+                                        HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT),
+                                    shoulder_window=EnergyInterval(left=HV_LEFT, right=HV_FEKALPHA_SHOULDER_RIGHT)),
+    'NiKalpha': build_fluorescent_line_info(label='NiKalpha', hv=7478),
+}
+"""The registered lines, by the labels of FLUORESCENT_LINES_LABELS
+"""
+
+
+@dataclass
+class FluorescentLineMeasurements:
+    """The measurements of a line, one element per key.
+    """
+
+    line: FluorescentLineInfo
+    flux: UncertainArray
+    ew: UncertainArray
+    shoulder: UncertainArray
+
+
+def measure_fluorescent_lines(line_fds: Dict[str, List[FluxDensity]], continuum_fds: List[FluxDensity],
+                              lines: Dict[str, FluorescentLineInfo] = FLUORESCENT_LINES) -> Dict[str, FluorescentLineMeasurements]:
+    """Measures the flux, ew and shoulder of the given lines of many keys at once: the continuum
+    windows of all the lines are one product per continuum flux density, and the flux and
+    shoulder windows one product per line flux density (see window_sums()).
+
+    Args:
+        line_fds (Dict[str, List[FluxDensity]]): line label -> flux densities of the line, one per key
+        continuum_fds (List[FluxDensity]): the continuum flux densities, one per key
+        lines (Dict[str, FluorescentLineInfo], optional): the registry. Defaults to FLUORESCENT_LINES.
+
+    Raises:
+        ValueError: if a line is not registered, or the flux densities are not on the same energy bins.
+
+    Returns:
+        Dict[str, FluorescentLineMeasurements]: line label -> measurements
+    """
+    unknown = [label for label in line_fds if label not in lines]
+    if unknown:
+        raise ValueError(f'the lines {unknown} are not registered!')
+
+    first = continuum_fds[0]
+
+    if not all(first.same_grid(fd) for fds in [continuum_fds, *line_fds.values()] for fd in fds):
+        raise ValueError(
+            'the flux densities must be on the same energy bins to be measured at once')
+
+    labels = list(line_fds)
+
+    continuum_weights = [first.average_weights(
+        lines[label].continuum_window) for label in labels]
+    continuum_at_lines = window_sums(continuum_fds,
+                                     weights=continuum_weights,
+                                     err_weights=continuum_weights)
+
+    measurements: Dict[str, FluorescentLineMeasurements] = {}
+    for label, continuum_at_line in zip(labels, continuum_at_lines):
+        line = lines[label]
+
+        flux, shoulder_flux = window_sums(line_fds[label],
+                                          weights=[first.area_weights(),
+                                                   first.area_weights(line.shoulder_window)],
+                                          err_weights=[first.flux_err_weights(),
+                                                       first.flux_err_weights(line.shoulder_window)])
+
+        measurements[label] = FluorescentLineMeasurements(line=line,
+                                                          flux=flux,
+                                                          ew=flux/continuum_at_line,
+                                                          shoulder=shoulder_flux/flux)
+
+    return measurements
@@ -1,5 +1,8 @@
+from __future__ import annotations
 from spectrum_utils import *
-from typing import Final, List, Dict, Iterable, Set
+from energy_grid_utils import EnergyGrid
+from typing import Final, List, Dict, Iterable, Set, Sequence
+from collections import OrderedDict
 from colum_density_utils import ColumnDensityDistribution
 from agn_utils import agn_solid_angle
 
@@ -40,22 +43,15 @@ def build_log10_energy_widths(energy_interval: EnergyInterval, n_intervals: int)
         np.ndarray: List of energy interval widths
     """
 
-    hv_left, hv_right = energy_interval.left, energy_interval.right
-
-    d_nh_expo = (np.log10(hv_right)-np.log10(hv_left))/n_intervals
-    hv_list = []
-
-    for i in range(n_intervals):
-        hv_list += [hv_left*(10**(d_nh_expo*(i+1)) - 10**(d_nh_expo*i))]
-
-    return np.array(hv_list)
+    return EnergyGrid.build(left=energy_interval.left,
+                            right=energy_interval.right,
+                            n_intervals=n_intervals).widths
 
 
 def get_normalization_factor(norm_params: NormalizationFluxDensityParameters, norm_spectrum: SpectrumCount, energy_widths: np.ndarray):
-    index = get_interval_index_log(
-        value=norm_params.energy_norm_value,
-        value_interval=norm_params.energy_interval,
-        num_of_intervals=len(norm_spectrum))
+    index = EnergyGrid.build(left=norm_params.energy_interval.left,
+                             right=norm_params.energy_interval.right,
+                             n_intervals=len(norm_spectrum)).index(norm_params.energy_norm_value)
 
     norm_energy_width = energy_widths[index]
     norm_spectrum_count = norm_spectrum[index].y
@@ -87,9 +83,11 @@ def agn_solid_angle(alpha: AngularInterval) -> float:
 class FluxDensity(SpectrumBase):
     def __init__(self, x: Iterable[float],
                  y: Iterable[float],
-                 y_err: Iterable[float]) -> None:
+                 y_err: Iterable[float],
+                 grid: EnergyGrid = None,
+                 grid_offset: int = 0) -> None:
 
-        super().__init__(x, y, y_err)
+        super().__init__(x, y, y_err, grid=grid, grid_offset=grid_offset)
 
     def _flux_std(self):
         energy_interval = EnergyInterval(*self.x_interval())
@@ -99,13 +97,231 @@ class FluxDensity(SpectrumBase):
 
         return np.sqrt(np.sum((self.y_err*energy_widths)**2))
 
-    def flux(self):
-        return ValueAndError(value=self.algebraic_area(),
-                             err=self._flux_std())
+    def _window_flux_err_weights(self, start: int, stop: int) -> np.ndarray:
+        """The energy widths of the _flux_std() of the portion x[start:stop], that is
+        a logarithmic grid between its first and last energies. They aren't interned
+        grids (see build_log10_energy_widths()), as there are as many as windows.
+        """
+        if stop - start < 1:
+            return np.zeros(0)
+
+        left, right, n_intervals = self.x[start], self.x[stop-1], stop - start
+
+        powers = 10**((np.log10(right)-np.log10(left))/n_intervals*np.arange(n_intervals+1))
+
+        return left*(powers[1:]-powers[:-1])
+
+    def window_flux_err(self, start: int, stop: int) -> float:
+        """Returns the error of the flux of the portion x[start:stop], the same
+        as the one of the flux() of get_cpy_on_interval().
+        """
+        return np.sqrt(np.sum((self.y_err[start:stop]*self._window_flux_err_weights(start, stop))**2))
+
+    def flux(self, energy_interval: EnergyInterval = None) -> ValueAndError:
+        """Returns the flux (the area of the flux density) and its error.
+
+        On a grid, the flux on an interval is answered from the cumulative sums
+        of the flux density, without slicing it. Its error weights the errors
+        by the widths of a logarithmic grid on the window, as the flux of the
+        sliced flux density does (not by the widths of the energy grid).
+
+        Args:
+            energy_interval (EnergyInterval, optional): the interval. Defaults to the whole flux density.
+
+        Returns:
+            ValueAndError: the flux
+        """
+        if energy_interval is None:
+            return ValueAndError(value=self.algebraic_area(),
+                                 err=self._flux_std())
+
+        if self.grid is None:
+            return self.get_cpy_on_interval(energy_interval).flux()
+
+        start, stop = self.window(energy_interval)
+        prefix_sums = self.prefix_sums()
+
+        return ValueAndError(value=prefix_sums.get_area(start, stop),
+                             err=self.window_flux_err(start, stop))
+
+    def flux_err_weights(self, energy_interval: EnergyInterval = None) -> np.ndarray:
+        """Returns the weights w such that sqrt(y_err**2 @ w**2) is the error of
+        the flux on the given interval (see flux()), the flux itself is area_weights() @ y.
+
+        Raises:
+            ValueError: if there is an interval and the flux density is not on a grid.
+        """
+        if self.grid is None:
+            if energy_interval is not None:
+                raise ValueError(
+                    'the flux error weights of a window need the flux density to be on a grid!')
+
+            return build_log10_energy_widths(energy_interval=EnergyInterval(*self.x_interval()),
+                                             n_intervals=len(self.x))
+
+        start, stop = self._weights_window(energy_interval)
+
+        weights = np.zeros(len(self))
+        weights[start:stop] = self._window_flux_err_weights(start, stop)
+
+        return weights
+
+
+_NORMALIZATION_CONTEXT_CACHE_SIZE = 8
+"""How many normalization contexts are kept alive by FluxDensityNormalizationContext.build()
+"""
+
+_normalization_context_cache: OrderedDict = OrderedDict()
+
+
+@dataclass
+class FluxDensityNormalizationContext:
+    """This class holds everything that is needed to normalize
+    spectrum counts into flux densities, for a given
+    (source spectrum, angle interval, normalization params).
+
+    The energy widths, the normalization factor and the solid angle
+    are computed once, so the context can be reused for every
+    spectrum that is normalized by the same source spectrum.
+
+    Don't modify the norm spectrum after the context was built,
+    otherwise the cached normalization factor will be stale.
+
+    ==============================
+
+    example:
+
+    context = FluxDensityNormalizationContext.build(norm_spectrum=source_spectrum,
+                                                    angle_interval=AngularInterval(60, 15).from_deg_to_rad())
+
+    print(context.norm_factor)
+
+    ==============================
+    """
+
+    norm_spectrum: SpectrumCount
+    """the normalization spectrum, which normally it is the source spectrum
+    """
+
+    angle_interval: AngularInterval
+    """angle interval (in radians) at which the spectral components were taken
+    """
+
+    norm_params: NormalizationFluxDensityParameters
+
+    grid: EnergyGrid
+    """energy grid of the norm spectrum
+    """
+
+    energy_widths: np.ndarray
+    """widths of the energy bins of the norm spectrum
+    """
+
+    norm_factor: float
+
+    solid_angle: float
+    """solid angle corresponding to the angle interval
+    """
+
+    @staticmethod
+    def build(norm_spectrum: SpectrumCount,
+              angle_interval: AngularInterval,
+              norm_params: NormalizationFluxDensityParameters = NORMALIZATION_SIMULATION_PARAMS) -> FluxDensityNormalizationContext:
+        """This factory method returns the normalization context for the given parameters.
+
+        The last contexts are cached, so calling this method several times
+        with the same parameters doesn't repeat the calculations.
+
+        Args:
+            norm_spectrum (SpectrumCount): This is the normalization spectrum, which normally it is the source spectrum.
+            angle_interval (AngularInterval): Angle interval at which the spectral components were taken
+            norm_params (NormalizationFluxDensityParameters): Normalization parameters. Typically these should be global (use the default value).
+
+        Returns:
+            FluxDensityNormalizationContext: the normalization context
+        """
+
+        key = (id(norm_spectrum),
+               angle_interval.beg, angle_interval.length,
+               norm_params.energy_norm_value,
+               norm_params.energy_interval.left, norm_params.energy_interval.right,
+               norm_params.solid_angle)
+
+        # the cached context keeps the norm spectrum alive, thus its id cannot be reused
+        if key in _normalization_context_cache:
+            _normalization_context_cache.move_to_end(key)
+            return _normalization_context_cache[key]
+
+        grid = EnergyGrid.build(left=norm_params.energy_interval.left,
+                                right=norm_params.energy_interval.right,
+                                n_intervals=len(norm_spectrum))
+        energy_widths = grid.widths
+
+        context = FluxDensityNormalizationContext(norm_spectrum=norm_spectrum,
+                                                  angle_interval=angle_interval,
+                                                  norm_params=norm_params,
+                                                  grid=grid,
+                                                  energy_widths=energy_widths,
+                                                  norm_factor=get_normalization_factor(
+                                                      norm_params, norm_spectrum, energy_widths),
+                                                  solid_angle=agn_solid_angle(angle_interval))
+
+        _normalization_context_cache[key] = context
+        if len(_normalization_context_cache) > _NORMALIZATION_CONTEXT_CACHE_SIZE:
+            _normalization_context_cache.popitem(last=False)
+
+        return context
 
 
 class FluxDensityBuilder:
 
+    @staticmethod
+    def build_flux_densities_for_given_nhs(spectra_counts: Sequence[SpectrumCount],
+                                           nhs: Sequence[float],
+                                           nh_distribution: ColumnDensityDistribution,
+                                           context: FluxDensityNormalizationContext) -> List[FluxDensity]:
+        """Builds the flux densities of a whole stack of spectrum counts at once.
+
+                DONT USE THIS METHOD TO CREATE THE NORMALIZATION FLUX DENSITY!
+                The normalization of the Normalization-Flux-Density is different.
+
+        Args:
+            spectra_counts (Sequence[SpectrumCount]): Spectrum counts on the same energy grid as the norm spectrum of the context.
+            nhs (Sequence[float]): The column density of each spectrum count.
+            nh_distribution (ColumnDensityDistribution): The column density distribution of the corresponding simulations.
+            context (FluxDensityNormalizationContext): The normalization context, see FluxDensityNormalizationContext.build().
+
+        Raises:
+            ValueError: if the spectra are not on the energy grid of the context.
+
+        Returns:
+            List[FluxDensity]: The normalized flux densities, in the same order as the given spectrum counts.
+        """
+
+        if len(spectra_counts) == 0:
+            return []
+
+        for spectrum_count in spectra_counts:
+            if not FluxDensityBuilder.is_on_context_grid(spectrum_count, context):
+                raise ValueError(
+                    'The spectrum counts must be on the energy grid of the normalization spectrum!')
+
+        x = context.grid.centers
+        counts = np.stack([spectrum_count.y for spectrum_count in spectra_counts])
+        counts_err = np.stack(
+            [spectrum_count.y_err for spectrum_count in spectra_counts])
+
+        true_solid_angles = np.array([nh_distribution.get_distribution_value_for_nh(
+            nh=nh) for nh in nhs]) * context.solid_angle
+
+        factors = (x*context.norm_factor/context.energy_widths)[np.newaxis, :] / \
+            true_solid_angles[:, np.newaxis]
+
+        flux_densities = counts*factors
+        flux_densities_err = counts_err*factors
+
+        return [FluxDensity(None, flux_densities[i], flux_densities_err[i], grid=context.grid) for i in range(len(spectra_counts))]
+
     @staticmethod
     def build_flux_density_for_given_nh(spectrum_count: SpectrumCount,
                                         norm_spectrum: SpectrumCount,
@@ -128,21 +344,14 @@ class FluxDensityBuilder:
             FluxDensity: The normalized flux density.
         """
 
-        energy_widths = build_log10_energy_widths(energy_interval=norm_params.energy_interval,
-                                                  n_intervals=len(norm_spectrum))
+        context = FluxDensityNormalizationContext.build(norm_spectrum=norm_spectrum,
+                                                        angle_interval=angle_interval,
+                                                        norm_params=norm_params)
 
-        norm_factor = get_normalization_factor(
-            norm_params, norm_spectrum, energy_widths)
-
-        solid_angle_ = FluxDensityBuilder._get_solid_angle(angle_interval)
-
-        true_solid_angle = nh_distribution.get_distribution_value_for_nh(
-            nh=nh) * solid_angle_
-
-        return FluxDensity(spectrum_count.x,
-                           spectrum_count.x*spectrum_count.y*norm_factor /
-                           true_solid_angle/energy_widths,
-                           spectrum_count.x*spectrum_count.y_err*norm_factor/true_solid_angle/energy_widths)
+        return FluxDensityBuilder.build_flux_densities_for_given_nhs(spectra_counts=[spectrum_count],
+                                                                     nhs=[nh],
+                                                                     nh_distribution=nh_distribution,
+                                                                     context=context)[0]
 
     @staticmethod
     def build_norm_flux_density(
@@ -160,20 +369,27 @@ class FluxDensityBuilder:
             _type_: _description_
         """
 
-        energy_widths = build_log10_energy_widths(energy_interval=norm_params.energy_interval,
-                                                  n_intervals=len(norm_spectrum))
+        context = FluxDensityNormalizationContext.build(norm_spectrum=norm_spectrum,
+                                                        angle_interval=angle_interval,
+                                                        norm_params=norm_params)
 
-        norm_factor = get_normalization_factor(
-            norm_params, norm_spectrum, energy_widths)
+        factor = context.grid.centers*context.norm_factor / \
+            context.solid_angle/context.energy_widths
 
-        solid_angle_ = FluxDensityBuilder._get_solid_angle(angle_interval)
+        return FluxDensity(None,
+                           norm_spectrum.y*factor,
+                           norm_spectrum.y_err*factor,
+                           grid=context.grid)
 
-        true_solid_angle = solid_angle_
+    @staticmethod
+    def is_on_context_grid(spectrum_count: SpectrumCount, context: FluxDensityNormalizationContext) -> bool:
+        """Whether the spectrum count can be normalized with the context, see build_flux_densities_for_given_nhs().
+        """
+        if spectrum_count.grid is not None:
+            return spectrum_count.grid is context.grid and spectrum_count.grid_offset == 0
 
-        return FluxDensity(norm_spectrum.x,
-                           norm_spectrum.x*norm_spectrum.y*norm_factor /
-                           true_solid_angle/energy_widths,
-                           norm_spectrum.x*norm_spectrum.y_err*norm_factor/true_solid_angle/energy_widths)
+        # spectra without grid are assumed to be on the grid if they have the same number of bins
+        return len(spectrum_count) == len(context.grid)
 
     @staticmethod
     def _get_solid_angle(angle_interval: float):
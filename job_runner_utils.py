@@ -0,0 +1,198 @@
+"""
+This module runs the external (single threaded) binaries of the project, like
+create_nh_distribution or create_source, concurrently with asyncio subprocesses.
+
+Every job is retried when it fails, the failures don't stop the other jobs,
+and the output and the timing of every job are kept for the summary.
+
+==================================
+
+Example: 'how to run several external jobs'
+
+jobs = [Job(label=f'source {n}', args=[create_source, str(n), f'/path/to/source_{n}.txt'])
+        for n in (1e6, 1e7, 1e8)]
+
+results = run_jobs(jobs, max_concurrency=8, max_retries=2)
+
+print_jobs_summary(results)
+
+==================================
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Callable, List, Final
+import asyncio
+import time
+import os
+
+DEFAULT_JOB_RETRIES: Final[int] = 1
+"""How many times a failed job is run again.
+"""
+
+
+@dataclass
+class Job:
+    """
+    This class represents a run of an external binary.
+    """
+
+    label: str
+    """a short name of the job for the logs
+    """
+
+    args: List[str]
+    """the binary and its arguments
+    """
+
+    on_success: Callable[[], None] = None
+    """optional callback, called after the job succeeds
+    """
+
+
+@dataclass
+class JobResult:
+    """
+    This class represents the outcome of a job (of its last attempt).
+    """
+
+    job: Job
+
+    returncode: int
+    """the exit code of the binary, None if the binary could not be started
+    """
+
+    stdout: str = ''
+
+    stderr: str = ''
+
+    elapsed: float = 0.0
+    """the time in seconds of all the attempts
+    """
+
+    attempts: int = 0
+
+    error: str = ''
+    """the error raised by the runner itself (binary not found, timeout, failed callback)
+    """
+
+    @property
+    def succeeded(self) -> bool:
+        return self.returncode == 0 and not self.error
+
+
+async def _run_job_once(job: Job, timeout: float = None) -> JobResult:
+    try:
+        process = await asyncio.create_subprocess_exec(*job.args,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        return JobResult(job=job, returncode=None, error=str(e))
+
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return JobResult(job=job, returncode=process.returncode, error=f'timeout after {timeout} s')
+
+    return JobResult(job=job,
+                     returncode=process.returncode,
+                     stdout=stdout.decode(errors='replace'),
+                     stderr=stderr.decode(errors='replace'))
+
+
+async def _run_job(job: Job, semaphore: asyncio.Semaphore, max_retries: int, timeout: float = None, verbose: bool = True) -> JobResult:
+    async with semaphore:
+        start = time.perf_counter()
+
+        for attempt in range(1, max_retries + 2):
+            result = await _run_job_once(job, timeout=timeout)
+            result.attempts = attempt
+
+            if result.succeeded and job.on_success is not None:
+                try:
+                    job.on_success()
+                except Exception as e:
+                    result.error = f'on_success: {e!r}'
+
+            if result.succeeded:
+                break
+
+            if verbose:
+                print(
+                    f'job {job.label} failed (attempt {attempt}): {result.returncode} {result.error}')
+
+        result.elapsed = time.perf_counter() - start
+
+        if verbose and result.succeeded:
+            print(f'job {job.label} done in {result.elapsed:0.1f} s')
+
+        return result
+
+
+async def run_jobs_async(jobs: List[Job],
+                         max_concurrency: int = None,
+                         max_retries: int = DEFAULT_JOB_RETRIES,
+                         timeout: float = None,
+                         verbose: bool = True) -> List[JobResult]:
+    """Runs the jobs concurrently, see run_jobs().
+    """
+    semaphore = asyncio.Semaphore(
+        max_concurrency if max_concurrency else os.cpu_count())
+
+    return list(await asyncio.gather(*[_run_job(job, semaphore, max_retries=max_retries, timeout=timeout, verbose=verbose)
+                                       for job in jobs]))
+
+
+def run_jobs(jobs: List[Job],
+             max_concurrency: int = None,
+             max_retries: int = DEFAULT_JOB_RETRIES,
+             timeout: float = None,
+             verbose: bool = True) -> List[JobResult]:
+    """Runs the jobs with at most max_concurrency of them at the same time.
+
+    A failed job is run again up to max_retries times, and it never
+    stops the other jobs.
+
+    Args:
+        jobs (List[Job]): the jobs
+        max_concurrency (int, optional): number of jobs running at the same time. Defaults to os.cpu_count().
+        max_retries (int, optional): number of retries of a failed job. Defaults to DEFAULT_JOB_RETRIES.
+        timeout (float, optional): time limit in seconds of every attempt. Defaults to None.
+        verbose (bool, optional): print the progress. Defaults to True.
+
+    Returns:
+        List[JobResult]: the results, in the order of the jobs
+    """
+    return asyncio.run(run_jobs_async(jobs,
+                                      max_concurrency=max_concurrency,
+                                      max_retries=max_retries,
+                                      timeout=timeout,
+                                      verbose=verbose))
+
+
+def print_jobs_summary(results: List[JobResult]):
+    """Prints the timing of every job and the output of the failed ones.
+
+    Args:
+        results (List[JobResult]): the results of run_jobs()
+    """
+    failed = [result for result in results if not result.succeeded]
+
+    print('=====================================')
+    print(f'jobs: {len(results)}, succeeded: {len(results) - len(failed)}, failed: {len(failed)}, '
+          f'total time: {sum(result.elapsed for result in results):0.1f} s')
+
+    for result in results:
+        print(f'{"OK" if result.succeeded else "FAILED":>6} {result.elapsed:>9.1f} s {result.attempts:>2} attempt(s)  {result.job.label}')
+
+    for result in failed:
+        print('-------------------------------------')
+        print(f'{result.job.label}: exit code {result.returncode} {result.error}')
+        print(f'command: {" ".join(result.job.args)}')
+        if result.stdout:
+            print(f'stdout:\n{result.stdout}')
+        if result.stderr:
+            print(f'stderr:\n{result.stderr}')
+
+    print('=====================================')
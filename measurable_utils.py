@@ -1,68 +1,154 @@
 from __future__ import annotations
-from measurements import parse_measurement, ValueAndError, Measurement
-from typing import Tuple, Dict, List
+from measurements import parse_measurement_row, ValueAndError, Measurement
+from measurement_table_utils import load_measurements_table, get_measurement_label, MEASUREMENT_KEY_FIELDS
+from agn_simulation_policy import AGN_VIEWING_DIRECTIONS_DEG
+from dataclasses import dataclass, field
+from typing import Tuple, Dict, List, Union, Iterator
 import numpy as np
 from agn_utils import AngularInterval
+from utils import UncertainArray
 
 
-def get_edge_vs_h(measurements_filepath: str, nh_index: int, a_fe: str = None) -> Tuple[np.ndarray]:
-    """Returns the edge vs h data to be plotted.
+@dataclass
+class MeasurementTable:
+    """
+    The measurements of a file loaded once into column arrays (see measurement_table_utils),
+    with secondary indexes on the key fields and vectorized filters.
 
     For example:
 
-        g = ColumnDensityGrid(LEFT_NH, RIGHT_NH, NH_INTERVALS)
+        table = MeasurementTable.build_measurement_table(
+            measurements_filepath="/path/to/measurements/file")
 
-        h, h_err, edge, edge_err = get_edge_vs_h(
-            measurements_filepath="/path/to/measurements/file", nh_index=g.index(5e23))
+        selected = table.select(table.relative_edge_error() <= 0.2, nh_aver='24', nh_index=[27, 30])
 
+        print(selected['h'], 1-selected['edge'])
 
-        print(h)
-        print(h_err)
-        print(1-edge)
-        print(edge_err)
-
+        for measurement in selected:
+            print(measurement.key, measurement.value)
+    """
 
-    Args:
-        measurements_filepath (str): the path to the measurements file
-        nh_index (int): index on the given-and-corresponding nh_grid
+    table: np.ndarray
+    """the rows, see MEASUREMENTS_DTYPE
+    """
 
-    Returns:
-        Tuple[np.ndarray]: h, h_err, edge, edge_err
+    indexes: Dict[str, Dict[object, np.ndarray]] = field(
+        default_factory=dict, repr=False)
+    """the secondary indexes: field -> value -> rows, built on first use
     """
 
-    h = []
-    h_err = []
-    edge = []
-    edge_err = []
-    with open(measurements_filepath) as measurements_file:
-        for line in measurements_file:
-            key, value = parse_measurement(measurement_line=line)
+    @staticmethod
+    def build_measurement_table(measurements_filepath: str) -> MeasurementTable:
+        return MeasurementTable(table=load_measurements_table(measurements_filepath, mmap=False))
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __getitem__(self, field_name: str) -> np.ndarray:
+        return self.table[field_name]
+
+    def __iter__(self) -> Iterator[Measurement]:
+        for row in self.table:
+            key, value = parse_measurement_row(row)
+            yield Measurement(key=key, value=value)
+
+    def labels(self) -> List[str]:
+        return [get_measurement_label(row) for row in self.table]
+
+    def index(self, field_name: str) -> Dict[object, np.ndarray]:
+        """Returns the secondary index of the given key field: the rows (in
+        the order of the table) of every value of the field.
+        """
+        if field_name not in MEASUREMENT_KEY_FIELDS:
+            raise ValueError(f'{field_name} is not a key field!')
+
+        if field_name not in self.indexes:
+            values, inverse = np.unique(
+                self.table[field_name], return_inverse=True)
+            order = np.argsort(inverse, kind='stable')
+            boundaries = np.cumsum(np.bincount(inverse, minlength=len(values)))
+            self.indexes[field_name] = {value.item(): rows for value, rows in zip(
+                values, np.split(order, boundaries[:-1]))}
+
+        return self.indexes[field_name]
+
+    def rows(self, field_name: str, value) -> np.ndarray:
+        """Returns the rows where the field has the given value (or one of the given values).
+        """
+        if field_name == 'alpha':
+            value = _alpha_codes(value)
+
+        index = self.index(field_name)
+        empty = np.empty(0, dtype=np.intp)
+
+        if isinstance(value, (list, tuple, set, np.ndarray)):
+            return np.sort(np.concatenate([index.get(v, empty) for v in value] + [empty]))
+
+        return index.get(value, empty)
+
+    def mask(self, **criteria) -> np.ndarray:
+        """Returns the mask of the rows matching all the given criteria, for example
+        mask(nh_index=27, a_fe=['1xfe', '2xfe'], alpha=AngularInterval(75, 15)).
+        """
+        mask = np.ones(len(self.table), dtype=bool)
+
+        for field_name, value in criteria.items():
+            matching = np.zeros(len(self.table), dtype=bool)
+            matching[self.rows(field_name, value)] = True
+            mask &= matching
+
+        return mask
+
+    def select(self, mask: np.ndarray = None, **criteria) -> MeasurementTable:
+        """Returns the rows matching the mask (of this table) and all the given criteria, see mask().
+        """
+        selected = self.mask(**criteria)
+
+        if mask is not None:
+            selected &= mask
+
+        return MeasurementTable(table=self.table[selected])
+
+    def relative_error(self, field_name: str) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.table[f'{field_name}_err']/self.table[field_name]
 
-            if a_fe != None:
-                if key.nh_index == nh_index and key.a_fe == a_fe:
+    def relative_edge_error(self) -> np.ndarray:
+        """Returns edge.err/(1-edge), the relative error of the absorbed fraction.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.table['edge_err']/(1-self.table['edge'])
 
-                    if value.edge.err/(1-value.edge.value) > 0.1:
-                        continue
+    def uncertain(self, field_name: str) -> UncertainArray:
+        """Returns the column and its errors, for example
+        (table.uncertain('h')/table.uncertain('ew')).log10().
+        """
+        return UncertainArray(value=self.table[field_name], err=self.table[f'{field_name}_err'])
 
-                    if 0.80865 <= 1-value.edge.value <= 0.8087:
-                        print(key)
+    def values_and_errors(self, field_name: str) -> List[ValueAndError]:
+        return self.uncertain(field_name).to_values_and_errors()
 
-                    h += [value.h.value]
-                    h_err += [value.h.err]
-                    edge += [value.edge.value]
-                    edge_err += [value.edge.err]
-            else:
-                if key.nh_index == nh_index:
 
-                    h += [value.h.value]
-                    h_err += [value.h.err]
-                    edge += [value.edge.value]
-                    edge_err += [value.edge.err]
+def _alpha_codes(alpha):
+    if isinstance(alpha, AngularInterval):
+        return [code for code, interval in AGN_VIEWING_DIRECTIONS_DEG.items() if interval == alpha]
 
-    return np.array(h), np.array(h_err), np.array(edge), np.array(edge_err)
+    if isinstance(alpha, (list, tuple, set)):
+        return [code for a in alpha for code in _alpha_codes(a)]
 
+    return alpha
 
-def get_edge_vs_h_by_nh_aver(measurements_filepath: str, nh_index: int, nh_aver: str = None) -> Tuple[np.ndarray]:
+
+def as_measurement_table(measurements: Union[str, MeasurementTable]) -> MeasurementTable:
+    """Loads the measurements file, or returns the already loaded table.
+    """
+    if isinstance(measurements, MeasurementTable):
+        return measurements
+
+    return MeasurementTable.build_measurement_table(measurements)
+
+
+def get_edge_vs_h(measurements_filepath: Union[str, MeasurementTable], nh_index: int, a_fe: str = None) -> Tuple[np.ndarray]:
     """Returns the edge vs h data to be plotted.
 
     For example:
@@ -80,129 +166,124 @@ def get_edge_vs_h_by_nh_aver(measurements_filepath: str, nh_index: int, nh_aver:
 
 
     Args:
-        measurements_filepath (str): the path to the measurements file
+        measurements_filepath (Union[str, MeasurementTable]): the path to the measurements file, or the loaded table
         nh_index (int): index on the given-and-corresponding nh_grid
 
     Returns:
         Tuple[np.ndarray]: h, h_err, edge, edge_err
     """
+    table = as_measurement_table(measurements_filepath)
 
-    h = []
-    h_err = []
-    edge = []
-    edge_err = []
-    with open(measurements_filepath) as measurements_file:
-        for line in measurements_file:
-            key, value = parse_measurement(measurement_line=line)
+    if a_fe != None:
+        table = table.select(nh_index=nh_index, a_fe=a_fe)
+        table = table.select(~(table.relative_edge_error() > 0.1))
 
-            if key.nh_aver != nh_aver:
-                continue
+        for label in np.array(table.labels())[(0.80865 <= 1-table['edge']) & (1-table['edge'] <= 0.8087)]:
+            print(label)
+    else:
+        table = table.select(nh_index=nh_index)
 
-            if value.edge.err/(1-value.edge.value) > 0.2:
-                continue
+    return table['h'].copy(), table['h_err'].copy(), table['edge'].copy(), table['edge_err'].copy()
 
-            if key.nh_index == nh_index:
 
-                h += [value.h.value]
-                h_err += [value.h.err]
-                edge += [value.edge.value]
-                edge_err += [value.edge.err]
-
-    return np.array(h), np.array(h_err), np.array(edge), np.array(edge_err)
-
-
-def get_shoulder_vs_nhaver(measurements_filepath: str) -> Dict[Tuple[str, str, bool, int], List[ValueAndError]]:
-    data: Dict[Tuple[str, str, bool, int], List[ValueAndError]] = {}
+def get_edge_vs_h_by_nh_aver(measurements_filepath: Union[str, MeasurementTable], nh_index: int, nh_aver: str = None) -> Tuple[np.ndarray]:
+    """Returns the edge vs h data to be plotted.
 
-    with open(measurements_filepath) as measurements_file:
-        for line in measurements_file:
-            key, value = parse_measurement(measurement_line=line)
+    For example:
 
-            is_alpha_75 = False
+        g = ColumnDensityGrid(LEFT_NH, RIGHT_NH, NH_INTERVALS)
 
-            if key.alpha == AngularInterval(75, 15):
-                is_alpha_75 = True
+        h, h_err, edge, edge_err = get_edge_vs_h(
+            measurements_filepath="/path/to/measurements/file", nh_index=g.index(5e23))
 
-            if (key.nh_aver, key.a_fe, is_alpha_75, key.n_aver) not in data:
-                data[key.nh_aver, key.a_fe, is_alpha_75, key.n_aver] = []
 
-            data[key.nh_aver, key.a_fe, is_alpha_75,
-                 key.n_aver] += [value.shoulder]
+        print(h)
+        print(h_err)
+        print(1-edge)
+        print(edge_err)
 
-    return data
 
+    Args:
+        measurements_filepath (Union[str, MeasurementTable]): the path to the measurements file, or the loaded table
+        nh_index (int): index on the given-and-corresponding nh_grid
 
-def get_ew_vs_n_aver(measurements_filepath: str, nh_index: int, a_fe: str):
+    Returns:
+        Tuple[np.ndarray]: h, h_err, edge, edge_err
+    """
+    table = as_measurement_table(measurements_filepath)
+    table = table.select(nh_aver=nh_aver, nh_index=nh_index)
+    table = table.select(~(table.relative_edge_error() > 0.2))
 
-    data: Dict[int, List[ValueAndError]] = {}
+    return table['h'].copy(), table['h_err'].copy(), table['edge'].copy(), table['edge_err'].copy()
 
-    with open(measurements_filepath) as measurements_file:
-        for line in measurements_file:
-            key, value = parse_measurement(measurement_line=line)
 
-            if key.nh_index != nh_index or key.a_fe != a_fe:
-                continue
+def get_shoulder_vs_nhaver(measurements_filepath: Union[str, MeasurementTable]) -> Dict[Tuple[str, str, bool, int], List[ValueAndError]]:
+    data: Dict[Tuple[str, str, bool, int], List[ValueAndError]] = {}
 
-            if key.n_aver not in data:
-                data[key.n_aver] = []
+    table = as_measurement_table(measurements_filepath)
+    is_alpha_75 = table.mask(alpha=AngularInterval(75, 15))
+    shoulders = table.values_and_errors('shoulder')
 
-            data[key.n_aver] += [value.ew]
-            print(f'the data: {data}')
+    for row, (nh_aver, a_fe, n_aver) in enumerate(zip(table['nh_aver'].tolist(), table['a_fe'].tolist(), table['n_aver'].tolist())):
+        data.setdefault((nh_aver, a_fe, bool(is_alpha_75[row]), n_aver), []).append(
+            shoulders[row])
 
     return data
 
 
-def load_data_from_file(measurements_filepath: str) -> List[Measurement]:
+def get_ew_vs_n_aver(measurements_filepath: Union[str, MeasurementTable], nh_index: int, a_fe: str):
 
-    data: List[Measurement] = []
-
-    with open(measurements_filepath) as measurements_file:
-        for line in measurements_file:
-            key, value = parse_measurement(measurement_line=line)
-            data += [Measurement(key=key, value=value)]
+    data: Dict[int, List[ValueAndError]] = {}
 
-    return data
+    table = as_measurement_table(measurements_filepath).select(
+        nh_index=nh_index, a_fe=a_fe)
 
+    for n_aver, ew in zip(table['n_aver'].tolist(), table.values_and_errors('ew')):
+        data.setdefault(n_aver, []).append(ew)
 
-def filter_data_by_nh(data: List[Measurement], nh_index: int):
+    print(f'the data: {data}')
 
-    filtered_data: List[Measurement] = []
+    return data
 
-    for measurement in data:
-        if measurement.key.nh_index == nh_index:
-            filtered_data += [measurement]
 
-    return filtered_data
+def get_vs_nh_index(measurements_filepath: Union[str, MeasurementTable], field_name: str, **criteria) -> Tuple[np.ndarray, UncertainArray]:
+    """Returns a measurement along the NH bins of the rows matching the criteria (see MeasurementTable.mask()),
+    sorted by nh_index. It is meant for the measurements of all the NH bins (see do_nh_bins_measurements()).
 
+    For example:
 
-def filter_data_by_nhaver(data: List[Measurement], nh_aver: str):
+        nh_indexes, ew = get_vs_nh_index(
+            "/path/to/nh_bins/measurements/file", 'ew', nh_aver='523', n_aver=5, a_fe='1xfe', alpha='7590')
 
-    filtered_data: List[Measurement] = []
+        plt.errorbar(nh_indexes, ew.value, ew.err)
 
-    for measurement in data:
-        if measurement.key.nh_aver == nh_aver:
-            filtered_data += [measurement]
+    Returns:
+        Tuple[np.ndarray, UncertainArray]: nh indexes, measurement
+    """
+    table = as_measurement_table(measurements_filepath).select(**criteria)
+    order = np.argsort(table['nh_index'], kind='stable')
 
-    return filtered_data
+    return table['nh_index'][order], table.uncertain(field_name)[order]
 
 
-def filter_data_by_abundance(data: List[Measurement], a_fe: str):
+def load_data_from_file(measurements_filepath: str) -> MeasurementTable:
+    """Loads the measurements file once, the filter_data_by_*() functions
+    and the iteration (over Measurement objects) are in-memory queries.
+    """
+    return MeasurementTable.build_measurement_table(measurements_filepath)
 
-    filtered_data: List[Measurement] = []
 
-    for measurement in data:
-        if measurement.key.a_fe == a_fe:
-            filtered_data += [measurement]
+def filter_data_by_nh(data: MeasurementTable, nh_index: int) -> MeasurementTable:
+    return data.select(nh_index=nh_index)
 
-    return filtered_data
 
+def filter_data_by_nhaver(data: MeasurementTable, nh_aver: str) -> MeasurementTable:
+    return data.select(nh_aver=nh_aver)
 
-def filter_data_by_viewing_angle(data: List[Measurement], alpha: AngularInterval):
 
-    filtered_data: List[Measurement] = []
+def filter_data_by_abundance(data: MeasurementTable, a_fe: str) -> MeasurementTable:
+    return data.select(a_fe=a_fe)
 
-    for measurement in data:
-        if measurement.key.alpha == alpha:
-            filtered_data += [measurement]
 
-    return filtered_data
+def filter_data_by_viewing_angle(data: MeasurementTable, alpha: AngularInterval) -> MeasurementTable:
+    return data.select(alpha=alpha)
@@ -0,0 +1,324 @@
+"""
+This module stores the measurements (see perform_measurements()) as a typed
+columnar table: a structured numpy array saved as .npy, one row per
+measurement key, so a whole run is loaded (or memory-mapped) with one read.
+
+The key 523_5_1xfe_7590_27 is stored in the columns
+
+    nh_aver='523', n_aver=5, a_fe='1xfe', alpha='7590', nh_index=27
+
+and the measurements in the columns ew, ew_err, h, h_err, shoulder, shoulder_err,
+edge, edge_err, edge_chi2, edge_dof, and the bootstrap percentile intervals
+ew_low, ew_high, h_low, h_high, shoulder_low, shoulder_high (NaN if the
+errors were propagated, and not kept by the text files).
+
+==================================
+
+Example-01: 'how to convert an old .measurements file'
+
+table_filepath = convert_measurements_file('/path/to/40_8.9e+21_8.9e+25.measurements')
+
+==================================
+
+Example-02: 'how to load the measurements of a run'
+
+table = load_measurements_table('/path/to/40_8.9e+21_8.9e+25.measurements.npy')
+
+print(table['h'][table['nh_index'] == 27])
+
+==================================
+
+Example-03: 'how to know which inputs a run was measured from'
+
+fingerprints = load_measurement_input_fingerprints('/path/to/40_8.9e+21_8.9e+25.measurements.npy')
+
+print(fingerprints['523_5_1xfe_7590_27'])
+print(load_measurement_parameters_digests('/path/to/40_8.9e+21_8.9e+25.measurements.npy')['523_5_1xfe_7590_27'])
+
+==================================
+
+Example-04: 'how to load the fluorescent line measurements'
+
+table = load_line_measurements_table('/path/to/40_8.9e+21_8.9e+25.lines.measurements.npy')
+
+print(table['ew'][table['line'] == 'NiKalpha'])
+
+==================================
+"""
+from __future__ import annotations
+from typing import Final, Iterable, Tuple, Dict
+import numpy as np
+import os
+
+MEASUREMENTS_TABLE_SUFFIX: Final[str] = '.npy'
+"""The measurements files with this suffix are tables, the rest are the (old) text files.
+"""
+
+MEASUREMENT_INPUTS_SUFFIX: Final[str] = '.inputs.npy'
+"""The fingerprints of the inputs of the measurements file {path} are stored in {path}.inputs.npy
+"""
+
+MEASUREMENT_INPUTS: Final[Tuple[str, ...]] = (
+    'continuum_fd', 'continuum_sp', 'fekalpha_fd')
+"""The spectral data files every measurement key is measured from.
+"""
+
+MEASUREMENT_KEY_FIELDS: Final[Tuple[str, ...]] = (
+    'nh_aver', 'n_aver', 'a_fe', 'alpha', 'nh_index')
+
+MEASUREMENT_VALUE_FIELDS: Final[Tuple[str, ...]] = ('ew', 'ew_err', 'h', 'h_err', 'shoulder', 'shoulder_err',
+                                                    'edge', 'edge_err', 'edge_chi2', 'edge_dof',
+                                                    'ew_low', 'ew_high', 'h_low', 'h_high', 'shoulder_low', 'shoulder_high')
+
+MEASUREMENT_INTERVAL_FIELDS: Final[Tuple[str, ...]] = ('ew', 'h', 'shoulder')
+"""The measurements that can have a bootstrap percentile interval.
+"""
+
+MEASUREMENTS_DTYPE: Final[np.dtype] = np.dtype([('nh_aver', 'U16'),
+                                                ('n_aver', np.int64),
+                                                ('a_fe', 'U16'),
+                                                ('alpha', 'U8'),
+                                                ('nh_index', np.int64),
+                                                ('ew', np.float64),
+                                                ('ew_err', np.float64),
+                                                ('h', np.float64),
+                                                ('h_err', np.float64),
+                                                ('shoulder', np.float64),
+                                                ('shoulder_err', np.float64),
+                                                ('edge', np.float64),
+                                                ('edge_err', np.float64),
+                                                ('edge_chi2', np.float64),
+                                                ('edge_dof', np.int64),
+                                                ('ew_low', np.float64),
+                                                ('ew_high', np.float64),
+                                                ('h_low', np.float64),
+                                                ('h_high', np.float64),
+                                                ('shoulder_low', np.float64),
+                                                ('shoulder_high', np.float64)])
+
+MEASUREMENT_INPUTS_DTYPE: Final[np.dtype] = np.dtype([('label', 'U64')] +
+                                                     [(f'{name}_{attribute}', dtype) for name in MEASUREMENT_INPUTS
+                                                      for attribute, dtype in (('path', 'U1024'), ('size', np.int64), ('mtime_ns', np.int64))] +
+                                                     [('parameters_digest', 'U64')])
+"""The fingerprints of the inputs of every key, and the digest of the measurement parameters
+(windows, fits and error mode) the key was measured with
+"""
+
+LINE_MEASUREMENTS_DTYPE: Final[np.dtype] = np.dtype(MEASUREMENTS_DTYPE.descr[:len(MEASUREMENT_KEY_FIELDS)] +
+                                                    [('line', 'U16')] +
+                                                    [(name, np.float64) for name in ('flux', 'flux_err', 'ew', 'ew_err', 'shoulder', 'shoulder_err')])
+"""The fluorescent line measurements (see fluorescent_line_utils): one row per key and line
+"""
+
+InputFingerprint = Tuple[Tuple[str, int, int], ...]
+"""(path, size, mtime_ns) of every input of a key, in the order of MEASUREMENT_INPUTS
+"""
+
+
+def is_measurements_table(measurements_filepath: str) -> bool:
+    return measurements_filepath.endswith(MEASUREMENTS_TABLE_SUFFIX)
+
+
+def split_measurement_label(label: str) -> Tuple[str, int, str, str, int]:
+    """Splits a key like 523_5_1xfe_7590_27 into nh_aver, n_aver, a_fe, alpha, nh_index
+    """
+    nh_aver, n_aver, a_fe, alpha, nh_index = label.split(sep='_')
+    return nh_aver, int(n_aver), a_fe, alpha, int(nh_index)
+
+
+def get_measurement_label(row: np.void) -> str:
+    """The inverse of split_measurement_label() for a row of the table.
+    """
+    return f"{row['nh_aver']}_{row['n_aver']}_{row['a_fe']}_{row['alpha']}_{row['nh_index']}"
+
+
+def measurement_row(label: str, ew: Tuple[float, float], h: Tuple[float, float], shoulder: Tuple[float, float],
+                    edge: Tuple[float, float], edge_chi2: float, edge_dof: int,
+                    intervals: Dict[str, Tuple[float, float]] = None) -> tuple:
+    """Builds a row of the table.
+
+    Args:
+        label (str): the measurement key, for example 523_5_1xfe_7590_27
+        ew (Tuple[float, float]): value, error
+        h (Tuple[float, float]): value, error
+        shoulder (Tuple[float, float]): value, error
+        edge (Tuple[float, float]): value, error
+        edge_chi2 (float): chi2 of the edge fit
+        edge_dof (int): degrees of freedom of the edge fit
+        intervals (Dict[str, Tuple[float, float]], optional): the (low, high) bootstrap intervals
+            of the MEASUREMENT_INTERVAL_FIELDS. Defaults to None (NaN).
+
+    Returns:
+        tuple: the row
+    """
+    intervals = intervals if intervals else {}
+
+    return (*split_measurement_label(label), *ew, *h, *shoulder, *edge, edge_chi2, edge_dof,
+            *[bound for name in MEASUREMENT_INTERVAL_FIELDS for bound in intervals.get(name, (np.nan, np.nan))])
+
+
+def build_measurements_table(rows: Iterable[tuple]) -> np.ndarray:
+    return np.array(list(rows), dtype=MEASUREMENTS_DTYPE)
+
+
+def write_measurements_table(measurements_filepath: str, table: np.ndarray):
+    # through a file object, so np.save doesn't append .npy to the path
+    with open(measurements_filepath, 'wb') as measurements_file:
+        np.save(measurements_file, np.asarray(
+            table, dtype=MEASUREMENTS_DTYPE))
+
+
+def line_measurement_row(label: str, line: str, flux: Tuple[float, float], ew: Tuple[float, float], shoulder: Tuple[float, float]) -> tuple:
+    """Returns the LINE_MEASUREMENTS_DTYPE row of a line of a key, the measurements are (value, err).
+    """
+    return (*split_measurement_label(label), line, *flux, *ew, *shoulder)
+
+
+def write_line_measurements_table(measurements_filepath: str, rows: Iterable[tuple]):
+    with open(measurements_filepath, 'wb') as measurements_file:
+        np.save(measurements_file, np.array(
+            list(rows), dtype=LINE_MEASUREMENTS_DTYPE))
+
+
+def load_line_measurements_table(measurements_filepath: str, mmap: bool = True) -> np.ndarray:
+    return np.load(measurements_filepath, mmap_mode='r' if mmap else None)
+
+
+def _parse_measurements_text_line(line: str) -> tuple:
+    label, values = line.split(sep='#')
+    ew, h, shoulder, edge = values.split()
+    edge_value, edge_err, edge_chi2, edge_dof = edge.split(sep=':')
+
+    def value_and_error(code: str):
+        value, err = code.split(sep=':')
+        return float(value), float(err)
+
+    return measurement_row(label=label,
+                           ew=value_and_error(ew),
+                           h=value_and_error(h),
+                           shoulder=value_and_error(shoulder),
+                           edge=(float(edge_value), float(edge_err)),
+                           edge_chi2=float(edge_chi2),
+                           edge_dof=int(edge_dof))
+
+
+def _upgrade_measurements_table(table: np.ndarray) -> np.ndarray:
+    """Copies a table written with fewer columns into a MEASUREMENTS_DTYPE table, the new columns are NaN.
+    """
+    upgraded = np.zeros(len(table), dtype=MEASUREMENTS_DTYPE)
+
+    for name in MEASUREMENTS_DTYPE.names:
+        if name in table.dtype.names:
+            upgraded[name] = table[name]
+        elif np.issubdtype(MEASUREMENTS_DTYPE[name], np.floating):
+            upgraded[name] = np.nan
+
+    return upgraded
+
+
+def load_measurements_table(measurements_filepath: str, mmap: bool = True) -> np.ndarray:
+    """Loads the measurements of the given file as a table.
+
+    Args:
+        measurements_filepath (str): a table (.npy) or an old (text) .measurements file
+        mmap (bool, optional): memory-map the table instead of reading it. Defaults to True.
+
+    Returns:
+        np.ndarray: the table, see MEASUREMENTS_DTYPE
+    """
+    if not os.path.exists(measurements_filepath):
+        raise FileNotFoundError(
+            f'The measurements file {measurements_filepath} does not exist, run do_measurements.py '
+            f'(or convert an old .measurements file, see convert_measurements_file())')
+
+    if is_measurements_table(measurements_filepath):
+        table = np.load(measurements_filepath, mmap_mode='r' if mmap else None)
+        return table if table.dtype == MEASUREMENTS_DTYPE else _upgrade_measurements_table(table)
+
+    with open(measurements_filepath) as measurements_file:
+        return build_measurements_table(_parse_measurements_text_line(line)
+                                        for line in measurements_file if line.strip())
+
+
+def write_measurements_text(measurements_filepath: str, table: np.ndarray):
+    """Writes the table as an old (text) .measurements file.
+    """
+    with open(measurements_filepath, 'w') as measurements_file:
+        for row in table:
+            measurements_file.write(
+                f"{get_measurement_label(row)}#{row['ew']}:{row['ew_err']}   {row['h']}:{row['h_err']}    "
+                f"{row['shoulder']}:{row['shoulder_err']}    {row['edge']}:{row['edge_err']}:{row['edge_chi2']}:{row['edge_dof']}\n")
+
+
+def convert_measurements_file(measurements_filepath: str, table_filepath: str = None) -> str:
+    """Converts an old (text) .measurements file into a table.
+
+    Args:
+        measurements_filepath (str): the text file
+        table_filepath (str, optional): the table file. Defaults to the text file path plus MEASUREMENTS_TABLE_SUFFIX.
+
+    Returns:
+        str: the path to the table
+    """
+    table_filepath = table_filepath if table_filepath else f'{measurements_filepath}{MEASUREMENTS_TABLE_SUFFIX}'
+
+    write_measurements_table(table_filepath, load_measurements_table(
+        measurements_filepath))
+
+    return table_filepath
+
+
+def get_measurement_inputs_filepath(measurements_filepath: str) -> str:
+    return f'{measurements_filepath}{MEASUREMENT_INPUTS_SUFFIX}'
+
+
+def get_input_fingerprint(*input_filepaths: str) -> InputFingerprint:
+    """Returns the fingerprint of the given input files: their path, size and modification time.
+    """
+    def fingerprint(filepath: str) -> Tuple[str, int, int]:
+        stat = os.stat(filepath)
+        return filepath, stat.st_size, stat.st_mtime_ns
+
+    return tuple(fingerprint(filepath) for filepath in input_filepaths)
+
+
+def write_measurement_input_fingerprints(measurements_filepath: str, fingerprints: Dict[str, InputFingerprint], parameters_digest: str = ''):
+    """Stores the fingerprints of the inputs of every key of the measurements file, and the
+    digest of the measurement parameters they were measured with.
+    """
+    rows = [(label, *[attribute for input_fingerprint in fingerprint for attribute in input_fingerprint], parameters_digest)
+            for label, fingerprint in sorted(fingerprints.items())]
+
+    with open(get_measurement_inputs_filepath(measurements_filepath), 'wb') as inputs_file:
+        np.save(inputs_file, np.array(rows, dtype=MEASUREMENT_INPUTS_DTYPE))
+
+
+def load_measurement_input_fingerprints(measurements_filepath: str) -> Dict[str, InputFingerprint]:
+    """Returns the fingerprints of the inputs of every key of the measurements file,
+    empty if they were not stored.
+    """
+    inputs_filepath = get_measurement_inputs_filepath(measurements_filepath)
+
+    if not os.path.exists(inputs_filepath):
+        return {}
+
+    return {str(row['label']): tuple((str(row[f'{name}_path']), int(row[f'{name}_size']), int(row[f'{name}_mtime_ns']))
+                                     for name in MEASUREMENT_INPUTS)
+            for row in np.load(inputs_filepath)}
+
+
+def load_measurement_parameters_digests(measurements_filepath: str) -> Dict[str, str]:
+    """Returns the digest of the measurement parameters of every key of the measurements file,
+    empty if they were not stored (files written before the digests have none, so nothing is reused).
+    """
+    inputs_filepath = get_measurement_inputs_filepath(measurements_filepath)
+
+    if not os.path.exists(inputs_filepath):
+        return {}
+
+    inputs = np.load(inputs_filepath)
+
+    if 'parameters_digest' not in inputs.dtype.names:
+        return {}
+
+    return {str(row['label']): str(row['parameters_digest']) for row in inputs}
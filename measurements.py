@@ -2,24 +2,208 @@ from os import listdir, path, mkdir, path
 from agn_processing_policy import *
 from paths_in_this_machine import root_simulations_directory
 from functools import reduce
-from dataclasses import dataclass
-from flux_density_utils import FluxDensity, EnergyInterval, product_transport_err, ValueAndError, SpectrumCount, get_interval_index_log, HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT, parse_spectral_data_files, HV_FEKALPHA_NO_SHOULDER_LEFT, HV_FEKALPHA_SHOULDER_RIGHT, HV_FEKALPHA_ABSORPTION_EDGE, HV_FEKALPHA_ABSORPTION_LEFT_LEFT, HV_FEKALPHA_ABSORPTION_RIGHT_LEFT, HV_FEKALPHA_ABSORPTION_RIGHT_RIGHT, AngularInterval
+from dataclasses import dataclass, fields, replace
+from flux_density_utils import FluxDensity, EnergyInterval, ValueAndError, SpectrumCount, get_interval_index_log, HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT, parse_spectral_data_files, HV_FEKALPHA_NO_SHOULDER_LEFT, HV_FEKALPHA_SHOULDER_RIGHT, HV_FEKALPHA_ABSORPTION_EDGE, HV_FEKALPHA_ABSORPTION_LEFT_LEFT, HV_FEKALPHA_ABSORPTION_RIGHT_LEFT, HV_FEKALPHA_ABSORPTION_RIGHT_RIGHT, AngularInterval
 from agn_simulation_policy import AGN_NH_AVERAGE, AGN_IRON_ABUNDANCE, AGN_VIEWING_DIRECTIONS_DEG
 import numpy as np
-from typing import Dict, List, Tuple
-from spectrum_utils import SpectrumBase
-from utils import chi2
+from typing import Dict, List, Tuple, Iterable
+from spectrum_utils import SpectrumBase, SpectrumPrefixSums, window_sums
+from energy_grid_utils import EnergyGrid
+from utils import chi2, UncertainArray
 from agn_utils import compton_shift
 from scipy.optimize import curve_fit
 from inspect import signature
+from concurrent.futures import ProcessPoolExecutor
+from measurement_table_utils import build_measurements_table, measurement_row, write_measurements_table, write_measurements_text, is_measurements_table, load_measurements_table, get_measurement_label, MEASUREMENT_INPUTS, MEASUREMENT_INTERVAL_FIELDS, line_measurement_row, write_line_measurements_table, InputFingerprint, get_input_fingerprint, load_measurement_input_fingerprints, load_measurement_parameters_digests, write_measurement_input_fingerprints
+from tempfile import TemporaryDirectory
+from fluorescent_line_utils import FLUORESCENT_LINES, FluorescentLineInfo, measure_fluorescent_lines
+import agn_processing_policy
+import hashlib
+import json
+import os
+import zlib
 
 root_dir = root_simulations_directory
 spectral_data_file_label = "spectral_data"
 
 
+EDGE_FIT_N_GRID_POINTS = 65
+"""Number of N_edge values in [0, 1] where the profile chi2 is evaluated to bracket its minimum.
+"""
+
+EDGE_FIT_GOLDEN_ITERATIONS = 48
+"""Number of golden section iterations to refine N_edge inside the bracket.
+"""
+
+_GOLDEN_RATIO = (np.sqrt(5) - 1)/2
+
+
+def _edge_window_sums(u: np.ndarray, y: np.ndarray, y_err: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """Weighted sums of a window of the spectra (one spectrum per row), with the
+    weights 1/y_err^2 (the points without error are ignored).
+
+    Returns:
+        Tuple[np.ndarray, ...]: S0, S1, S2, T0, T1, Y = sum(w), sum(w*u), sum(w*u^2), sum(w*y), sum(w*u*y), sum(w*y^2)
+    """
+    with np.errstate(divide='ignore'):
+        w = np.where(mask & (y_err > 0), 1/np.where(y_err > 0, y_err, 1)**2, 0)
+    wu = w*u
+    wy = w*y
+    return w.sum(axis=-1), wu.sum(axis=-1), (wu*u).sum(axis=-1), wy.sum(axis=-1), (wy*u).sum(axis=-1), (wy*y).sum(axis=-1)
+
+
+def _edge_line_params(N: np.ndarray, left_sums, right_sums) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Least squares line (m, b) of the edge model for the given N, and its chi2.
+    """
+    SL0, SL1, SL2, TL0, TL1, YL = left_sums
+    SR0, SR1, SR2, TR0, TR1, YR = right_sums
+
+    N2 = N**2
+    a11 = SL2 + N2*SR2
+    a12 = SL1 + N2*SR1
+    a22 = SL0 + N2*SR0
+    r1 = TL1 + N*TR1
+    r2 = TL0 + N*TR0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = a11*a22 - a12**2
+        m = (a22*r1 - a12*r2)/det
+        b = (a11*r2 - a12*r1)/det
+
+    return m, b, YL + YR - (m*r1 + b*r2)
+
+
+def _solve_edge_model(u: np.ndarray, y: np.ndarray, y_err: np.ndarray,
+                      left_mask: np.ndarray, right_mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Weighted least squares of the absorption edge model
+
+        y = m*u + b         on the left window
+        y = N*(m*u + b)     on the right window, 0 <= N <= 1
+
+    for every spectrum (row) at once.
+
+    For a given N the model is linear in (m, b), thus (m, b) and the chi2 are
+    solved in closed form from the weighted sums of the windows, and only the
+    profile chi2(N) is minimized numerically: it is bracketed on a grid of N
+    and then refined by golden section. The covariance is the inverse of the
+    (exact) 3x3 J^T W J at the solution, like curve_fit(absolute_sigma=True).
+
+    Args:
+        u (np.ndarray): the (rescaled) energies, (n_points,) or (n_spectra, n_points)
+        y (np.ndarray): (n_spectra, n_points) counts
+        y_err (np.ndarray): (n_spectra, n_points) errors of the counts
+        left_mask (np.ndarray): the points of the left window
+        right_mask (np.ndarray): the points of the right window
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: m, b, N, N_err (nan where the fit is undetermined)
+    """
+    left_sums = _edge_window_sums(u, y, y_err, left_mask)
+    right_sums = _edge_window_sums(u, y, y_err, right_mask)
+
+    left_sums_k = [s[:, np.newaxis] for s in left_sums]
+    right_sums_k = [s[:, np.newaxis] for s in right_sums]
+
+    N_grid = np.linspace(0, 1, EDGE_FIT_N_GRID_POINTS)
+    *_, chi2_grid = _edge_line_params(N_grid[np.newaxis, :],
+                                      left_sums_k, right_sums_k)
+    best = np.argmin(np.where(np.isnan(chi2_grid), np.inf, chi2_grid), axis=1)
+
+    step = N_grid[1] - N_grid[0]
+    lower = np.clip(N_grid[best] - step, 0, 1)
+    upper = np.clip(N_grid[best] + step, 0, 1)
+
+    def profile(N):
+        return _edge_line_params(N, left_sums, right_sums)[2]
+
+    c = upper - _GOLDEN_RATIO*(upper - lower)
+    d = lower + _GOLDEN_RATIO*(upper - lower)
+    f_c, f_d = profile(c), profile(d)
+    for _ in range(EDGE_FIT_GOLDEN_ITERATIONS):
+        go_left = f_c < f_d
+        lower, upper = np.where(go_left, lower, c), np.where(go_left, d, upper)
+        new_c = np.where(go_left, upper - _GOLDEN_RATIO*(upper - lower), d)
+        new_d = np.where(go_left, c, lower + _GOLDEN_RATIO*(upper - lower))
+        f_new = profile(np.where(go_left, new_c, new_d))
+        f_c, f_d = np.where(go_left, f_new, f_d), np.where(go_left, f_c, f_new)
+        c, d = new_c, new_d
+
+    # the minimum may be at the bounds, which the golden section only approaches
+    candidates = np.stack(((lower + upper)/2, np.zeros_like(lower), np.ones_like(lower)))
+    candidates_chi2 = np.stack([profile(N_i) for N_i in candidates])
+    N = np.take_along_axis(candidates, np.argmin(np.where(
+        np.isnan(candidates_chi2), np.inf, candidates_chi2), axis=0)[np.newaxis, :], axis=0)[0]
+
+    m, b, _ = _edge_line_params(N, left_sums, right_sums)
+
+    SR0, SR1, SR2, *_ = right_sums
+    N2 = N**2
+    h11 = left_sums[2] + N2*SR2
+    h12 = left_sums[1] + N2*SR1
+    h22 = left_sums[0] + N2*SR0
+    h13 = N*(m*SR2 + b*SR1)
+    h23 = N*(m*SR1 + b*SR0)
+    h33 = m**2*SR2 + 2*m*b*SR1 + b**2*SR0
+
+    hessian = np.stack((np.stack((h11, h12, h13), axis=-1),
+                        np.stack((h12, h22, h23), axis=-1),
+                        np.stack((h13, h23, h33), axis=-1)), axis=-2)
+
+    with np.errstate(invalid='ignore'):
+        det = np.linalg.det(hessian)
+    solvable = np.isfinite(det) & (np.abs(det) > 0)
+
+    N_err = np.full(len(N), np.nan)
+    if np.any(solvable):
+        N_err[solvable] = np.sqrt(np.abs(np.linalg.inv(
+            hessian[solvable])[:, 2, 2]))
+
+    N = np.where(solvable, N, np.nan)
+
+    return m, b, N, N_err
+
+
+@dataclass
+class EdgeFitBatchResult:
+    """
+    This class holds the absorption edge fits of a stack of spectra, one row per spectrum.
+    """
+
+    N_edge: np.ndarray
+
+    N_edge_err: np.ndarray
+
+    chi2: np.ndarray
+
+    dof: np.ndarray
+
+    m: np.ndarray
+    """slope of the continuum line (in counts/eV)
+    """
+
+    b: np.ndarray
+    """intercept of the continuum line
+    """
+
+    valid: np.ndarray
+    """False for the spectra whose fit is undetermined (their values are nan)
+    """
+
+    def __len__(self) -> int:
+        return len(self.N_edge)
+
+    def get_edge(self, row: int) -> Tuple[ValueAndError, float, int]:
+        """The same output of get_edge() for the given row.
+        """
+        return ValueAndError(self.N_edge[row], self.N_edge_err[row]), self.chi2[row], self.dof[row]
+
+
 class AbsorptionEdgeFitter:
     """
     This is a functor class to fit the Iron Absorption Edge.
+
+    The continuum is modeled by a line on the left window and the same line
+    times N_edge (in [0, 1]) on the right window, see _solve_edge_model().
     """
 
     def __init__(self, hv_left_left: float,
@@ -35,8 +219,8 @@ class AbsorptionEdgeFitter:
             hv_left_right (float): right energy bound of the left region
             hv_right_left (float): left energy bound of the right region
             hv_right_right (float): right energy bound of the right region
-            max_number_trials (float, optional): maximum number of trial. Defaults to 1e6.
-            custom_fitter (callable, optional): custom fitter. Defaults to None.
+            max_number_trials (float, optional): maximum number of trial, only used with a custom fitter. Defaults to 1e6.
+            custom_fitter (callable, optional): custom fitter, fitted with curve_fit. Defaults to None.
         """
 
         self.hv_left_left = hv_left_left
@@ -44,16 +228,24 @@ class AbsorptionEdgeFitter:
         self.hv_right_left = hv_right_left
         self.hv_right_right = hv_right_right
         self.max_number_trials = max_number_trials
+        self.custom_fitter = custom_fitter
         self.fitter = custom_fitter if custom_fitter else self._get_fitter()
         sig = signature(self.fitter)
         self.num_params_of_fitter = len(sig.parameters)
 
+        # the energies are rescaled to [0, 1] on the fitted range to keep the sums well conditioned
+        self._hv_reference = hv_left_left
+        self._hv_scale = hv_right_right - hv_left_left
+
     def __call__(self, spectrum: SpectrumCount) -> Tuple[SpectrumCount, SpectrumCount, float, float, float]:
         """fit the given spectrum
 
         Args:
             spectrum (SpectrumCount): the continuum spectrum near the absorption edge
 
+        Raises:
+            ValueError: if the fit is undetermined (for example, there are no counts in a window).
+
         Returns:
             Tuple[SpectrumCount, SpectrumCount, float, float, float]: part of the continuum that was fitted, \
                 the fitted continuum, edge, edge error, xi2
@@ -61,8 +253,140 @@ class AbsorptionEdgeFitter:
 
         formated_spectrum = self._format_spectrum_to_be_fitted(spectrum)
 
-        fitter = self._get_fitter()
-        pars, cov = curve_fit(f=fitter, xdata=formated_spectrum.x,
+        if self.custom_fitter:
+            return self._fit_with_custom_fitter(formated_spectrum)
+
+        x = formated_spectrum.x
+        left_mask, right_mask = self._window_masks(x)
+
+        m, b, N_edge, N_edge_err = _solve_edge_model(u=self._rescale(x),
+                                                     y=formated_spectrum.y[np.newaxis, :],
+                                                     y_err=formated_spectrum.y_err[np.newaxis, :],
+                                                     left_mask=left_mask,
+                                                     right_mask=right_mask)
+
+        if not np.isfinite(N_edge[0]):
+            raise ValueError(
+                'the absorption edge fit is undetermined for the given spectrum')
+
+        m, b = self._to_energy_units(m[0], b[0])
+
+        y = self.fitter(x, m, b, N_edge[0])
+        expected_spectrum = SpectrumCount(x, y, np.sqrt(y))
+
+        fitted = left_mask | right_mask
+        xi2_val = chi2(observed=formated_spectrum.y[fitted],
+                       expected=y[fitted])
+        dof = int(np.count_nonzero(fitted)) - (self.num_params_of_fitter-1)
+
+        return formated_spectrum, expected_spectrum, float(N_edge[0]), float(N_edge_err[0]), xi2_val, dof
+
+    def fit_batch(self, x: np.ndarray, y: np.ndarray, y_err: np.ndarray) -> EdgeFitBatchResult:
+        """Fits a stack of continuum spectra on the same energy bins at once.
+
+        The points out of both windows (like the center one) are ignored.
+        The fits that fail are flagged in the result instead of raising.
+
+        Args:
+            x (np.ndarray): (n_points,) the energies shared by all the spectra
+            y (np.ndarray): (n_spectra, n_points) counts
+            y_err (np.ndarray): (n_spectra, n_points) errors of the counts
+
+        Returns:
+            EdgeFitBatchResult: the fits, one per row
+        """
+        if self.custom_fitter:
+            raise ValueError(
+                'the batch fit is not available for custom fitters')
+
+        x = np.asarray(x, dtype=float)
+        y = np.atleast_2d(np.asarray(y, dtype=float))
+        y_err = np.atleast_2d(np.asarray(y_err, dtype=float))
+
+        left_mask, right_mask = self._window_masks(x)
+
+        m, b, N_edge, N_edge_err = _solve_edge_model(u=self._rescale(x), y=y, y_err=y_err,
+                                                     left_mask=left_mask, right_mask=right_mask)
+        m, b = self._to_energy_units(m, b)
+
+        fitted = left_mask | right_mask
+        line = m[:, np.newaxis]*x[np.newaxis, fitted] + b[:, np.newaxis]
+        expected = np.where(right_mask[fitted][np.newaxis, :],
+                            N_edge[:, np.newaxis]*line, line)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xi2_val = np.sum((y[:, fitted] - expected)**2/expected, axis=1)
+
+        valid = np.isfinite(N_edge)
+        dof = np.full(len(y), int(np.count_nonzero(fitted)) -
+                      (self.num_params_of_fitter-1))
+
+        return EdgeFitBatchResult(N_edge=N_edge,
+                                  N_edge_err=N_edge_err,
+                                  chi2=np.where(valid, xi2_val, np.nan),
+                                  dof=dof,
+                                  m=m,
+                                  b=b,
+                                  valid=valid)
+
+    def fit_spectra(self, spectra: List[SpectrumBase]) -> EdgeFitBatchResult:
+        """Fits the given continuum spectra, the ones on the same energy bins at once (see fit_batch()),
+        so a spectrum on other energy bins doesn't stop the fits of the rest.
+
+        Args:
+            spectra (List[SpectrumBase]): the continuum spectra
+
+        Returns:
+            EdgeFitBatchResult: the fits, in the order of the spectra
+        """
+        groups: List[List[int]] = []
+        for row, spectrum in enumerate(spectra):
+            for group in groups:
+                if spectra[group[0]].same_grid(spectrum):
+                    group.append(row)
+                    break
+            else:
+                groups.append([row])
+
+        if len(groups) == 1:
+            return self._fit_spectra_on_same_grid(spectra)
+
+        results = [self._fit_spectra_on_same_grid([spectra[row] for row in group])
+                   for group in groups]
+
+        def scatter(name: str) -> np.ndarray:
+            values = np.empty(len(spectra), dtype=getattr(results[0], name).dtype)
+            for group, result in zip(groups, results):
+                values[group] = getattr(result, name)
+            return values
+
+        return EdgeFitBatchResult(**{result_field.name: scatter(result_field.name)
+                                     for result_field in fields(EdgeFitBatchResult)})
+
+    def _fit_spectra_on_same_grid(self, spectra: List[SpectrumBase]) -> EdgeFitBatchResult:
+        first = spectra[0]
+
+        start = np.searchsorted(first.x, self.hv_left_left, side='left')
+        stop = np.searchsorted(first.x, self.hv_right_right, side='right')
+
+        return self.fit_batch(x=first.x[start:stop],
+                              y=np.stack([spectrum.y[start:stop]
+                                         for spectrum in spectra]),
+                              y_err=np.stack([spectrum.y_err[start:stop] for spectrum in spectra]))
+
+    def _rescale(self, x: np.ndarray) -> np.ndarray:
+        return (x - self._hv_reference)/self._hv_scale
+
+    def _to_energy_units(self, m, b):
+        return m/self._hv_scale, b - m*self._hv_reference/self._hv_scale
+
+    def _window_masks(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        left_mask = (self.hv_left_left <= x) & (x <= self.hv_left_right)
+        right_mask = (self.hv_right_left <= x) & (x <= self.hv_right_right)
+        return left_mask, right_mask
+
+    def _fit_with_custom_fitter(self, formated_spectrum: SpectrumBase):
+        pars, cov = curve_fit(f=self.fitter, xdata=formated_spectrum.x,
                               ydata=formated_spectrum.y,
                               bounds=([-np.inf for i in range(self.num_params_of_fitter-2)] + [0],
                                       [np.inf for i in range(self.num_params_of_fitter-2)]+[1]),
@@ -70,26 +394,8 @@ class AbsorptionEdgeFitter:
                               absolute_sigma=True,
                               maxfev=self.max_number_trials)
 
-        # x = formated_spectrum.x
-        # y = fitter(x, *pars)
-
-        # # print(len(np.absolute(formated_spectrum.y-y)))
-        # # print(len(formated_spectrum.y_err))
-        # # print(np.absolute(formated_spectrum.y-y))
-        # # print(formated_spectrum.y_err)
-
-        # true_err = [a if a > b else b for a, b in zip(
-        #     np.absolute(formated_spectrum.y-y), formated_spectrum.y_err)]
-
-        # pars, cov = curve_fit(f=fitter, xdata=formated_spectrum.x,
-        #                       ydata=formated_spectrum.y,
-        #                       bounds=([-np.inf for i in range(self.num_params_of_fitter-2)] + [0],
-        #                               [np.inf for i in range(self.num_params_of_fitter-2)]+[1]),
-        #                       sigma=np.array(true_err),
-        #                       absolute_sigma=True, maxfev=self.max_number_trials)
-
         x = formated_spectrum.x
-        y = fitter(x, *pars)
+        y = self.fitter(x, *pars)
         y_err = np.sqrt(y)
         expected_spectrum = SpectrumCount(x, y, y_err)
 
@@ -100,30 +406,16 @@ class AbsorptionEdgeFitter:
         perr = np.sqrt(np.diag(cov))
         *_, N_edge_err = perr
 
-        # print(pars)
-        # print(perr)
-        # plt.plot(formated_spectrum.x, formated_spectrum.y)
-        # plt.plot(expected_spectrum.x, expected_spectrum.y)
-
         return formated_spectrum, expected_spectrum, N_edge, N_edge_err, xi2_val, dof
 
     def _get_fitter(self):
 
         def fitter(energy_intervals: np.ndarray, m, b, N_fit):
-            zero_spectrum = SpectrumCount(
-                energy_intervals, 0*energy_intervals, 0*energy_intervals)
+            left_mask, right_mask = self._window_masks(energy_intervals)
 
-            left_spectrum = zero_spectrum.get_cpy_on_interval(
-                EnergyInterval(self.hv_left_left, self.hv_left_right))
-            right_spectrum = zero_spectrum.get_cpy_on_interval(
-                EnergyInterval(self.hv_right_left, self.hv_right_right))
-            center_zero_spectrum = zero_spectrum.get_cpy_on_interval(
-                EnergyInterval(self.hv_left_right, self.hv_right_left))
+            line = (m*energy_intervals) + b
 
-            left_count = (m*left_spectrum.x) + b
-            right_count = N_fit * ((m*right_spectrum.x) + b)
-
-            return np.concatenate((left_count, center_zero_spectrum.y, right_count))
+            return np.where(left_mask, line, np.where(right_mask, N_fit*line, 0.0))
 
         return fitter
 
@@ -135,12 +427,10 @@ class AbsorptionEdgeFitter:
         center_spectrum = spectrum.get_cpy_on_interval(
             EnergyInterval(self.hv_left_right, self.hv_right_left))
 
-        center_spectrum.y *= 0
-
         spectrum_x = np.concatenate(
             (left_spectrum.x, center_spectrum.x, right_spectrum.x))
         spectrum_y = np.concatenate(
-            (left_spectrum.y, center_spectrum.y, right_spectrum.y))
+            (left_spectrum.y, np.zeros(len(center_spectrum.y)), right_spectrum.y))
         spectrum_y_err = np.concatenate(
             (left_spectrum.y_err, center_spectrum.y_err, right_spectrum.y_err))
 
@@ -172,40 +462,148 @@ def get_hardness(continuum_fd: FluxDensity,
                  hv_interval_left: EnergyInterval = EnergyInterval(
                      HV_HARDNESS_LEFT_LEFT, HV_HARDNESS_LEFT_RIGHT),
                  hv_interval_right: EnergyInterval = EnergyInterval(HV_HARDNESS_RIGHT_LEFT, HV_HARDNESS_RIGHT_RIGHT)):
-    continuum_flux_left = continuum_fd.get_cpy_on_interval(
-        hv_interval_left).flux()
-    continuum_flux_right = continuum_fd.get_cpy_on_interval(
-        hv_interval_right).flux()
-    h = continuum_flux_right.value/continuum_flux_left.value
-    h_err = h * \
-        product_transport_err([continuum_flux_left, continuum_flux_right])
+    continuum_flux_left = UncertainArray.build_uncertain_array(
+        [continuum_fd.flux(hv_interval_left)])
+    continuum_flux_right = UncertainArray.build_uncertain_array(
+        [continuum_fd.flux(hv_interval_right)])
 
-    return ValueAndError(h, h_err)
+    return (continuum_flux_right/continuum_flux_left)[0].to_value_and_error()
 
 
 def get_ew(fekalpha_fd: FluxDensity, continuum_fd: FluxDensity):
-    fekalpha_flux = fekalpha_fd.flux()
+    fekalpha_flux = UncertainArray.build_uncertain_array(
+        [fekalpha_fd.flux()])
 
-    continuum_at_fekalpha = continuum_fd.average(EnergyInterval(
-        HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT))
+    continuum_at_fekalpha = UncertainArray.build_uncertain_array([continuum_fd.average(EnergyInterval(
+        HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT))])
 
-    ew = fekalpha_flux.value / continuum_at_fekalpha.value
-    ew_err = ew*product_transport_err([fekalpha_flux, continuum_at_fekalpha])
-
-    return ValueAndError(ew, ew_err)
+    return (fekalpha_flux/continuum_at_fekalpha)[0].to_value_and_error()
 
 
 def get_fekalpha_compton_shoulder(fekalpha_fd: FluxDensity) -> ValueAndError:
-    fekalpha_line_shoulder = fekalpha_fd.get_cpy_on_interval(
-        EnergyInterval(left=HV_LEFT, right=HV_FEKALPHA_SHOULDER_RIGHT))
+    shoulder_flux = UncertainArray.build_uncertain_array([fekalpha_fd.flux(
+        EnergyInterval(left=HV_LEFT, right=HV_FEKALPHA_SHOULDER_RIGHT))])
+    line_flux = UncertainArray.build_uncertain_array([fekalpha_fd.flux()])
+
+    return (shoulder_flux/line_flux)[0].to_value_and_error()
+
+
+BOOTSTRAP_REPLICAS = 1000
+"""Number of Poisson replicas of the spectra in the bootstrap mode.
+"""
+
+BOOTSTRAP_CONFIDENCE = 0.6827
+"""Probability inside the bootstrap percentile intervals (1 sigma).
+"""
+
+BOOTSTRAP_CHUNK_SIZE = 100
+"""Number of replicas drawn at once, it bounds the memory of the bootstrap.
+"""
+
+
+@dataclass
+class BootstrapEstimate(ValueAndError):
+    """
+    A measurement with its bootstrap percentile interval [low, high],
+    err is the half width of the interval.
+    """
+
+    low: float
+    high: float
+
+
+def _build_bootstrap_estimate(value: float, replicas: np.ndarray, confidence: float) -> BootstrapEstimate:
+    replicas = replicas[np.isfinite(replicas)]
+
+    if len(replicas) == 0:
+        return BootstrapEstimate(value=value, err=np.nan, low=np.nan, high=np.nan)
+
+    low, high = np.percentile(
+        replicas, [50*(1-confidence), 50*(1+confidence)])
+
+    return BootstrapEstimate(value=value, err=(high-low)/2, low=low, high=high)
+
+
+def bootstrap_window_sums(spectrum: SpectrumBase, weights: np.ndarray, n_replicas: int,
+                          rng: np.random.Generator, chunk_size: int = BOOTSTRAP_CHUNK_SIZE) -> np.ndarray:
+    """Evaluates the weighted sums weights @ y (see area_weights(), average_weights()) on
+    n_replicas Poisson replicas of the spectrum.
+
+    Every bin of the spectrum is taken as n = (y/y_err)^2 effective counts of weight y/n
+    (exact for counts, and for flux densities built from counts), and a replica draws
+    Poisson(n) counts per bin. Only the bins used by the weights are drawn, the bins
+    without counts (y_err == 0) are constant.
+
+    Args:
+        spectrum (SpectrumBase): the spectrum
+        weights (np.ndarray): (m, bins) weights of the m sums
+        n_replicas (int): number of replicas
+        rng (np.random.Generator): the random generator
+        chunk_size (int, optional): replicas drawn at once. Defaults to BOOTSTRAP_CHUNK_SIZE.
+
+    Returns:
+        np.ndarray: (n_replicas, m) sums
+    """
+    y = np.asarray(spectrum.y, dtype=float)
+    y_err = np.asarray(spectrum.y_err, dtype=float)
+    weights = np.atleast_2d(weights)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_eff = np.where(y_err > 0, (y/y_err)**2, 0.0)
+
+    random = np.any(weights != 0, axis=0) & (y > 0) & np.isfinite(n_eff) & (n_eff > 0)
 
-    shoulder_flux = fekalpha_line_shoulder.flux()
-    line_flux = fekalpha_fd.flux()
-    d_compton = shoulder_flux.value/line_flux.value
-    d_compton_err = d_compton * \
-        product_transport_err([shoulder_flux, line_flux])
+    constant = weights[:, ~random] @ y[~random]
+    random_weights = (weights[:, random]*(y[random]/n_eff[random])).T
+    n_eff = n_eff[random]
 
-    return ValueAndError(d_compton, d_compton_err)
+    sums = np.empty((n_replicas, len(weights)))
+    for start in range(0, n_replicas, chunk_size):
+        stop = min(start + chunk_size, n_replicas)
+        sums[start:stop] = rng.poisson(n_eff, size=(stop - start, len(n_eff))) @ random_weights + constant
+
+    return sums
+
+
+def bootstrap_line_and_continuum(fekalpha_fd: FluxDensity, continuum_fd: FluxDensity,
+                                 n_replicas: int = BOOTSTRAP_REPLICAS,
+                                 confidence: float = BOOTSTRAP_CONFIDENCE,
+                                 rng: np.random.Generator = None) -> Tuple[BootstrapEstimate, BootstrapEstimate, BootstrapEstimate]:
+    """Measures the ew, the hardness and the compton shoulder (see measure_line_and_continuum())
+    with bootstrap percentile intervals instead of the first-order propagated errors,
+    evaluating the measurements on all the Poisson replicas of the flux densities at once.
+
+    Args:
+        fekalpha_fd (FluxDensity): the FeKalpha line flux density
+        continuum_fd (FluxDensity): the continuum flux density
+        n_replicas (int, optional): number of replicas. Defaults to BOOTSTRAP_REPLICAS.
+        confidence (float, optional): probability inside the intervals. Defaults to BOOTSTRAP_CONFIDENCE.
+        rng (np.random.Generator, optional): the random generator. Defaults to np.random.default_rng().
+
+    Returns:
+        Tuple[BootstrapEstimate, BootstrapEstimate, BootstrapEstimate]: ew, h, compton_shoulder
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+
+    line, shoulder = bootstrap_window_sums(fekalpha_fd,
+                                           np.stack((fekalpha_fd.area_weights(),
+                                                     fekalpha_fd.area_weights(EnergyInterval(left=HV_LEFT, right=HV_FEKALPHA_SHOULDER_RIGHT)))),
+                                           n_replicas=n_replicas, rng=rng).T
+
+    continuum_at_fekalpha, hard_left, hard_right = bootstrap_window_sums(continuum_fd,
+                                                                         np.stack((continuum_fd.average_weights(EnergyInterval(HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT)),
+                                                                                   continuum_fd.area_weights(EnergyInterval(
+                                                                                       HV_HARDNESS_LEFT_LEFT, HV_HARDNESS_LEFT_RIGHT)),
+                                                                                   continuum_fd.area_weights(EnergyInterval(HV_HARDNESS_RIGHT_LEFT, HV_HARDNESS_RIGHT_RIGHT)))),
+                                                                         n_replicas=n_replicas, rng=rng).T
+
+    ew, h, compton_shoulder = measure_line_and_continuum(fekalpha_fd=fekalpha_fd,
+                                                         continuum_fd=continuum_fd)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (_build_bootstrap_estimate(ew.value, line/continuum_at_fekalpha, confidence),
+                _build_bootstrap_estimate(h.value, hard_right/hard_left, confidence),
+                _build_bootstrap_estimate(compton_shoulder.value, shoulder/line, confidence))
 
 
 def get_edge(continuum_sp: SpectrumCount, fitter: AbsorptionEdgeFitter):
@@ -305,19 +703,32 @@ class SpectralDataFileInfo:
                                     path_to_file=path_to_file)
 
 
-def get_wanted_spectral_data(considered_nh_indexes: List[int], *root_dirs: str) -> Tuple[Dict[str, FluxDensity], Dict[str, SpectrumCount], Dict[str, FluxDensity]]:
-    """Returns the continuum flux density, continuum spectrum and fekalpha fluxdensity maps according to the considered nh indexes.
+def _parse_spectral_data_file_on_grid(path_to_file: str) -> Dict[str, any]:
+    """Returns the x, y, y_err, grid arguments to build the spectrum of
+    the given spectral data file, where grid is the energy grid of the
+    file (or None if it is unknown).
+    """
+    x, y, y_err = parse_spectral_data_files(path_to_file)
+    grid = EnergyGrid.find(x)
+    return dict(x=(x if grid is None else None), y=y, y_err=y_err, grid=grid)
+
+
+def find_wanted_spectral_data_files(considered_nh_indexes: List[int], *root_dirs: str, line_labels: Iterable[str] = ('FeKalpha',)) -> Dict[str, Dict[str, SpectralDataFileInfo]]:
+    """Returns the spectral data files of every measurement key according to the considered nh indexes,
+    without reading them.
 
     Args:
         considered_nh_indexes (List[int]): the considered indexes to get the data
+        line_labels (Iterable[str], optional): the fluorescent lines whose flux densities are wanted,
+            see FLUORESCENT_LINES. Defaults to ('FeKalpha',).
 
     Returns:
-        Tuple[Dict[str, SpectralDataFileInfo], Dict[str, SpectralDataFileInfo], Dict[str, SpectralDataFileInfo]]: continuum_fd_map,continuum_sp_map,fekalpha_fd_map
+        Dict[str, Dict[str, SpectralDataFileInfo]]: key -> input (see MEASUREMENT_INPUTS, FluorescentLineInfo.input_name) -> file info
     """
+    line_input_names = {label: FLUORESCENT_LINES[label].input_name
+                        for label in line_labels}
 
-    continuum_fd_map: Dict[str, FluxDensity] = {}
-    continuum_sp_map: Dict[str, SpectrumCount] = {}
-    fekalpha_fd_map: Dict[str, FluxDensity] = {}
+    spectral_data_files: Dict[str, Dict[str, SpectralDataFileInfo]] = {}
 
     for root_dir in root_dirs:
         print('=====================================')
@@ -334,62 +745,930 @@ def get_wanted_spectral_data(considered_nh_indexes: List[int], *root_dirs: str)
 
                     if spectral_info.type_label == 'CONTINUUM' and spectral_info.file_data_type == 'fluxdensity':
 
-                        continuum_fd_map[f'{spectral_info}'] = FluxDensity(
-                            *parse_spectral_data_files(spectral_info.path_to_file))
+                        spectral_data_files.setdefault(
+                            f'{spectral_info}', {})['continuum_fd'] = spectral_info
 
                     if spectral_info.type_label == 'CONTINUUM' and spectral_info.file_data_type == 'spectrum':
 
-                        continuum_sp_map[f'{spectral_info}'] = SpectrumCount(
-                            *parse_spectral_data_files(spectral_info.path_to_file))
+                        spectral_data_files.setdefault(
+                            f'{spectral_info}', {})['continuum_sp'] = spectral_info
 
-                    if spectral_info.type_label == 'FLUORESCENT' and spectral_info.file_data_type == 'fluxdensity' and spectral_info.line_label == 'FeKalpha':
+                    if spectral_info.type_label == 'FLUORESCENT' and spectral_info.file_data_type == 'fluxdensity' and spectral_info.line_label in line_input_names:
 
-                        fekalpha_fd_map[f'{spectral_info}'] = FluxDensity(
-                            *parse_spectral_data_files(spectral_info.path_to_file))
+                        spectral_data_files.setdefault(
+                            f'{spectral_info}', {})[line_input_names[spectral_info.line_label]] = spectral_info
 
-    return continuum_fd_map, continuum_sp_map, fekalpha_fd_map
+    return spectral_data_files
 
 
-def perform_measurements(considered_nh_indexes: List[int], output_filepath: str, *root_dirs):
+def load_spectral_data(spectral_data_files: Dict[str, Dict[str, SpectralDataFileInfo]]) -> Tuple[Dict[str, FluxDensity], Dict[str, SpectrumCount], Dict[str, FluxDensity]]:
+    """Reads the spectral data files found by find_wanted_spectral_data_files().
+
+    Returns:
+        Tuple[Dict[str, FluxDensity], Dict[str, SpectrumCount], Dict[str, FluxDensity]]: continuum_fd_map,continuum_sp_map,fekalpha_fd_map
+    """
+    maps = load_spectral_inputs(spectral_data_files)
+
+    return maps.get('continuum_fd', {}), maps.get('continuum_sp', {}), maps.get('fekalpha_fd', {})
+
+
+def load_spectral_inputs(spectral_data_files: Dict[str, Dict[str, SpectralDataFileInfo]]) -> Dict[str, Dict[str, SpectrumBase]]:
+    """Reads the spectral data files found by find_wanted_spectral_data_files(), the spectra
+    (continuum_sp) as SpectrumCount and the rest as FluxDensity.
+
+    Returns:
+        Dict[str, Dict[str, SpectrumBase]]: input -> key -> spectrum
+    """
+    maps: Dict[str, Dict[str, SpectrumBase]] = {}
+
+    for key, spectral_infos in spectral_data_files.items():
+        for input_name, spectral_info in spectral_infos.items():
+            spectrum_type = SpectrumCount if spectral_info.file_data_type == 'spectrum' else FluxDensity
+            maps.setdefault(input_name, {})[key] = spectrum_type(
+                **_parse_spectral_data_file_on_grid(spectral_info.path_to_file))
+
+    return maps
+
+
+def get_wanted_spectral_data(considered_nh_indexes: List[int], *root_dirs: str) -> Tuple[Dict[str, FluxDensity], Dict[str, SpectrumCount], Dict[str, FluxDensity]]:
+    """Returns the continuum flux density, continuum spectrum and fekalpha fluxdensity maps according to the considered nh indexes.
+
+    Args:
+        considered_nh_indexes (List[int]): the considered indexes to get the data
+
+    Returns:
+        Tuple[Dict[str, SpectralDataFileInfo], Dict[str, SpectralDataFileInfo], Dict[str, SpectralDataFileInfo]]: continuum_fd_map,continuum_sp_map,fekalpha_fd_map
+    """
+    return load_spectral_data(find_wanted_spectral_data_files(considered_nh_indexes, *root_dirs))
+
+
+@dataclass
+class MeasurementFailure:
+    """
+    This class represents a measurement that could not be done.
+    """
+
+    key: str
+    """the measurement key, for example: 523_5_1xfe_7590_27
+    """
+
+    stage: str
+    """for example: ew/h/shoulder/edge
+    """
+
+    message: str
+
+    def __str__(self):
+        return f'{self.key}#{self.stage}: {self.message}'
+
+
+def measure_line_and_continuum(fekalpha_fd: FluxDensity, continuum_fd: FluxDensity) -> Tuple[ValueAndError, ValueAndError, ValueAndError]:
+    """Measures the ew, the hardness and the compton shoulder of a measurement key.
+
+    Args:
+        fekalpha_fd (FluxDensity): the FeKalpha line flux density
+        continuum_fd (FluxDensity): the continuum flux density
+
+    Returns:
+        Tuple[ValueAndError, ValueAndError, ValueAndError]: ew, h, compton_shoulder
+    """
+    ew = get_ew(fekalpha_fd=fekalpha_fd, continuum_fd=continuum_fd)
+    h = get_hardness(continuum_fd=continuum_fd)
+    compton_shoulder = get_fekalpha_compton_shoulder(fekalpha_fd=fekalpha_fd)
+
+    return ew, h, compton_shoulder
+
+
+def _measure_key(key: str, fekalpha_fd: FluxDensity, continuum_fd: FluxDensity, bootstrap_replicas: int) -> Tuple[ValueAndError, ValueAndError, ValueAndError]:
+    """Measures a key with propagated errors, or with bootstrap intervals if bootstrap_replicas > 0.
+    The random generator is seeded from the key, so the intervals don't depend on the order
+    of the keys nor on the number of workers.
+    """
+    if bootstrap_replicas > 0:
+        return bootstrap_line_and_continuum(fekalpha_fd=fekalpha_fd, continuum_fd=continuum_fd,
+                                            n_replicas=bootstrap_replicas,
+                                            rng=np.random.default_rng(zlib.crc32(key.encode())))
+
+    return measure_line_and_continuum(fekalpha_fd=fekalpha_fd, continuum_fd=continuum_fd)
+
+
+def measure_line_and_continuum_batch(fekalpha_fds: List[FluxDensity], continuum_fds: List[FluxDensity]) -> Tuple[UncertainArray, UncertainArray, UncertainArray]:
+    """Measures the ew, the hardness and the compton shoulder (see measure_line_and_continuum())
+    of many keys at once: every window flux of every key is a product with the window weights,
+    see window_sums().
+
+    For example:
+
+        ew, h, shoulder = measure_line_and_continuum_batch(
+            [fekalpha_fd_map[key] for key in keys], [continuum_fd_map[key] for key in keys])
+
+        print(ew.value, ew.err, (h/ew).log10().value)
+
+    Args:
+        fekalpha_fds (List[FluxDensity]): the FeKalpha line flux densities
+        continuum_fds (List[FluxDensity]): the continuum flux densities, in the same order
+
+    Raises:
+        ValueError: if the flux densities are not on the same energy bins.
+
+    Returns:
+        Tuple[UncertainArray, UncertainArray, UncertainArray]: ew, h, compton_shoulder, one element per key
+    """
+    first = fekalpha_fds[0]
+
+    if not all(first.same_grid(fd) for fd in list(fekalpha_fds) + list(continuum_fds)):
+        raise ValueError(
+            'the flux densities must be on the same energy bins to be measured at once')
+
+    shoulder_interval = EnergyInterval(
+        left=HV_LEFT, right=HV_FEKALPHA_SHOULDER_RIGHT)
+    continuum_at_fekalpha_interval = EnergyInterval(
+        HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT)
+    hardness_left_interval = EnergyInterval(
+        HV_HARDNESS_LEFT_LEFT, HV_HARDNESS_LEFT_RIGHT)
+    hardness_right_interval = EnergyInterval(
+        HV_HARDNESS_RIGHT_LEFT, HV_HARDNESS_RIGHT_RIGHT)
+
+    line_flux, shoulder_flux = window_sums(fekalpha_fds,
+                                            weights=[first.area_weights(), first.area_weights(shoulder_interval)],
+                                            err_weights=[first.flux_err_weights(), first.flux_err_weights(shoulder_interval)])
+
+    continuum_at_fekalpha, continuum_flux_left, continuum_flux_right = window_sums(continuum_fds,
+                                                                                   weights=[first.average_weights(continuum_at_fekalpha_interval),
+                                                                                            first.area_weights(
+                                                                                                hardness_left_interval),
+                                                                                            first.area_weights(hardness_right_interval)],
+                                                                                   err_weights=[first.average_weights(continuum_at_fekalpha_interval),
+                                                                                                first.flux_err_weights(
+                                                                                                    hardness_left_interval),
+                                                                                                first.flux_err_weights(hardness_right_interval)])
+
+    return (line_flux/continuum_at_fekalpha,
+            continuum_flux_right/continuum_flux_left,
+            shoulder_flux/line_flux)
+
+
+_MEASUREMENT_ARRAYS = ('fekalpha_y', 'fekalpha_y_err',
+                       'continuum_y', 'continuum_y_err', 'x')
+"""The memory-mapped arrays shared with the measurement workers.
+"""
+
+_worker_measurement_data: Dict[str, any] = {}
+
+
+def _write_measurement_arrays(arrays_dir: str, keys: List[str],
+                              fekalpha_fd_map: Dict[str, FluxDensity],
+                              continuum_fd_map: Dict[str, FluxDensity]) -> Dict[str, any]:
+    """Stores the flux densities of the keys into .npy files (one row per key),
+    so the workers memory-map them instead of receiving pickled spectra.
+    """
+    first = fekalpha_fd_map[keys[0]]
+    spectra = [fekalpha_fd_map[key] for key in keys] + \
+        [continuum_fd_map[key] for key in keys]
+
+    if not all(first.same_grid(spectrum) for spectrum in spectra):
+        raise ValueError(
+            'the flux densities must be on the same energy bins to be measured in parallel')
+
+    columns = {'fekalpha_y': [fekalpha_fd_map[key].y for key in keys],
+               'fekalpha_y_err': [fekalpha_fd_map[key].y_err for key in keys],
+               'continuum_y': [continuum_fd_map[key].y for key in keys],
+               'continuum_y_err': [continuum_fd_map[key].y_err for key in keys]}
+
+    for label, rows in columns.items():
+        array = np.lib.format.open_memmap(path.join(arrays_dir, f'{label}.npy'), mode='w+',
+                                          dtype=float, shape=(len(keys), len(first)))
+        for i, row in enumerate(rows):
+            array[i] = row
+        array.flush()
+        del array
+
+    np.save(path.join(arrays_dir, 'x.npy'), np.asarray(first.x, dtype=float))
+
+    grid = first.grid
+    return dict(arrays_dir=arrays_dir,
+                keys=keys,
+                grid=None if grid is None else (
+                    grid.left, grid.right, grid.n_intervals),
+                grid_offset=first.grid_offset)
+
+
+def _init_measurement_worker(shared: Dict[str, any]):
+    _worker_measurement_data.clear()
+    _worker_measurement_data.update({label: np.load(path.join(shared['arrays_dir'], f'{label}.npy'), mmap_mode='r')
+                                     for label in _MEASUREMENT_ARRAYS})
+    _worker_measurement_data['grid'] = None if shared['grid'] is None else EnergyGrid.build(
+        *shared['grid'])
+    _worker_measurement_data['grid_offset'] = shared['grid_offset']
+    _worker_measurement_data['keys'] = shared['keys']
+    _worker_measurement_data['bootstrap_replicas'] = shared['bootstrap_replicas']
+
+
+def _measure_rows(rows: List[int]) -> List[Tuple[int, Tuple[ValueAndError, ...], str]]:
+    data = _worker_measurement_data
+    grid = data['grid']
+    x = None if grid is not None else np.array(data['x'])
+
+    results = []
+    for row in rows:
+        try:
+            fekalpha_fd = FluxDensity(x=x, y=np.array(data['fekalpha_y'][row]), y_err=np.array(data['fekalpha_y_err'][row]),
+                                      grid=grid, grid_offset=data['grid_offset'])
+            continuum_fd = FluxDensity(x=x, y=np.array(data['continuum_y'][row]), y_err=np.array(data['continuum_y_err'][row]),
+                                       grid=grid, grid_offset=data['grid_offset'])
+            results.append((row, _measure_key(data['keys'][row], fekalpha_fd=fekalpha_fd, continuum_fd=continuum_fd,
+                                              bootstrap_replicas=data['bootstrap_replicas']), ''))
+        except Exception as e:
+            results.append((row, None, f'{e!r}'))
+
+    return results
+
+
+def _measure_keys_in_parallel(keys: List[str],
+                              fekalpha_fd_map: Dict[str, FluxDensity],
+                              continuum_fd_map: Dict[str, FluxDensity],
+                              n_workers: int,
+                              bootstrap_replicas: int = 0,
+                              rows_per_task: int = 16) -> List[Tuple[int, Tuple[ValueAndError, ...], str]]:
+    with TemporaryDirectory() as arrays_dir:
+        shared = _write_measurement_arrays(arrays_dir=arrays_dir, keys=keys,
+                                           fekalpha_fd_map=fekalpha_fd_map,
+                                           continuum_fd_map=continuum_fd_map)
+        shared['bootstrap_replicas'] = bootstrap_replicas
+
+        tasks = [list(range(i, min(i+rows_per_task, len(keys))))
+                 for i in range(0, len(keys), rows_per_task)]
+
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_measurement_worker, initargs=(shared,)) as executor:
+            return [result for results in executor.map(_measure_rows, tasks) for result in results]
+
+
+def _measure_keys_serially(keys: List[str],
+                           fekalpha_fd_map: Dict[str, FluxDensity],
+                           continuum_fd_map: Dict[str, FluxDensity],
+                           bootstrap_replicas: int = 0) -> List[Tuple[int, Tuple[ValueAndError, ...], str]]:
+    results = []
+    for row, key in enumerate(keys):
+        try:
+            results.append((row, _measure_key(key, fekalpha_fd=fekalpha_fd_map[key], continuum_fd=continuum_fd_map[key],
+                                              bootstrap_replicas=bootstrap_replicas), ''))
+        except Exception as e:
+            results.append((row, None, f'{e!r}'))
+    return results
+
+
+def get_measurement_parameters_digest(bootstrap_replicas: int = 0) -> str:
+    """Returns the digest of what the measurements depend on besides their inputs: the
+    HV_* windows, the edge fit and the error mode (propagated, or the bootstrap replicas
+    and confidence).
+    """
+    parameters = {**{name: getattr(agn_processing_policy, name) for name in dir(agn_processing_policy) if name.startswith('HV_')},
+                  'EDGE_FIT_N_GRID_POINTS': EDGE_FIT_N_GRID_POINTS,
+                  'EDGE_FIT_GOLDEN_ITERATIONS': EDGE_FIT_GOLDEN_ITERATIONS,
+                  'errors': {'bootstrap_replicas': bootstrap_replicas, 'BOOTSTRAP_CONFIDENCE': BOOTSTRAP_CONFIDENCE}
+                  if bootstrap_replicas > 0 else 'propagated'}
+
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+def _get_reusable_measurements(output_filepath: str, fingerprints: Dict[str, InputFingerprint], parameters_digest: str) -> Dict[str, tuple]:
+    """Returns the stored rows (see measurement_row()) of the keys whose inputs didn't change
+    and that were measured with the same parameters (see get_measurement_parameters_digest()).
+    """
+    if not path.exists(output_filepath):
+        return {}
+
+    stored_fingerprints = load_measurement_input_fingerprints(output_filepath)
+    stored_digests = load_measurement_parameters_digests(output_filepath)
+
+    reusable_rows: Dict[str, tuple] = {}
+    for row in load_measurements_table(output_filepath, mmap=False):
+        label = get_measurement_label(row)
+        if stored_digests.get(label) != parameters_digest:
+            continue
+        if label in fingerprints and stored_fingerprints.get(label) == fingerprints[label]:
+            reusable_rows[label] = row.item()
+
+    return reusable_rows
+
+
+@dataclass(frozen=True)
+class MeasurementWindows:
+    """
+    The energy windows of the measurements, the defaults are the ones of agn_processing_policy.
+
+    For example:
+
+        windows = replace(MeasurementWindows.build_default_windows(),
+                          continuum_at_fekalpha=EnergyInterval(6200, 6600))
+    """
+
+    continuum_at_fekalpha: EnergyInterval
+    """where the continuum at FeKalpha is averaged (ew)
+    """
+
+    hardness_left: EnergyInterval
+    hardness_right: EnergyInterval
+
+    shoulder: EnergyInterval
+    """the compton shoulder of the FeKalpha line
+    """
+
+    absorption_left: EnergyInterval
+    """the left region of the absorption edge fit
+    """
+
+    absorption_right: EnergyInterval
+    """the right region of the absorption edge fit
+    """
+
+    @staticmethod
+    def build_default_windows():
+        return MeasurementWindows(continuum_at_fekalpha=EnergyInterval(HV_CONTINUUM_AT_FEKALPHA_LEFT, HV_CONTINUUM_AT_FEKALPHA_RIGHT),
+                                  hardness_left=EnergyInterval(
+                                      HV_HARDNESS_LEFT_LEFT, HV_HARDNESS_LEFT_RIGHT),
+                                  hardness_right=EnergyInterval(
+                                      HV_HARDNESS_RIGHT_LEFT, HV_HARDNESS_RIGHT_RIGHT),
+                                  shoulder=EnergyInterval(
+                                      left=HV_LEFT, right=HV_FEKALPHA_SHOULDER_RIGHT),
+                                  absorption_left=EnergyInterval(HV_FEKALPHA_ABSORPTION_LEFT_LEFT,
+                                                                 compton_shift(HV_FEKALPHA_ABSORPTION_EDGE)),
+                                  absorption_right=EnergyInterval(HV_FEKALPHA_ABSORPTION_RIGHT_LEFT,
+                                                                  HV_FEKALPHA_ABSORPTION_RIGHT_RIGHT))
+
+    def build_edge_fitter(self) -> AbsorptionEdgeFitter:
+        return AbsorptionEdgeFitter(
+            hv_left_left=self.absorption_left.left,
+            hv_left_right=self.absorption_left.right,
+            hv_right_left=self.absorption_right.left,
+            hv_right_right=self.absorption_right.right)
+
+
+def _build_edge_fitter() -> AbsorptionEdgeFitter:
+    return MeasurementWindows.build_default_windows().build_edge_fitter()
+
+
+def perform_measurements(considered_nh_indexes: List[int], output_filepath: str, *root_dirs, n_workers: int = 1, incremental: bool = True,
+                         bootstrap_replicas: int = 0) -> List[MeasurementFailure]:
     """This function takes the spectrum and flux densities in spectral_data directories and
     measures ew, h, shoulder, edge, with their corresponding errors. The data will be stored
-    in the given file.
+    in the given file, one row per key in the sorted order of the keys, thus the output
+    doesn't depend on the number of workers.
+
+    If the output file ends with MEASUREMENTS_TABLE_SUFFIX (.npy), the measurements are stored as a
+    table (see measurement_table_utils), else as the old text lines key#ew:err h:err shoulder:err edge:err:chi2:dof.
+
+    The keys that could not be measured are not stored, they are reported in the returned
+    list and in the file {output_filepath}.failures (only if there are failures).
+
+    The (path, size, mtime) of the three input files of every stored key, and the digest of the
+    measurement parameters (see get_measurement_parameters_digest()), are kept in
+    {output_filepath}.inputs.npy. In an incremental run, the stored measurements of the keys
+    whose inputs and parameters didn't change are reused, only the new or changed keys are read and measured,
+    and the keys that don't exist anymore are dropped.
+
+    With bootstrap_replicas > 0, the errors of ew, h and shoulder are the half widths of their
+    bootstrap percentile intervals (see bootstrap_line_and_continuum()), and the intervals are
+    stored in the table columns {ew,h,shoulder}_{low,high}.
 
     Args:
         considered_nh_indexes (List[int]): Indexes from the NH grid
-        output_filepath (str): where to store the measurements
+        output_filepath (str): where to store the measurements (a table or a text file)
+        n_workers (int, optional): number of processes, the flux densities are shared with them
+            through memory-mapped files. Defaults to 1 (no extra processes).
+        incremental (bool, optional): reuse the stored measurements of the unchanged keys. Defaults to True.
+        bootstrap_replicas (int, optional): number of Poisson replicas of the bootstrap. Defaults to 0 (propagated errors).
+
+    Returns:
+        List[MeasurementFailure]: the measurements that could not be done
     """
 
-    continuum_fd_map, continuum_sp_map, fekalpha_fd_map = get_wanted_spectral_data(considered_nh_indexes,
-                                                                                   *root_dirs)
+    spectral_data_files = find_wanted_spectral_data_files(considered_nh_indexes,
+                                                          *root_dirs)
+
+    fingerprints = {key: get_input_fingerprint(*[spectral_infos[input_name].path_to_file for input_name in MEASUREMENT_INPUTS])
+                    for key, spectral_infos in spectral_data_files.items()
+                    if all(input_name in spectral_infos for input_name in MEASUREMENT_INPUTS)}
+
+    parameters_digest = get_measurement_parameters_digest(bootstrap_replicas)
+
+    reused_rows = _get_reusable_measurements(output_filepath, fingerprints,
+                                             parameters_digest=parameters_digest) if incremental else {}
 
-    fitter = AbsorptionEdgeFitter(
-        hv_left_left=HV_FEKALPHA_ABSORPTION_LEFT_LEFT,
-        hv_left_right=compton_shift(HV_FEKALPHA_ABSORPTION_EDGE),
-        hv_right_left=HV_FEKALPHA_ABSORPTION_RIGHT_LEFT,
-        hv_right_right=HV_FEKALPHA_ABSORPTION_RIGHT_RIGHT)
+    print(f'measurements: {len(reused_rows)} key(s) reused, '
+          f'{len(spectral_data_files) - len(reused_rows)} key(s) to be measured')
 
-    with open(output_filepath, 'w') as measurements_file:
-        for fekalpha_line_key in fekalpha_fd_map:
+    continuum_fd_map, continuum_sp_map, fekalpha_fd_map = load_spectral_data({key: spectral_infos for key, spectral_infos in spectral_data_files.items()
+                                                                              if key not in reused_rows})
 
-            fekalpha_fd = fekalpha_fd_map[fekalpha_line_key]
-            continuum_fd = continuum_fd_map[fekalpha_line_key]
-            continuum_sp = continuum_sp_map[fekalpha_line_key]
+    fitter = _build_edge_fitter()
 
-            ew = get_ew(fekalpha_fd=fekalpha_fd, continuum_fd=continuum_fd)
-            h = get_hardness(continuum_fd=continuum_fd)
-            compton_shoulder = get_fekalpha_compton_shoulder(
-                fekalpha_fd=fekalpha_fd)
-            try:
-                edge, chi2_, dof = get_edge(
-                    continuum_sp=continuum_sp, fitter=fitter)
-            except ValueError as e:
-                print(
-                    f'error while fitting the absorption edge({fekalpha_line_key}): {e}')
-                continue
+    failures: List[MeasurementFailure] = []
 
-            measurements_file.write(
-                f'{fekalpha_line_key}#{ew.value}:{ew.err}   {h.value}:{h.err}    {compton_shoulder.value}:{compton_shoulder.err}    {edge.value}:{edge.err}:{chi2_}:{dof}\n')
+    fekalpha_line_keys = []
+    for key in sorted(fekalpha_fd_map):
+        if key in continuum_fd_map and key in continuum_sp_map:
+            fekalpha_line_keys.append(key)
+        else:
+            failures.append(MeasurementFailure(
+                key=key, stage='data', message='there is no continuum for this key'))
+
+    edges = fitter.fit_spectra(
+        [continuum_sp_map[key] for key in fekalpha_line_keys]) if fekalpha_line_keys else None
+
+    if not fekalpha_line_keys:
+        results = []
+    elif n_workers is not None and n_workers > 1:
+        results = _measure_keys_in_parallel(keys=fekalpha_line_keys,
+                                            fekalpha_fd_map=fekalpha_fd_map,
+                                            continuum_fd_map=continuum_fd_map,
+                                            n_workers=n_workers,
+                                            bootstrap_replicas=bootstrap_replicas)
+    else:
+        results = _measure_keys_serially(keys=fekalpha_line_keys,
+                                         fekalpha_fd_map=fekalpha_fd_map,
+                                         continuum_fd_map=continuum_fd_map,
+                                         bootstrap_replicas=bootstrap_replicas)
+
+    table_rows = dict(reused_rows)
+    for row, measurements, error in sorted(results, key=lambda result: result[0]):
+        fekalpha_line_key = fekalpha_line_keys[row]
+
+        if measurements is None:
+            failures.append(MeasurementFailure(
+                key=fekalpha_line_key, stage='ew/h/shoulder', message=error))
+            continue
+
+        if not edges.valid[row]:
+            failures.append(MeasurementFailure(
+                key=fekalpha_line_key, stage='edge', message='the absorption edge fit is undetermined'))
+            continue
+
+        ew, h, compton_shoulder = measurements
+        edge, chi2_, dof = edges.get_edge(row)
+
+        table_rows[fekalpha_line_key] = measurement_row(label=fekalpha_line_key,
+                                                        ew=(ew.value, ew.err),
+                                                        h=(h.value, h.err),
+                                                        shoulder=(compton_shoulder.value,
+                                                                  compton_shoulder.err),
+                                                        edge=(edge.value, edge.err),
+                                                        edge_chi2=chi2_,
+                                                        edge_dof=dof,
+                                                        intervals={name: (measurement.low, measurement.high)
+                                                                   for name, measurement in zip(MEASUREMENT_INTERVAL_FIELDS, measurements)
+                                                                   if isinstance(measurement, BootstrapEstimate)})
+
+    table = build_measurements_table(
+        table_rows[key] for key in sorted(table_rows))
+
+    if is_measurements_table(output_filepath):
+        write_measurements_table(output_filepath, table)
+    else:
+        write_measurements_text(output_filepath, table)
+
+    write_measurement_input_fingerprints(output_filepath,
+                                         {key: fingerprints[key] for key in table_rows},
+                                         parameters_digest=parameters_digest)
+
+    failures_filepath = f'{output_filepath}.failures'
+    if failures:
+        with open(failures_filepath, 'w') as failures_file:
+            failures_file.writelines(
+                f'{failure}\n' for failure in failures)
+    elif path.exists(failures_filepath):
+        os.remove(failures_filepath)
+
+    return failures
+
+
+def perform_line_measurements(considered_nh_indexes: List[int], output_filepath: str, *root_dirs: str,
+                              lines: Dict[str, FluorescentLineInfo] = FLUORESCENT_LINES) -> Dict[str, int]:
+    """Measures the flux, ew and shoulder of every registered fluorescent line (see fluorescent_line_utils)
+    of every key, and stores them as a table (see LINE_MEASUREMENTS_DTYPE), one row per key and line,
+    sorted by key and line.
+
+    The keys are read a combination (see get_combination_label()) at a time, and the lines available
+    for the same keys are measured together (see measure_fluorescent_lines()). The lines without
+    spectral data for a key are left out.
+
+    Args:
+        considered_nh_indexes (List[int]): Indexes from the NH grid
+        output_filepath (str): where to store the table
+        lines (Dict[str, FluorescentLineInfo], optional): the registry. Defaults to FLUORESCENT_LINES.
+
+    Returns:
+        Dict[str, int]: line label -> number of measured keys
+    """
+    spectral_data_files = find_wanted_spectral_data_files(considered_nh_indexes, *root_dirs,
+                                                          line_labels=list(lines))
+
+    combinations: Dict[str, List[str]] = {}
+    for key in sorted(spectral_data_files):
+        if 'continuum_fd' in spectral_data_files[key]:
+            combinations.setdefault(get_combination_label(key), []).append(key)
+
+    rows: Dict[Tuple[str, str], tuple] = {}
+    measured_keys = {label: 0 for label in lines}
+    for combination_keys in combinations.values():
+        maps = load_spectral_inputs({key: {input_name: spectral_info for input_name, spectral_info in spectral_data_files[key].items()
+                                           if input_name != 'continuum_sp'}
+                                     for key in combination_keys})
+
+        line_groups: Dict[Tuple[str, ...], List[str]] = {}
+        for label, line in lines.items():
+            keys = tuple(key for key in combination_keys
+                         if key in maps.get(line.input_name, {}))
+            if keys:
+                line_groups.setdefault(keys, []).append(label)
+
+        for keys, labels in line_groups.items():
+            measurements = measure_fluorescent_lines(line_fds={label: [maps[lines[label].input_name][key] for key in keys]
+                                                               for label in labels},
+                                                     continuum_fds=[
+                                                         maps['continuum_fd'][key] for key in keys],
+                                                     lines=lines)
+
+            for label in labels:
+                line_measurements = measurements[label]
+                measured_keys[label] += len(keys)
+                for row, key in enumerate(keys):
+                    rows[(key, label)] = line_measurement_row(label=key,
+                                                              line=label,
+                                                              flux=(line_measurements.flux.value[row],
+                                                                    line_measurements.flux.err[row]),
+                                                              ew=(line_measurements.ew.value[row],
+                                                                  line_measurements.ew.err[row]),
+                                                              shoulder=(line_measurements.shoulder.value[row],
+                                                                        line_measurements.shoulder.err[row]))
+
+    write_line_measurements_table(output_filepath,
+                                  [rows[key_and_line] for key_and_line in sorted(rows)])
+
+    return measured_keys
+
+
+MIN_NH_BIN_COUNTS = 100
+"""The NH bins whose continuum spectrum has fewer counts are masked by measure_nh_bins().
+"""
+
+
+@dataclass
+class NHBinsMeasurements:
+    """
+    The measurements of all the NH bins of a combination (nh_aver, n_aver, a_fe, alpha),
+    one element per bin, in the order of the NH grid. The masked bins are nan.
+
+    For example:
+
+        measurements = measure_all_nh_bins(*root_dirs)['523_5_1xfe_7590']
+
+        nh = DEFAULT_NH_GRID.nh_list
+
+        plt.errorbar(np.array(nh)[measurements.nh_indexes[measurements.valid]],
+                     measurements.ew.value[measurements.valid], measurements.ew.err[measurements.valid])
+    """
+
+    combination: str
+    """for example: 523_5_1xfe_7590
+    """
+
+    nh_indexes: np.ndarray
+
+    ew: UncertainArray
+    h: UncertainArray
+    shoulder: UncertainArray
+    edge: UncertainArray
+
+    edge_chi2: np.ndarray
+    edge_dof: np.ndarray
+
+    valid: np.ndarray
+    """False for the masked bins: too few counts, or undetermined measurements
+    """
+
+    def __len__(self) -> int:
+        return len(self.nh_indexes)
+
+    def get_label(self, row: int) -> str:
+        return f'{self.combination}_{self.nh_indexes[row]}'
+
+
+def measure_nh_bins(combination: str, nh_indexes: List[int],
+                    fekalpha_fds: List[FluxDensity], continuum_fds: List[FluxDensity], continuum_sps: List[SpectrumCount],
+                    fitter: AbsorptionEdgeFitter = None, min_counts: float = MIN_NH_BIN_COUNTS) -> NHBinsMeasurements:
+    """Measures the ew, h, shoulder and edge of all the NH bins of a combination in one pass:
+    see measure_line_and_continuum_batch() and AbsorptionEdgeFitter.fit_spectra().
+
+    The bins with fewer than min_counts continuum counts, or whose measurements are
+    undetermined (no line, empty windows, failed edge fit), are masked instead of raising.
+
+    Args:
+        combination (str): the combination label, for example 523_5_1xfe_7590
+        nh_indexes (List[int]): the NH grid indexes of the bins
+        fekalpha_fds (List[FluxDensity]): the FeKalpha line flux densities, one per bin
+        continuum_fds (List[FluxDensity]): the continuum flux densities, one per bin
+        continuum_sps (List[SpectrumCount]): the continuum spectra, one per bin
+        fitter (AbsorptionEdgeFitter, optional): the edge fitter. Defaults to the one of perform_measurements().
+        min_counts (float, optional): the minimum continuum counts of a bin. Defaults to MIN_NH_BIN_COUNTS.
+
+    Returns:
+        NHBinsMeasurements: the measurements of the bins
+    """
+    fitter = fitter if fitter is not None else _build_edge_fitter()
+
+    ew, h, shoulder = measure_line_and_continuum_batch(fekalpha_fds=fekalpha_fds,
+                                                       continuum_fds=continuum_fds)
+    edges = fitter.fit_spectra(continuum_sps)
+
+    counts = np.array([np.sum(spectrum.y) for spectrum in continuum_sps])
+
+    valid = (counts >= min_counts) & edges.valid
+    for measurement in (ew, h, shoulder):
+        valid &= np.isfinite(measurement.value) & np.isfinite(measurement.err)
+    valid &= ew.value > 0
+
+    def masked(measurement: UncertainArray) -> UncertainArray:
+        return UncertainArray(value=np.where(valid, measurement.value, np.nan),
+                              err=np.where(valid, measurement.err, np.nan))
+
+    return NHBinsMeasurements(combination=combination,
+                              nh_indexes=np.asarray(nh_indexes, dtype=int),
+                              ew=masked(ew),
+                              h=masked(h),
+                              shoulder=masked(shoulder),
+                              edge=masked(UncertainArray(
+                                  value=edges.N_edge, err=edges.N_edge_err)),
+                              edge_chi2=np.where(valid, edges.chi2, np.nan),
+                              edge_dof=edges.dof,
+                              valid=valid)
+
+
+def get_combination_label(key: str) -> str:
+    """Returns the combination of a measurement key: 523_5_1xfe_7590_27 -> 523_5_1xfe_7590
+    """
+    return key.rsplit('_', 1)[0]
+
+
+def measure_all_nh_bins(*root_dirs: str, n_nh_intervals: int = NH_INTERVALS, min_counts: float = MIN_NH_BIN_COUNTS) -> Dict[str, NHBinsMeasurements]:
+    """Measures every NH bin of every combination found in the spectral_data directories,
+    a combination at a time (see measure_nh_bins()). The bins without the three inputs are left out.
+
+    Returns:
+        Dict[str, NHBinsMeasurements]: combination label -> measurements
+    """
+    spectral_data_files = find_wanted_spectral_data_files(list(range(n_nh_intervals)),
+                                                          *root_dirs)
+
+    combinations: Dict[str, List[str]] = {}
+    for key in sorted(spectral_data_files, key=lambda key: (get_combination_label(key), int(key.rsplit('_', 1)[1]))):
+        if all(input_name in spectral_data_files[key] for input_name in MEASUREMENT_INPUTS):
+            combinations.setdefault(get_combination_label(key), []).append(key)
+
+    fitter = _build_edge_fitter()
+
+    measurements: Dict[str, NHBinsMeasurements] = {}
+    for combination, keys in combinations.items():
+        continuum_fd_map, continuum_sp_map, fekalpha_fd_map = load_spectral_data({key: spectral_data_files[key]
+                                                                                  for key in keys})
+
+        measurements[combination] = measure_nh_bins(combination=combination,
+                                                    nh_indexes=[int(key.rsplit('_', 1)[1])
+                                                                for key in keys],
+                                                    fekalpha_fds=[
+                                                        fekalpha_fd_map[key] for key in keys],
+                                                    continuum_fds=[
+                                                        continuum_fd_map[key] for key in keys],
+                                                    continuum_sps=[
+                                                        continuum_sp_map[key] for key in keys],
+                                                    fitter=fitter,
+                                                    min_counts=min_counts)
+
+        print(f'{combination}: {np.count_nonzero(measurements[combination].valid)}/{len(keys)} NH bin(s) measured')
+
+    return measurements
+
+
+def write_nh_bins_measurements(output_filepath: str, measurements: Dict[str, NHBinsMeasurements]):
+    """Stores the measured (not masked) bins as a measurements table (or text file, see perform_measurements()),
+    so they can be queried with measurable_utils.MeasurementTable.
+    """
+    rows = [measurement_row(label=nh_measurements.get_label(row),
+                            ew=(nh_measurements.ew.value[row],
+                                nh_measurements.ew.err[row]),
+                            h=(nh_measurements.h.value[row],
+                               nh_measurements.h.err[row]),
+                            shoulder=(nh_measurements.shoulder.value[row],
+                                      nh_measurements.shoulder.err[row]),
+                            edge=(nh_measurements.edge.value[row],
+                                  nh_measurements.edge.err[row]),
+                            edge_chi2=nh_measurements.edge_chi2[row],
+                            edge_dof=nh_measurements.edge_dof[row])
+            for combination in sorted(measurements)
+            for nh_measurements in [measurements[combination]]
+            for row in np.flatnonzero(nh_measurements.valid)]
+
+    table = build_measurements_table(rows)
+
+    if is_measurements_table(output_filepath):
+        write_measurements_table(output_filepath, table)
+    else:
+        write_measurements_text(output_filepath, table)
+
+
+@dataclass
+class WindowScan:
+    """
+    The measurements of every key for every candidate window (see scan_measurement_windows()),
+    as cubes whose first axis is the key:
+
+        ew:         (keys, continuum_at_fekalpha)
+        h:          (keys, hardness_left, hardness_right)
+        shoulder:   (keys, shoulder)
+        edge:       (keys, absorption)
+
+    For example:
+
+        scan = perform_window_scan(considered_nh_indexes, *root_dirs,
+                                   continuum_at_fekalpha=[EnergyInterval(6400-d, 6400+d) for d in (50, 100, 200)])
+
+        print(scan.relative_spread('ew'))
+    """
+
+    keys: List[str]
+
+    candidates: Dict[str, list]
+    """window name (see MeasurementWindows) -> candidate windows, the absorption candidates
+    are (absorption_left, absorption_right) pairs
+    """
+
+    ew: UncertainArray
+    h: UncertainArray
+    shoulder: UncertainArray
+    edge: UncertainArray
+
+    def relative_spread(self, measurement_name: str) -> np.ndarray:
+        """Returns (max - min)/|median| of the measurement over all the candidate windows, one per key.
+        """
+        values = getattr(self, measurement_name).value.reshape(len(self.keys), -1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (np.nanmax(values, axis=1) - np.nanmin(values, axis=1))/np.abs(np.nanmedian(values, axis=1))
+
+    def save(self, output_filepath: str):
+        """Stores the cubes (values and errors), the keys and the candidate windows bounds into a .npz file.
+        """
+        np.savez(output_filepath,
+                 keys=np.array(self.keys),
+                 **{f'{name}_candidates': np.array([[bound for window in (candidate if isinstance(candidate, tuple) else (candidate,))
+                                                     for bound in (window.left, window.right)]
+                                                    for candidate in candidates])
+                    for name, candidates in self.candidates.items()},
+                 **{f'{name}{suffix}': getattr(getattr(self, name), attribute)
+                    for name in ('ew', 'h', 'shoulder', 'edge')
+                    for suffix, attribute in (('', 'value'), ('_err', 'err'))})
+
+
+def _window_bounds(spectrum: SpectrumBase, energy_intervals: List[EnergyInterval]) -> Tuple[np.ndarray, np.ndarray]:
+    windows = [spectrum.window(energy_interval)
+               for energy_interval in energy_intervals]
+
+    if any(window is None for window in windows):
+        raise ValueError(
+            'the windows of a scan need the energies to be sorted!')
+
+    starts, stops = np.array(windows, dtype=int).reshape(-1, 2).T
+    return starts, stops
+
+
+def _window_fluxes(flux_density: FluxDensity, prefix_sums: SpectrumPrefixSums, starts: np.ndarray, stops: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The vectorized FluxDensity.flux() of the windows x[start:stop], only the areas
+    are vectorized (the error weights depend on the window, see window_flux_err()).
+    """
+    last = len(prefix_sums.area) - 1
+    areas = np.where(stops - starts >= 2,
+                     prefix_sums.area[np.clip(stops - 1, 0, last)] - prefix_sums.area[np.clip(starts, 0, last)], 0.0)
+
+    return areas, np.array([flux_density.window_flux_err(start, stop) for start, stop in zip(starts, stops)])
+
+
+def _window_averages(prefix_sums: SpectrumPrefixSums, starts: np.ndarray, stops: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The vectorized SpectrumBase.average() of the windows x[start:stop].
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = np.where(stops > starts, stops - starts, np.nan)
+        return (prefix_sums.y[stops] - prefix_sums.y[starts])/n, np.sqrt(prefix_sums.y_err2[stops] - prefix_sums.y_err2[starts])/n
+
+
+def scan_measurement_windows(keys: List[str],
+                             fekalpha_fd_map: Dict[str, FluxDensity],
+                             continuum_fd_map: Dict[str, FluxDensity],
+                             continuum_sp_map: Dict[str, SpectrumCount],
+                             continuum_at_fekalpha: List[EnergyInterval] = None,
+                             hardness_left: List[EnergyInterval] = None,
+                             hardness_right: List[EnergyInterval] = None,
+                             shoulder: List[EnergyInterval] = None,
+                             absorption: List[Tuple[EnergyInterval, EnergyInterval]] = None) -> WindowScan:
+    """Measures the ew, h, shoulder and edge of the keys for every candidate window
+    (the windows without candidates are the default ones, see MeasurementWindows).
+
+    The cumulative sums of every flux density are built once (see SpectrumPrefixSums), so every
+    window of ew, h and shoulder is two lookups per key. Every absorption candidate is one batch
+    fit of all the keys (see AbsorptionEdgeFitter.fit_spectra()).
+
+    Args:
+        keys (List[str]): the keys to measure
+        fekalpha_fd_map (Dict[str, FluxDensity]): the FeKalpha line flux densities, on a grid
+        continuum_fd_map (Dict[str, FluxDensity]): the continuum flux densities, on a grid
+        continuum_sp_map (Dict[str, SpectrumCount]): the continuum spectra
+        continuum_at_fekalpha (List[EnergyInterval], optional): candidate windows. Defaults to the default window.
+        hardness_left (List[EnergyInterval], optional): candidate windows. Defaults to the default window.
+        hardness_right (List[EnergyInterval], optional): candidate windows. Defaults to the default window.
+        shoulder (List[EnergyInterval], optional): candidate windows. Defaults to the default window.
+        absorption (List[Tuple[EnergyInterval, EnergyInterval]], optional): candidate (left, right) regions
+            of the edge fit. Defaults to the default regions.
+
+    Raises:
+        ValueError: if the flux densities are not on a grid.
+
+    Returns:
+        WindowScan: the measurement cubes
+    """
+    defaults = MeasurementWindows.build_default_windows()
+
+    candidates = {'continuum_at_fekalpha': continuum_at_fekalpha or [defaults.continuum_at_fekalpha],
+                  'hardness_left': hardness_left or [defaults.hardness_left],
+                  'hardness_right': hardness_right or [defaults.hardness_right],
+                  'shoulder': shoulder or [defaults.shoulder],
+                  'absorption': absorption or [(defaults.absorption_left, defaults.absorption_right)]}
+
+    n_continuum, n_left, n_right, n_shoulder = (len(candidates[name]) for name in
+                                                ('continuum_at_fekalpha', 'hardness_left', 'hardness_right', 'shoulder'))
+
+    line_flux = np.empty((len(keys), 1, 2))
+    shoulder_flux = np.empty((len(keys), n_shoulder, 2))
+    continuum_average = np.empty((len(keys), n_continuum, 2))
+    hardness_flux = np.empty((len(keys), n_left + n_right, 2))
+
+    bounds = None
+    for row, key in enumerate(keys):
+        fekalpha_fd, continuum_fd = fekalpha_fd_map[key], continuum_fd_map[key]
+
+        if fekalpha_fd.grid is None or continuum_fd.grid is None:
+            raise ValueError('the flux densities of a scan must be on a grid!')
+
+        if bounds is None or not first.same_grid(fekalpha_fd) or not first.same_grid(continuum_fd):
+            first = fekalpha_fd
+            bounds = {'shoulder': _window_bounds(fekalpha_fd, candidates['shoulder']),
+                      'continuum': _window_bounds(continuum_fd, candidates['continuum_at_fekalpha']),
+                      'hardness': _window_bounds(continuum_fd, candidates['hardness_left'] + candidates['hardness_right'])}
+
+        # not cached in the spectra, so the memory doesn't grow with the number of keys
+        fekalpha_sums = SpectrumPrefixSums.build(fekalpha_fd)
+        continuum_sums = SpectrumPrefixSums.build(continuum_fd)
+
+        line_flux[row] = np.column_stack(
+            (fekalpha_sums.area[-1], fekalpha_fd.window_flux_err(0, len(fekalpha_fd))))
+        shoulder_flux[row] = np.column_stack(
+            _window_fluxes(fekalpha_fd, fekalpha_sums, *bounds['shoulder']))
+        continuum_average[row] = np.column_stack(
+            _window_averages(continuum_sums, *bounds['continuum']))
+        hardness_flux[row] = np.column_stack(
+            _window_fluxes(continuum_fd, continuum_sums, *bounds['hardness']))
+
+    def uncertain(sums: np.ndarray) -> UncertainArray:
+        return UncertainArray(value=sums[..., 0], err=sums[..., 1])
+
+    line = uncertain(line_flux)
+    hardness_left_flux = uncertain(hardness_flux[:, :n_left, np.newaxis])
+    hardness_right_flux = uncertain(hardness_flux[:, np.newaxis, n_left:])
+
+    edges = [replace(defaults, absorption_left=left, absorption_right=right).build_edge_fitter().fit_spectra([continuum_sp_map[key] for key in keys])
+             for left, right in candidates['absorption']]
+
+    return WindowScan(keys=list(keys),
+                      candidates=candidates,
+                      ew=line/uncertain(continuum_average),
+                      h=hardness_right_flux/hardness_left_flux,
+                      shoulder=uncertain(shoulder_flux)/line,
+                      edge=UncertainArray(value=np.column_stack([edge.N_edge for edge in edges]),
+                                          err=np.column_stack([edge.N_edge_err for edge in edges])))
+
+
+def perform_window_scan(considered_nh_indexes: List[int], *root_dirs: str, **candidates) -> WindowScan:
+    """Loads the spectral data of the keys once and scans the candidate windows, see scan_measurement_windows().
+    The keys without the three inputs are left out.
+    """
+    continuum_fd_map, continuum_sp_map, fekalpha_fd_map = get_wanted_spectral_data(considered_nh_indexes,
+                                                                                   *root_dirs)
+
+    keys = sorted(key for key in fekalpha_fd_map
+                  if key in continuum_fd_map and key in continuum_sp_map)
+
+    return scan_measurement_windows(keys, fekalpha_fd_map=fekalpha_fd_map,
+                                    continuum_fd_map=continuum_fd_map,
+                                    continuum_sp_map=continuum_sp_map,
+                                    **candidates)
 
 
 @dataclass
@@ -486,3 +1765,33 @@ def parse_measurement(measurement_line: str) -> Tuple[MeasurementKey, Measuremen
     value = MeasurementValue.build_value(value_str=value_code)
 
     return key, value
+
+
+def parse_measurement_row(row: np.void) -> Tuple[MeasurementKey, MeasurementValue]:
+    """The parse_measurement() of a row of a measurements table (see measurement_table_utils).
+    """
+    key = MeasurementKey.build_key(label=get_measurement_label(row))
+    value = MeasurementValue(ew=ValueAndError(value=float(row['ew']), err=float(row['ew_err'])),
+                             h=ValueAndError(value=float(
+                                 row['h']), err=float(row['h_err'])),
+                             shoulder=ValueAndError(value=float(
+                                 row['shoulder']), err=float(row['shoulder_err'])),
+                             edge=ValueAndError(value=float(
+                                 row['edge']), err=float(row['edge_err'])),
+                             edge_chi2_value=float(row['edge_chi2']),
+                             edge_chi2_dof=int(row['edge_dof']))
+
+    return key, value
+
+
+def iterate_measurements(measurements_filepath: str) -> Iterable[Tuple[MeasurementKey, MeasurementValue]]:
+    """Iterates over the measurements of the given file, either a table or an old text file.
+
+    Args:
+        measurements_filepath (str): path to the measurements file
+
+    Yields:
+        Tuple[MeasurementKey, MeasurementValue]: key, value
+    """
+    for row in load_measurements_table(measurements_filepath):
+        yield parse_measurement_row(row)
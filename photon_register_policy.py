@@ -79,6 +79,12 @@ def _photon_file_line_interpretation(line: str):
         total_path_str = '-1'
         x_str = y_str = z_str = '-1'
 
+    elif len(items) == 10:
+        # the escape line information is stored apart, see escape_lines_utils
+        hv_str, theta_str, phi_str, photon_type_str, line_str, n_scatterings_str, total_path_str, x_str, y_str, z_str = items
+        n_clouds_str = '-1'
+        effective_length_str = '-1'
+
     elif len(items) == 12:
         hv_str, theta_str, phi_str, photon_type_str, line_str, n_scatterings_str, total_path_str, x_str, y_str, z_str, n_clouds_str, effective_length_str = items
     else:
@@ -199,7 +205,17 @@ class PhotonRawInfo:
     """
 
     @staticmethod
-    def build_photon_raw_info(raw_info: str) -> PhotonRawInfo:
+    def build_photon_raw_info(raw_info: str, escape_line: np.void = None) -> PhotonRawInfo:
+        """Builds the photon information from a line of a simulation file.
+
+        Args:
+            raw_info (str): the line of the simulation file
+            escape_line (np.void, optional): the (n_clouds, effective_length) record of the photon,
+                see escape_lines_utils. It overrides the values of the line. Defaults to None.
+
+        Returns:
+            PhotonRawInfo: the photon information
+        """
         hv_str, theta_str, phi_str, photon_type_str, line_str, n_scatterings_str, total_path_str, x_str, y_str, z_str, n_clouds_str, effective_length_str = PhotonRawInfo.photon_line_interpretation_policy(
             raw_info)
 
@@ -212,8 +228,10 @@ class PhotonRawInfo:
             n_scatterings=int(n_scatterings_str),
             total_path=float(total_path_str),
             escape_pos=np.array([float(x_str), float(y_str), float(z_str)]),
-            n_clouds=int(n_clouds_str),
-            effective_length=float(effective_length_str)
+            n_clouds=int(n_clouds_str) if escape_line is None else int(
+                escape_line['n_clouds']),
+            effective_length=float(effective_length_str) if escape_line is None else float(
+                escape_line['effective_length'])
         )
 
     def __str__(self) -> str:
@@ -287,9 +305,10 @@ class PhotonInfo:
         return hydrogen_concentration*self.effective_length
 
     @staticmethod
-    def build_photon_info(raw_info: str, policy: UnitsPolicy) -> PhotonRawInfo:
+    def build_photon_info(raw_info: str, policy: UnitsPolicy, escape_line: np.void = None) -> PhotonRawInfo:
 
-        photon_raw_info = PhotonRawInfo.build_photon_raw_info(raw_info)
+        photon_raw_info = PhotonRawInfo.build_photon_raw_info(
+            raw_info, escape_line=escape_line)
 
         return PhotonInfo(
             hv=policy.translate_energy(photon_raw_info.hv),
@@ -0,0 +1,483 @@
+"""
+This module runs the processing as a graph of tasks, like make does.
+
+Every task declares its inputs and outputs (files, directories or glob
+patterns), its parameters and the source files of its code. A task
+depends on the tasks whose outputs it reads, and it is run again only
+if its recipe (the parameters or the code) or its inputs (size and
+modification time) changed since its last run, or if an output is missing.
+The outputs are removed before running the task, so no stale file of
+a previous run (for example a key that doesn't exist anymore) is left
+among the new ones. The outputs of an incremental task, which updates
+them itself, are only removed when the recipe changed, so it cannot
+reuse results produced by the old recipe.
+
+The provenance of every task (code version, parameters, inputs and
+timing of the run that produced its outputs) is stored in
+
+    {state_dir}/{task name}.json
+
+==================================
+
+Example: 'how to run a small pipeline'
+
+tasks = [Task(name='effective lengths sim_01 6075',
+              action=partial(build_effective_lengths, '/path/to/sim_01', '6075'),
+              inputs=['/path/to/sim_01/clouds.txt'],
+              outputs=['/path/to/sim_01/effective_lengths/effective_lengths_6075'],
+              params={'TOTAL_DIRECTIONS': TOTAL_DIRECTIONS},
+              code=get_code_closure('build_effective_lengths.py')),
+         ...]
+
+pipeline = Pipeline(tasks=tasks, state_dir='/path/to/.pipeline')
+
+results = pipeline.run(n_workers=8)
+
+print_pipeline_summary(results)
+
+==================================
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Final, Tuple
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from glob import glob, has_magic
+from functools import lru_cache
+from datetime import datetime
+import subprocess
+import traceback
+import ast
+import hashlib
+import shutil
+import json
+import time
+import os
+
+PIPELINE_STATE_DIR_LABEL: Final[str] = '.pipeline'
+
+CODE_DIRECTORY: Final[str] = os.path.dirname(os.path.abspath(__file__))
+"""The relative code paths of the tasks are relative to this directory.
+"""
+
+TASK_DONE: Final[str] = 'done'
+TASK_UP_TO_DATE: Final[str] = 'up-to-date'
+TASK_FAILED: Final[str] = 'failed'
+TASK_SKIPPED: Final[str] = 'skipped'
+"""skipped because a task it depends on failed
+"""
+
+
+@dataclass
+class Task:
+    """
+    This class represents a step of the pipeline.
+    """
+
+    name: str
+    """unique name of the task, for example: spectra 523_5_1xfe 7590
+    """
+
+    action: Callable[[], any]
+    """what the task does, it has to be picklable (a function of a module or a partial of it)
+    to run in the worker processes
+    """
+
+    inputs: List[str] = field(default_factory=list)
+    """the files, directories or glob patterns read by the task
+    """
+
+    outputs: List[str] = field(default_factory=list)
+    """the files, directories or glob patterns written by the task
+    """
+
+    params: Dict[str, any] = field(default_factory=dict)
+    """the parameters the outputs depend on, for example: {'NH_INTERVALS': 51}
+    """
+
+    code: List[str] = field(default_factory=list)
+    """the source files of the task, relative to CODE_DIRECTORY
+    """
+
+    incremental: bool = False
+    """the task reuses and updates its outputs itself (for example the measurements of
+    the unchanged keys), they are removed only when the recipe changed
+    """
+
+
+@dataclass
+class TaskResult:
+    task: Task
+
+    status: str
+    """TASK_DONE, TASK_UP_TO_DATE, TASK_FAILED or TASK_SKIPPED
+    """
+
+    elapsed: float = 0.0
+
+    error: str = ''
+
+
+def _expand(path_or_pattern: str) -> List[str]:
+    if has_magic(path_or_pattern):
+        return sorted(glob(path_or_pattern))
+
+    return [path_or_pattern] if os.path.exists(path_or_pattern) else []
+
+
+def _fixed_prefix(path_or_pattern: str) -> str:
+    """Returns the part of the path before the first wildcard.
+    """
+    if not has_magic(path_or_pattern):
+        return path_or_pattern
+
+    parts = []
+    for part in path_or_pattern.split(os.sep):
+        if has_magic(part):
+            break
+        parts.append(part)
+
+    return os.sep.join(parts)
+
+
+def _overlaps(path_a: str, path_b: str) -> bool:
+    """Returns if one of the paths (or patterns) is (or can be) inside the other.
+    """
+    a = os.path.abspath(_fixed_prefix(path_a))
+    b = os.path.abspath(_fixed_prefix(path_b))
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+
+def fingerprint_paths(paths_or_patterns: List[str]) -> List[Tuple[str, int, int]]:
+    """Returns the (path, size, mtime_ns) of every file of the given files, directories
+    (recursively) and glob patterns. A missing path is fingerprinted as (path, -1, -1).
+    """
+    fingerprints = []
+
+    for path_or_pattern in paths_or_patterns:
+        paths = _expand(path_or_pattern)
+
+        if not paths:
+            fingerprints.append((path_or_pattern, -1, -1))
+
+        for path in paths:
+            if os.path.isdir(path):
+                filepaths = sorted(os.path.join(directory, filename)
+                                   for directory, _, filenames in os.walk(path) for filename in filenames)
+            else:
+                filepaths = [path]
+
+            for filepath in filepaths:
+                stat = os.stat(filepath)
+                fingerprints.append((filepath, stat.st_size, stat.st_mtime_ns))
+
+    return fingerprints
+
+
+def get_code_closure(*scripts: str) -> List[str]:
+    """Returns the given source files and all the modules of CODE_DIRECTORY they import,
+    directly or not, so the code of a task doesn't have to be listed by hand.
+
+    For example:
+
+        get_code_closure('build_spectra_on_grid.py')
+
+    Args:
+        scripts (str): the source files, relative to CODE_DIRECTORY
+
+    Returns:
+        List[str]: the sorted source files, relative to CODE_DIRECTORY
+    """
+    return list(_code_closure(scripts))
+
+
+@lru_cache(maxsize=None)
+def _code_closure(scripts: Tuple[str, ...]) -> Tuple[str, ...]:
+    closure = set()
+    pending = list(scripts)
+
+    while pending:
+        script = pending.pop()
+        if script in closure:
+            continue
+        closure.add(script)
+
+        with open(os.path.join(CODE_DIRECTORY, script)) as script_file:
+            tree = ast.parse(script_file.read(), filename=script)
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                modules = [node.module]
+            else:
+                continue
+
+            pending += [f'{module}.py' for module in modules
+                        if os.path.isfile(os.path.join(CODE_DIRECTORY, f'{module}.py'))]
+
+    return tuple(sorted(closure))
+
+
+def _file_digest(filepath: str) -> str:
+    with open(filepath, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def get_code_version() -> str:
+    """Returns the git revision of the code (with a -dirty suffix if there are local changes),
+    None if it is not known.
+    """
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=CODE_DIRECTORY,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=CODE_DIRECTORY,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return f'{revision}-dirty' if status else revision
+
+
+def _safe_filename(name: str) -> str:
+    return ''.join(c if c.isalnum() or c in '-_.+' else '_' for c in name)
+
+
+def _remove_outputs(task: Task):
+    for output in task.outputs:
+        for path in _expand(output):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def _run_task(task: Task) -> Tuple[float, str]:
+    start = time.perf_counter()
+    try:
+        task.action()
+    except Exception:
+        return time.perf_counter() - start, traceback.format_exc()
+
+    return time.perf_counter() - start, ''
+
+
+class Pipeline:
+    """
+    The graph of the tasks, see the module documentation.
+    """
+
+    def __init__(self, tasks: List[Task], state_dir: str):
+        """
+        Args:
+            tasks (List[Task]): the tasks
+            state_dir (str): where the provenance of the tasks is stored
+
+        Raises:
+            ValueError: if two tasks have the same name or write the same output,
+            or if the dependencies have a cycle.
+        """
+        self.tasks: Dict[str, Task] = {}
+        for task in tasks:
+            if task.name in self.tasks:
+                raise ValueError(f'There are two tasks named {task.name}!')
+            self.tasks[task.name] = task
+
+        self.state_dir = state_dir
+        self.dependencies = self._build_dependencies()
+        self.order = self._topological_order()
+
+    def _build_dependencies(self) -> Dict[str, List[str]]:
+        producers: Dict[str, str] = {}
+        for task in self.tasks.values():
+            for output in task.outputs:
+                if output in producers:
+                    raise ValueError(
+                        f'The output {output} is written by {producers[output]} and {task.name}!')
+                producers[output] = task.name
+
+        return {task.name: sorted({producer for output, producer in producers.items()
+                                   if producer != task.name and any(_overlaps(input, output) for input in task.inputs)})
+                for task in self.tasks.values()}
+
+    def _topological_order(self) -> List[str]:
+        dependents: Dict[str, List[str]] = {name: [] for name in self.tasks}
+        n_pending = {name: len(dependencies)
+                     for name, dependencies in self.dependencies.items()}
+
+        for name, dependencies in self.dependencies.items():
+            for dependency in dependencies:
+                dependents[dependency].append(name)
+
+        ready = [name for name in self.tasks if n_pending[name] == 0]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for dependent in dependents[name]:
+                n_pending[dependent] -= 1
+                if n_pending[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(order) != len(self.tasks):
+            raise ValueError(
+                f'The dependencies of the tasks {sorted(set(self.tasks) - set(order))} have a cycle!')
+
+        return order
+
+    def get_provenance_filepath(self, task: Task) -> str:
+        return os.path.join(self.state_dir, f'{_safe_filename(task.name)}.json')
+
+    def load_provenance(self, task: Task) -> Dict[str, any]:
+        provenance_filepath = self.get_provenance_filepath(task)
+
+        if not os.path.exists(provenance_filepath):
+            return None
+
+        with open(provenance_filepath) as provenance_file:
+            return json.load(provenance_file)
+
+    def _recipe_digest(self, task: Task) -> str:
+        recipe = {'params': {key: repr(value) for key, value in sorted(task.params.items())},
+                  'code': {code: _file_digest(os.path.join(CODE_DIRECTORY, code)) for code in sorted(task.code)}}
+        return hashlib.sha256(json.dumps(recipe, sort_keys=True).encode()).hexdigest()
+
+    def _inputs_digest(self, task: Task) -> str:
+        return hashlib.sha256(json.dumps(fingerprint_paths(task.inputs)).encode()).hexdigest()
+
+    def get_state(self, task: Task) -> Tuple[bool, bool, Dict[str, any]]:
+        """Returns if the task is up to date, if its recipe changed, and its new provenance.
+        """
+        provenance = dict(task=task.name,
+                          recipe_digest=self._recipe_digest(task),
+                          inputs_digest=self._inputs_digest(task),
+                          params={key: repr(value)
+                                  for key, value in task.params.items()},
+                          inputs=task.inputs,
+                          outputs=task.outputs)
+
+        stored = self.load_provenance(task)
+
+        recipe_changed = stored is not None and stored['recipe_digest'] != provenance['recipe_digest']
+
+        up_to_date = (stored is not None
+                      and not recipe_changed
+                      and stored['inputs_digest'] == provenance['inputs_digest']
+                      and all(_expand(output) for output in task.outputs))
+
+        return up_to_date, recipe_changed, provenance
+
+    def _write_provenance(self, provenance: Dict[str, any], elapsed: float, code_version: str):
+        os.makedirs(self.state_dir, exist_ok=True)
+        provenance = dict(provenance,
+                          code_version=code_version,
+                          finished=datetime.now().isoformat(timespec='seconds'),
+                          elapsed=elapsed)
+
+        with open(self.get_provenance_filepath(self.tasks[provenance['task']]), 'w') as provenance_file:
+            json.dump(provenance, provenance_file, indent=2)
+
+    def outdated_tasks(self) -> List[str]:
+        """Returns the tasks that would run now (without running the tasks they depend on).
+        """
+        return [name for name in self.order if not self.get_state(self.tasks[name])[0]]
+
+    def run(self, n_workers: int = 1, force: bool = False, verbose: bool = True) -> List[TaskResult]:
+        """Runs the outdated tasks, the independent ones at the same time.
+
+        A task runs when all the tasks it depends on are done, the failure
+        of a task skips the tasks that depend on it, not the others.
+
+        Args:
+            n_workers (int, optional): number of tasks running at the same time (in worker processes if > 1). Defaults to 1.
+            force (bool, optional): run all the tasks. Defaults to False.
+            verbose (bool, optional): print the progress. Defaults to True.
+
+        Returns:
+            List[TaskResult]: the results, in a topological order of the tasks
+        """
+        code_version = get_code_version()
+        results: Dict[str, TaskResult] = {}
+        provenances: Dict[str, Dict[str, any]] = {}
+        running: Dict[Future, str] = {}
+
+        def ready_tasks() -> List[str]:
+            return [name for name in self.order
+                    if name not in results and name not in provenances
+                    and all(dependency in results for dependency in self.dependencies[name])]
+
+        def finish(name: str, elapsed: float, error: str):
+            task = self.tasks[name]
+            if error:
+                results[name] = TaskResult(task=task, status=TASK_FAILED,
+                                           elapsed=elapsed, error=error)
+            else:
+                self._write_provenance(provenances[name], elapsed=elapsed,
+                                       code_version=code_version)
+                results[name] = TaskResult(task=task, status=TASK_DONE,
+                                           elapsed=elapsed)
+            if verbose:
+                print(f'task {name}: {results[name].status} in {elapsed:0.1f} s')
+
+        def start(name: str, executor: ProcessPoolExecutor):
+            task = self.tasks[name]
+
+            if any(results[dependency].status in (TASK_FAILED, TASK_SKIPPED) for dependency in self.dependencies[name]):
+                results[name] = TaskResult(task=task, status=TASK_SKIPPED)
+                return
+
+            up_to_date, recipe_changed, provenance = self.get_state(task)
+
+            if up_to_date and not force:
+                results[name] = TaskResult(task=task, status=TASK_UP_TO_DATE)
+                return
+
+            if recipe_changed or not task.incremental:
+                _remove_outputs(task)
+
+            provenances[name] = provenance
+
+            if verbose:
+                print(f'task {name}: running')
+
+            if executor is None:
+                finish(name, *_run_task(task))
+            else:
+                running[executor.submit(_run_task, task)] = name
+
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers) if n_workers is not None and n_workers > 1 else None
+        try:
+            while len(results) < len(self.tasks):
+                for name in ready_tasks():
+                    start(name, executor)
+
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(running.pop(future), *future.result())
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return [results[name] for name in self.order]
+
+
+def print_pipeline_summary(results: List[TaskResult]):
+    """Prints the status of every task and the errors of the failed ones.
+    """
+    counts = {status: sum(result.status == status for result in results)
+              for status in (TASK_DONE, TASK_UP_TO_DATE, TASK_FAILED, TASK_SKIPPED)}
+
+    print('=====================================')
+    print(f'tasks: {len(results)}, ' +
+          ', '.join(f'{status}: {count}' for status, count in counts.items()))
+
+    for result in results:
+        print(f'{result.status:>10} {result.elapsed:>9.1f} s  {result.task.name}')
+
+    for result in results:
+        if result.status == TASK_FAILED:
+            print('-------------------------------------')
+            print(f'{result.task.name}:\n{result.error}')
+
+    print('=====================================')
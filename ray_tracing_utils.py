@@ -0,0 +1,499 @@
+"""
+This module computes the effective lengths (the length inside the clouds)
+and the number of clouds along straight lines through the clumpy torus,
+replacing the external create_nh_distribution tool.
+
+The clouds are spheres of the same radius, indexed by a uniform grid,
+so every ray is only tested against the clouds in the cells it crosses.
+
+The module is unit agnostic: the clouds, the radius and the rays
+must be given in the same units.
+
+==================================
+
+Example-01: 'how to get the effective lengths of a simulation for a viewing angle'
+
+sim_info = AgnSimulationInfo.build_agn_simulation_info(
+    sim_root_dir="/path/to/sim_root_dir")
+
+effective_lengths, n_clouds = compute_effective_lengths_for_simulation(
+    sim_info=sim_info, alpha=AGN_VIEWING_DIRECTIONS_DEG['7590'], n_directions=100_000)
+
+print(effective_lengths.mean(), n_clouds.mean())
+
+==================================
+
+Example-02: 'how to sample directions until the column density distribution converges'
+
+effective_lengths, n_clouds = compute_effective_lengths_until_converged(
+    sim_info=sim_info, alpha=AGN_VIEWING_DIRECTIONS_DEG['7590'], nh_grid=DEFAULT_NH_GRID, tolerance=0.02)
+
+print(len(effective_lengths))
+
+==================================
+
+Example-03: 'how to trace arbitrary rays'
+
+tracer = CloudsRayTracer(centers=load_clouds('/path/to/clouds.txt'), radius=1e11)
+
+effective_lengths, n_clouds = tracer.trace(origins=origins, directions=directions)
+
+==================================
+"""
+from __future__ import annotations
+from utils import *
+from agn_utils import AgnSimulationInfo
+from colum_density_utils import _get_multiplication_factor_to_translate_from_sim_to_processing_units, build_nh_list_from_effective_lengths, histogram_max_relative_change, ColumnDensityGrid, DEFAULT_NH_GRID
+from agn_processing_policy import MAX_TOTAL_DIRECTIONS, NH_CONVERGENCE_BATCH_SIZE, NH_CONVERGENCE_TOLERANCE, NH_CONVERGENCE_MIN_BIN_FRACTION
+from smooth_torus_utils import smooth_torus_path_lengths, smooth_torus_path_lengths_from_center
+from concurrent.futures import ProcessPoolExecutor
+from typing import Final
+import os
+
+MAX_SAMPLES_PER_TRACE: Final[int] = 4_000_000
+"""Maximum number of (ray, sample-point) pairs processed at once by the tracer.
+"""
+
+MAX_GRID_CELLS_PER_AXIS: Final[int] = 128
+"""The cells of the clouds grid are never smaller than the extent of the clouds over this number.
+"""
+
+DIRECTIONS_BATCH_SIZE: Final[int] = 20_000
+"""Number of directions sent at once to each worker.
+"""
+
+
+def load_clouds(clouds_file_path: str) -> np.ndarray:
+    """Returns the centers of the clouds in the given clouds file.
+
+    The first three columns of the file are the x, y, z coordinates
+    of the clouds (in the simulation units).
+
+    Args:
+        clouds_file_path (str): path to the clouds file
+
+    Returns:
+        np.ndarray: (n_clouds, 3) array with the centers of the clouds
+    """
+    return np.loadtxt(clouds_file_path, usecols=(0, 1, 2), ndmin=2)
+
+
+def sample_directions(alpha: AngularInterval, n_directions: int, rng: np.random.Generator = None) -> np.ndarray:
+    """Samples directions uniformly (in solid angle) in the given viewing angular interval.
+
+    The angles are measured from the oz axis, and the directions are
+    distributed in both hemispheres, like the (doubled) agn_solid_angle().
+
+    Args:
+        alpha (AngularInterval): the viewing angular interval in radians
+        n_directions (int): number of directions
+        rng (np.random.Generator, optional): random generator. Defaults to None.
+
+    Returns:
+        np.ndarray: (n_directions, 3) unit vectors
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+
+    cos_theta = rng.uniform(np.cos(alpha.end), np.cos(alpha.beg), n_directions)
+    cos_theta *= rng.choice([-1.0, 1.0], n_directions)
+    sin_theta = np.sqrt(1.0 - cos_theta**2)
+    phi = rng.uniform(0, 2*np.pi, n_directions)
+
+    return np.stack((sin_theta*np.cos(phi), sin_theta*np.sin(phi), cos_theta), axis=1)
+
+
+def _ragged_arange(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenation of arange(start, start+count) for every (start, count).
+    """
+    total = np.sum(counts)
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+    return np.arange(total) - np.repeat(offsets, counts) + np.repeat(starts, counts)
+
+
+class CloudsRayTracer:
+    """
+    This class traces straight rays through spherical clouds of the same radius.
+
+    The clouds are registered in a uniform grid of cubic cells. Every cloud is
+    registered in all the cells that overlap its bounding box enlarged by
+    half a cell, therefore sampling the rays every cell size finds all the
+    intersected clouds.
+    """
+
+    def __init__(self, centers: np.ndarray, radius: float, cell_size: float = None):
+        """Builds the grid index of the clouds.
+
+        Args:
+            centers (np.ndarray): (n_clouds, 3) centers of the clouds
+            radius (float): radius of the clouds
+            cell_size (float, optional): size of the cells. Defaults to the diameter of the clouds, but
+                not less than the extent of the clouds divided by MAX_GRID_CELLS_PER_AXIS.
+        """
+        self.centers = np.asarray(centers, dtype=float)
+        self.radius = radius
+
+        lower = self.centers.min(axis=0) - radius
+        upper = self.centers.max(axis=0) + radius
+
+        if cell_size is None:
+            cell_size = max(2*radius, np.max(upper-lower) /
+                            MAX_GRID_CELLS_PER_AXIS)
+
+        self.cell_size = cell_size
+        self.margin = cell_size/2
+        self.lower = lower - self.margin
+        self.upper = upper + self.margin
+        self.shape = np.maximum(
+            np.ceil((self.upper-self.lower)/cell_size).astype(np.int64), 1)
+
+        self.cell_start, self.cell_clouds = self._register_clouds()
+
+    def _register_clouds(self) -> Tuple[np.ndarray, np.ndarray]:
+        reach = self.radius + self.margin
+        lo = np.floor((self.centers - reach - self.lower) /
+                      self.cell_size).astype(np.int64)
+        hi = np.floor((self.centers + reach - self.lower) /
+                      self.cell_size).astype(np.int64)
+        lo = np.clip(lo, 0, self.shape-1)
+        hi = np.clip(hi, 0, self.shape-1)
+
+        span = int(np.max(hi-lo)) + 1
+        cloud_ids = np.arange(len(self.centers))
+
+        cells = []
+        clouds = []
+        for i in range(span):
+            for j in range(span):
+                for k in range(span):
+                    cell = lo + np.array([i, j, k])
+                    valid = np.all(cell <= hi, axis=1)
+                    cells += [self._flat_cell(cell[valid])]
+                    clouds += [cloud_ids[valid]]
+
+        cells = np.concatenate(cells)
+        clouds = np.concatenate(clouds)
+
+        order = np.argsort(cells, kind='stable')
+        counts = np.bincount(cells, minlength=int(np.prod(self.shape)))
+        cell_start = np.concatenate(([0], np.cumsum(counts)))
+
+        return cell_start, clouds[order]
+
+    def _flat_cell(self, cell: np.ndarray) -> np.ndarray:
+        return (cell[..., 0]*self.shape[1] + cell[..., 1])*self.shape[2] + cell[..., 2]
+
+    def _exit_distances(self, origins: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_lower = (self.lower - origins)/directions
+            t_upper = (self.upper - origins)/directions
+        t_exit = np.nanmin(np.where(np.isnan(t_lower), np.inf,
+                                    np.maximum(t_lower, t_upper)), axis=1)
+        return np.maximum(t_exit, 0)
+
+    def trace(self, origins: np.ndarray, directions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the effective lengths and the number of clouds along the given rays.
+
+        The rays start at the origins and go to infinity along the directions.
+        If a ray starts inside a cloud, only the part of the cloud ahead is counted.
+
+        Args:
+            origins (np.ndarray): (n_rays, 3) origins of the rays
+            directions (np.ndarray): (n_rays, 3) unit directions of the rays
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: effective_lengths, n_clouds
+        """
+        origins = np.broadcast_to(np.asarray(
+            origins, dtype=float), np.shape(directions))
+        directions = np.asarray(directions, dtype=float)
+
+        effective_lengths = np.zeros(len(directions))
+        n_clouds = np.zeros(len(directions), dtype=np.int64)
+
+        t_exit = self._exit_distances(origins, directions)
+        n_samples = np.ceil(t_exit/self.cell_size).astype(np.int64) + 1
+
+        start = 0
+        while start < len(directions):
+            stop = start + 1
+            samples = n_samples[start]
+            while stop < len(directions) and samples + n_samples[stop] <= MAX_SAMPLES_PER_TRACE:
+                samples += n_samples[stop]
+                stop += 1
+
+            effective_lengths[start:stop], n_clouds[start:stop] = self._trace_batch(
+                origins[start:stop], directions[start:stop], n_samples[start:stop])
+            start = stop
+
+        return effective_lengths, n_clouds
+
+    def _trace_batch(self, origins: np.ndarray, directions: np.ndarray, n_samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        n_rays = len(directions)
+
+        # sample points every cell size along the rays
+        sample_rays = np.repeat(np.arange(n_rays), n_samples)
+        sample_t = _ragged_arange(np.zeros(n_rays, dtype=np.int64),
+                                  n_samples)*self.cell_size
+        points = origins[sample_rays] + \
+            sample_t[:, np.newaxis]*directions[sample_rays]
+
+        cells = np.floor((points - self.lower)/self.cell_size).astype(np.int64)
+        inside = np.all((cells >= 0) & (cells < self.shape), axis=1)
+        sample_rays = sample_rays[inside]
+        flat_cells = self._flat_cell(cells[inside])
+
+        # candidate (ray, cloud) pairs from the visited cells
+        counts = self.cell_start[flat_cells+1] - self.cell_start[flat_cells]
+        candidate_clouds = self.cell_clouds[_ragged_arange(
+            self.cell_start[flat_cells], counts)]
+        candidate_rays = np.repeat(sample_rays, counts)
+
+        pairs = np.unique(candidate_rays*len(self.centers) + candidate_clouds)
+        pair_rays = pairs // len(self.centers)
+        pair_clouds = pairs % len(self.centers)
+
+        # exact chords of the rays inside the clouds
+        to_center = self.centers[pair_clouds] - origins[pair_rays]
+        b = np.sum(to_center*directions[pair_rays], axis=1)
+        discriminant = b**2 - np.sum(to_center**2, axis=1) + self.radius**2
+        hit = discriminant > 0
+        root = np.sqrt(np.where(hit, discriminant, 0))
+        chords = np.where(hit, np.maximum(
+            b + root - np.maximum(b - root, 0), 0), 0)
+
+        effective_lengths = np.bincount(
+            pair_rays, weights=chords, minlength=n_rays)
+        n_clouds = np.bincount(pair_rays, weights=(
+            chords > 0), minlength=n_rays).astype(np.int64)
+
+        return effective_lengths, n_clouds
+
+
+_worker_tracer: CloudsRayTracer = None
+
+
+def _init_worker(tracer: CloudsRayTracer):
+    global _worker_tracer
+    _worker_tracer = tracer
+
+
+def _trace_from_center(directions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    return _worker_tracer.trace(origins=np.zeros(3), directions=directions)
+
+
+def trace_directions_from_center(tracer: CloudsRayTracer,
+                                 directions: np.ndarray,
+                                 n_workers: int = None,
+                                 batch_size: int = DIRECTIONS_BATCH_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """Traces the rays that start at the center of the torus (the source),
+    distributing batches of directions among several processes.
+
+    Args:
+        tracer (CloudsRayTracer): the tracer of the clouds
+        directions (np.ndarray): (n_directions, 3) unit vectors
+        n_workers (int, optional): number of processes. Defaults to os.cpu_count().
+        batch_size (int, optional): number of directions per batch. Defaults to DIRECTIONS_BATCH_SIZE.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: effective_lengths, n_clouds
+    """
+    n_workers = n_workers if n_workers else os.cpu_count()
+    batches = [directions[i:i+batch_size]
+               for i in range(0, len(directions), batch_size)]
+
+    if n_workers == 1 or len(batches) <= 1:
+        results = [tracer.trace(origins=np.zeros(3), directions=batch)
+                   for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(tracer,)) as executor:
+            results = list(executor.map(_trace_from_center, batches))
+
+    if len(results) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+def build_clouds_ray_tracer(sim_info: AgnSimulationInfo) -> CloudsRayTracer:
+    """Builds the tracer of the clouds of the given simulation, in the simulation units.
+
+    Args:
+        sim_info (AgnSimulationInfo): the simulation info
+
+    Raises:
+        ValueError: if the simulation has no clouds file.
+
+    Returns:
+        CloudsRayTracer: the tracer
+    """
+    if not sim_info.clouds_file_path:
+        raise ValueError(
+            f'The simulation {sim_info.sim_root_dir} has no clouds file!')
+
+    to_processing_units = _get_multiplication_factor_to_translate_from_sim_to_processing_units(
+        dimensionality=LENGTH)
+
+    return CloudsRayTracer(centers=load_clouds(sim_info.clouds_file_path),
+                           radius=sim_info.r_clouds/to_processing_units)
+
+
+def _smooth_torus_geometry_in_sim_units(sim_info: AgnSimulationInfo) -> Tuple[float, float, float]:
+    to_processing_units = _get_multiplication_factor_to_translate_from_sim_to_processing_units(
+        dimensionality=LENGTH)
+    return sim_info.r1/to_processing_units, sim_info.r2/to_processing_units, sim_info.theta
+
+
+def trace_simulation_rays(sim_info: AgnSimulationInfo,
+                          origins: np.ndarray,
+                          directions: np.ndarray,
+                          tracer: CloudsRayTracer = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the effective lengths and the number of clouds along the given rays
+    through the torus of the simulation (everything in the simulation units).
+
+    The smooth tori are handled in closed form, in this case the number of clouds is 0.
+
+    Args:
+        sim_info (AgnSimulationInfo): the simulation info
+        origins (np.ndarray): (n_rays, 3) origins of the rays
+        directions (np.ndarray): (n_rays, 3) unit directions of the rays
+        tracer (CloudsRayTracer, optional): the tracer of the clouds, to reuse it. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: effective_lengths, n_clouds
+    """
+    if sim_info.is_smooth:
+        r1, r2, theta = _smooth_torus_geometry_in_sim_units(sim_info)
+        return smooth_torus_path_lengths(origins=origins, directions=directions, r1=r1, r2=r2, theta=theta), np.zeros(len(directions), dtype=np.int64)
+
+    tracer = tracer if tracer is not None else build_clouds_ray_tracer(
+        sim_info)
+
+    return tracer.trace(origins=origins, directions=directions)
+
+
+def compute_effective_lengths_for_simulation(sim_info: AgnSimulationInfo,
+                                             alpha: AngularInterval,
+                                             n_directions: int,
+                                             n_workers: int = None,
+                                             rng: np.random.Generator = None,
+                                             tracer: CloudsRayTracer = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes the effective lengths (in the simulation units) and the number of clouds
+    for random directions from the center of the torus in the given viewing angle.
+
+    The smooth tori are handled in closed form, in this case the number of clouds is 0.
+
+    Args:
+        sim_info (AgnSimulationInfo): the simulation info
+        alpha (AngularInterval): viewing angular interval in degrees, see AGN_VIEWING_DIRECTIONS_DEG
+        n_directions (int): number of directions
+        n_workers (int, optional): number of processes. Defaults to os.cpu_count().
+        rng (np.random.Generator, optional): random generator. Defaults to None.
+        tracer (CloudsRayTracer, optional): the tracer of the clouds, to reuse it among viewing angles. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: effective_lengths, n_clouds
+    """
+    directions = sample_directions(
+        alpha=alpha.from_deg_to_rad(), n_directions=n_directions, rng=rng)
+
+    if sim_info.is_smooth:
+        r1, r2, theta = _smooth_torus_geometry_in_sim_units(sim_info)
+        return smooth_torus_path_lengths_from_center(directions=directions, r1=r1, r2=r2, theta=theta), np.zeros(n_directions, dtype=np.int64)
+
+    tracer = tracer if tracer is not None else build_clouds_ray_tracer(
+        sim_info)
+
+    return trace_directions_from_center(tracer=tracer, directions=directions, n_workers=n_workers)
+
+
+def compute_effective_lengths_until_converged(sim_info: AgnSimulationInfo,
+                                              alpha: AngularInterval,
+                                              nh_grid: ColumnDensityGrid = DEFAULT_NH_GRID,
+                                              tolerance: float = NH_CONVERGENCE_TOLERANCE,
+                                              batch_size: int = NH_CONVERGENCE_BATCH_SIZE,
+                                              max_directions: int = MAX_TOTAL_DIRECTIONS,
+                                              min_bin_fraction: float = NH_CONVERGENCE_MIN_BIN_FRACTION,
+                                              n_workers: int = None,
+                                              rng: np.random.Generator = None,
+                                              tracer: CloudsRayTracer = None,
+                                              verbose: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes the effective lengths (in the simulation units) and the number of clouds
+    for random directions from the center of the torus in the given viewing angle,
+    batch by batch, until the column density distribution converges.
+
+    After every batch the histogram of the column densities is updated, and the
+    sampling stops when the maximum relative change of its normalized counts in the
+    occupied bins (see histogram_max_relative_change()) is below the tolerance,
+    or when max_directions is reached.
+
+    Args:
+        sim_info (AgnSimulationInfo): the simulation info
+        alpha (AngularInterval): viewing angular interval in degrees, see AGN_VIEWING_DIRECTIONS_DEG
+        nh_grid (ColumnDensityGrid, optional): the grid of the column density distribution. Defaults to DEFAULT_NH_GRID.
+        tolerance (float, optional): the target maximum relative change. Defaults to NH_CONVERGENCE_TOLERANCE.
+        batch_size (int, optional): number of directions per batch. Defaults to NH_CONVERGENCE_BATCH_SIZE.
+        max_directions (int, optional): maximum number of directions. Defaults to MAX_TOTAL_DIRECTIONS.
+        min_bin_fraction (float, optional): smallest normalized count of an occupied bin. Defaults to NH_CONVERGENCE_MIN_BIN_FRACTION.
+        n_workers (int, optional): number of processes. Defaults to os.cpu_count().
+        rng (np.random.Generator, optional): random generator. Defaults to None.
+        tracer (CloudsRayTracer, optional): the tracer of the clouds, to reuse it among viewing angles. Defaults to None.
+        verbose (bool, optional): print the change after every batch. Defaults to False.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: effective_lengths, n_clouds
+    """
+    if not sim_info.is_smooth and tracer is None:
+        tracer = build_clouds_ray_tracer(sim_info)
+
+    to_processing_units = _get_multiplication_factor_to_translate_from_sim_to_processing_units(
+        dimensionality=LENGTH)
+
+    effective_lengths_batches = []
+    n_clouds_batches = []
+
+    counts = np.zeros(nh_grid.n_intervals)
+    total = 0
+
+    while total < max_directions:
+        n_directions = min(batch_size, max_directions - total)
+
+        effective_lengths, n_clouds = compute_effective_lengths_for_simulation(sim_info=sim_info,
+                                                                               alpha=alpha,
+                                                                               n_directions=n_directions,
+                                                                               n_workers=n_workers,
+                                                                               rng=rng,
+                                                                               tracer=tracer)
+        effective_lengths_batches.append(effective_lengths)
+        n_clouds_batches.append(n_clouds)
+
+        batch_counts, _, _ = nh_grid.histogram(build_nh_list_from_effective_lengths(
+            effective_lengths=effective_lengths*to_processing_units, sim_info=sim_info))
+
+        previous_counts, previous_total = counts, total
+        counts, total = counts + batch_counts, total + n_directions
+
+        change = histogram_max_relative_change(previous_counts=previous_counts,
+                                               previous_total=previous_total,
+                                               counts=counts,
+                                               total=total,
+                                               min_bin_fraction=min_bin_fraction)
+        if verbose:
+            print(f'directions: {total:>10}, max relative change: {change:0.3g}')
+
+        if change < tolerance:
+            break
+
+    return np.concatenate(effective_lengths_batches), np.concatenate(n_clouds_batches)
+
+
+def write_effective_lengths(output_filepath: str, effective_lengths: np.ndarray):
+    """Writes the effective lengths in the format of the effective lengths files,
+    one value per line, see get_effective_lengths().
+
+    Args:
+        output_filepath (str): path to the effective lengths file
+        effective_lengths (np.ndarray): effective lengths in the simulation units
+    """
+    np.savetxt(output_filepath, effective_lengths)
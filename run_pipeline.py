@@ -0,0 +1,220 @@
+"""
+This script runs the whole processing as a pipeline (see pipeline_utils):
+
+    add_effective_length_info (escape lines), build_effective_lengths -> build_spectra_on_grid -> build_spectral_data -> do_measurements (and the NH bins and line measurements, and the table model)
+
+with one task per simulation for the escape lines, one task per simulation and
+viewing angle for the effective lengths and the spectra on grid, one
+task per (nh_aver, n_aver, a_fe, alpha) combination for the spectral data,
+and one task for the measurements. Only the tasks whose inputs, parameters
+or code changed are run, the independent ones at the same time.
+
+The provenance of the tasks is stored in /repo-directory/.pipeline/
+"""
+from pipeline_utils import Task, Pipeline, get_code_closure, print_pipeline_summary, PIPELINE_STATE_DIR_LABEL, TASK_FAILED, TASK_SKIPPED
+from build_effective_lengths import build_effective_lengths, get_effective_lengths_filepath, USE_ADAPTIVE_DIRECTIONS
+from add_effective_length_info import add_escape_lines
+from build_spectra_on_grid import build_spectra_on_grid, get_spectra_on_grid_dir
+from build_spectral_data import build_spectral_data, get_spectral_data_dir, get_spectral_data_label_prefix, SPECTRAL_DATA_NH_AVERS, SPECTRAL_DATA_N_AVERS, SPECTRAL_DATA_A_FES, SPECTRAL_DATA_ALPHAS, get_alpha_label
+from do_measurements import do_measurements, do_nh_bins_measurements, do_line_measurements, get_measurements_filepath, get_nh_bins_measurements_filepath, get_line_measurements_filepath, get_considered_root_dirs, MEASUREMENT_NHS, MEASUREMENT_BOOTSTRAP_REPLICAS
+from measurement_table_utils import get_measurement_inputs_filepath
+from fluorescent_line_utils import FLUORESCENT_LINES
+from build_table_model import build_table_model, get_table_model_dir, TABLE_MODEL_FILL_VALUE
+from table_model_utils import TABLE_MODEL_COMPONENTS
+from agn_utils import AgnSimulationInfo, AGN_VIEWING_DIRECTIONS_DEG, get_iron_abundance_from_sim_name
+from agn_simulation_policy import get_effective_lengths_sidecar_filepath, get_escape_lines_sidecar_filepath
+from spectral_data_utils import simulations_root_dir
+from paths_in_this_machine import root_dirs, repo_directory
+from functools import partial
+from typing import List
+import agn_processing_policy
+import measurements
+import os
+
+PIPELINE_N_WORKERS = os.cpu_count()
+
+EFFECTIVE_LENGTHS_N_WORKERS = 1
+"""processes of every effective lengths task: the tasks already run in the PIPELINE_N_WORKERS processes
+"""
+
+NH_GRID_PARAMS = {name: getattr(agn_processing_policy, name)
+                  for name in ('LEFT_NH', 'RIGHT_NH', 'NH_INTERVALS')}
+
+ENERGY_GRID_PARAMS = {name: getattr(agn_processing_policy, name)
+                      for name in ('HV_LEFT', 'HV_RIGHT', 'HV_N_INTERVALS')}
+
+EFFECTIVE_LENGTHS_PARAMS = {name: getattr(agn_processing_policy, name)
+                            for name in ('TOTAL_DIRECTIONS', 'MAX_TOTAL_DIRECTIONS', 'NH_CONVERGENCE_BATCH_SIZE',
+                                         'NH_CONVERGENCE_TOLERANCE', 'NH_CONVERGENCE_MIN_BIN_FRACTION')}
+
+MEASUREMENT_PARAMS = {**{name: getattr(agn_processing_policy, name) for name in dir(agn_processing_policy) if name.startswith('HV_')},
+                      'EDGE_FIT_N_GRID_POINTS': measurements.EDGE_FIT_N_GRID_POINTS,
+                      'EDGE_FIT_GOLDEN_ITERATIONS': measurements.EDGE_FIT_GOLDEN_ITERATIONS,
+                      'MEASUREMENT_BOOTSTRAP_REPLICAS': MEASUREMENT_BOOTSTRAP_REPLICAS,
+                      'BOOTSTRAP_CONFIDENCE': measurements.BOOTSTRAP_CONFIDENCE}
+"""the measurement windows and the parameters of the fits
+"""
+
+
+def get_simulation_dirs(root_dir: str) -> List[str]:
+    return sorted(os.path.join(root_dir, sim_dir) for sim_dir in os.listdir(root_dir)
+                  if sim_dir not in ('past', 'spectral_data')
+                  and os.path.isdir(os.path.join(root_dir, sim_dir))
+                  and 'data' in os.listdir(os.path.join(root_dir, sim_dir)))
+
+
+def build_simulation_tasks(sim_root_dir: str) -> List[Task]:
+    """The escape lines, the effective lengths and the spectra on grid tasks of a simulation.
+    """
+    sim_info = AgnSimulationInfo.build_agn_simulation_info(
+        sim_root_dir=sim_root_dir)
+
+    tasks = [Task(name=f'escape lines {sim_root_dir}',
+                  action=partial(add_escape_lines, sim_root_dir),
+                  inputs=sim_info.simulation_files +
+                  ([sim_info.clouds_file_path]
+                   if not sim_info.is_smooth else []),
+                  outputs=[get_escape_lines_sidecar_filepath(
+                      simulation_file) for simulation_file in sim_info.simulation_files],
+                  code=get_code_closure('add_effective_length_info.py'))]
+
+    for alpha in AGN_VIEWING_DIRECTIONS_DEG:
+        effective_lengths_filepath = get_effective_lengths_filepath(
+            sim_root_dir, alpha)
+
+        tasks.append(Task(name=f'effective lengths {sim_root_dir} {alpha}',
+                          action=partial(
+                              build_effective_lengths, sim_root_dir, alpha, n_workers=EFFECTIVE_LENGTHS_N_WORKERS),
+                          inputs=[sim_info.file_path] +
+                          ([sim_info.clouds_file_path]
+                           if not sim_info.is_smooth else []),
+                          outputs=[effective_lengths_filepath,
+                                   get_effective_lengths_sidecar_filepath(effective_lengths_filepath)],
+                          params={'alpha': alpha, 'USE_ADAPTIVE_DIRECTIONS': USE_ADAPTIVE_DIRECTIONS,
+                                  **EFFECTIVE_LENGTHS_PARAMS, **NH_GRID_PARAMS},
+                          code=get_code_closure('build_effective_lengths.py')))
+
+        tasks.append(Task(name=f'spectra on grid {sim_root_dir} {alpha}',
+                          action=partial(
+                              build_spectra_on_grid, sim_root_dir, alpha),
+                          inputs=[sim_info.file_path] + sim_info.simulation_files +
+                          [get_escape_lines_sidecar_filepath(
+                              simulation_file) for simulation_file in sim_info.simulation_files],
+                          outputs=[get_spectra_on_grid_dir(
+                              sim_root_dir, alpha)],
+                          params={'alpha': alpha,
+                                  **NH_GRID_PARAMS, **ENERGY_GRID_PARAMS},
+                          code=get_code_closure('build_spectra_on_grid.py')))
+
+    return tasks
+
+
+def build_spectral_data_tasks() -> List[Task]:
+    """The spectral data tasks of the combinations that have simulations.
+    """
+    tasks = []
+    for nh_aver in SPECTRAL_DATA_NH_AVERS:
+        sims_root_dir = simulations_root_dir(nh_aver=nh_aver)
+
+        if not os.path.isdir(sims_root_dir):
+            continue
+
+        simulations = [AgnSimulationInfo.build_agn_simulation_info(sim_root_dir=sim_root_dir)
+                       for sim_root_dir in get_simulation_dirs(sims_root_dir)]
+
+        for n_aver in SPECTRAL_DATA_N_AVERS:
+            for a_fe in SPECTRAL_DATA_A_FES:
+                combination = [simulation for simulation in simulations
+                               if simulation.n_aver == n_aver
+                               and get_iron_abundance_from_sim_name(simulation_name=os.path.basename(simulation.sim_root_dir)) == a_fe]
+
+                if not combination:
+                    continue
+
+                for alpha in SPECTRAL_DATA_ALPHAS:
+                    alpha_label = get_alpha_label(alpha)
+
+                    tasks.append(Task(name=f'spectral data {nh_aver:0.2g} {n_aver} {a_fe} {alpha_label}',
+                                      action=partial(build_spectral_data, nh_aver=nh_aver,
+                                                     n_aver=n_aver, a_fe=a_fe, alpha=alpha),
+                                      inputs=[path for simulation in combination
+                                              for path in (get_effective_lengths_filepath(simulation.sim_root_dir, alpha_label),
+                                                           get_spectra_on_grid_dir(simulation.sim_root_dir, alpha_label))],
+                                      outputs=[os.path.join(get_spectral_data_dir(sims_root_dir),
+                                                            f'{get_spectral_data_label_prefix(sims_root_dir, n_aver, a_fe, alpha)}*')],
+                                      params={'alpha': alpha_label,
+                                              **NH_GRID_PARAMS, **ENERGY_GRID_PARAMS},
+                                      code=get_code_closure('build_spectral_data.py')))
+
+    return tasks
+
+
+def build_measurements_task() -> Task:
+    measurements_filepath = get_measurements_filepath()
+
+    return Task(name='measurements',
+                action=do_measurements,
+                inputs=[get_spectral_data_dir(root_dir)
+                        for root_dir in get_considered_root_dirs()],
+                outputs=[measurements_filepath,
+                         get_measurement_inputs_filepath(measurements_filepath)],
+                incremental=True,
+                params={'MEASUREMENT_NHS': MEASUREMENT_NHS,
+                        **NH_GRID_PARAMS, **MEASUREMENT_PARAMS},
+                code=get_code_closure('do_measurements.py'))
+
+
+def build_nh_bins_measurements_task() -> Task:
+    return Task(name='nh bins measurements',
+                action=do_nh_bins_measurements,
+                inputs=[get_spectral_data_dir(root_dir)
+                        for root_dir in get_considered_root_dirs()],
+                outputs=[get_nh_bins_measurements_filepath()],
+                params={'MIN_NH_BIN_COUNTS': measurements.MIN_NH_BIN_COUNTS,
+                        **NH_GRID_PARAMS, **MEASUREMENT_PARAMS},
+                code=get_code_closure('do_measurements.py'))
+
+
+def build_line_measurements_task() -> Task:
+    return Task(name='line measurements',
+                action=do_line_measurements,
+                inputs=[get_spectral_data_dir(root_dir)
+                        for root_dir in get_considered_root_dirs()],
+                outputs=[get_line_measurements_filepath()],
+                params={'MEASUREMENT_NHS': MEASUREMENT_NHS,
+                        'FLUORESCENT_LINES': FLUORESCENT_LINES,
+                        **NH_GRID_PARAMS},
+                code=get_code_closure('do_measurements.py'))
+
+
+def build_table_model_task() -> Task:
+    return Task(name='table model',
+                action=build_table_model,
+                inputs=[get_spectral_data_dir(root_dir)
+                        for root_dir in get_considered_root_dirs()],
+                outputs=[get_table_model_dir(smooth=False),
+                         get_table_model_dir(smooth=True)],
+                params={'TABLE_MODEL_COMPONENTS': TABLE_MODEL_COMPONENTS, 'TABLE_MODEL_FILL_VALUE': TABLE_MODEL_FILL_VALUE,
+                        **NH_GRID_PARAMS, **ENERGY_GRID_PARAMS},
+                code=get_code_closure('build_table_model.py'))
+
+
+def build_pipeline() -> Pipeline:
+    tasks = [task for root_dir in root_dirs
+             for sim_root_dir in get_simulation_dirs(root_dir)
+             for task in build_simulation_tasks(sim_root_dir)]
+
+    tasks += build_spectral_data_tasks()
+    tasks += [build_measurements_task(), build_nh_bins_measurements_task(),
+              build_line_measurements_task(), build_table_model_task()]
+
+    return Pipeline(tasks=tasks, state_dir=os.path.join(repo_directory, PIPELINE_STATE_DIR_LABEL))
+
+
+if __name__ == '__main__':
+    results = build_pipeline().run(n_workers=PIPELINE_N_WORKERS)
+
+    print_pipeline_summary(results)
+
+    if any(result.status in (TASK_FAILED, TASK_SKIPPED) for result in results):
+        exit(-1)
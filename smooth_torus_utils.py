@@ -0,0 +1,195 @@
+"""
+This module gives the path lengths through a smooth (uniform) torus in closed form,
+so the smooth simulations don't need to trace random directions through clouds.
+
+The smooth torus is the spherical shell r1 <= r <= r2 without the two polar
+cones of half opening angle theta (measured from the oz axis), ie the points
+whose polar angle is in [theta, pi - theta].
+
+All the lengths must be given in the same units, and the angles in radians.
+
+==================================
+
+Example-01: 'path lengths of rays through a smooth torus'
+
+lengths = smooth_torus_path_lengths(origins=origins, directions=directions,
+                                    r1=sim_info.r1, r2=sim_info.r2, theta=sim_info.theta)
+
+==================================
+
+Example-02: 'column density distribution of a smooth torus'
+
+histogram = build_smooth_torus_nh_histogram(sim_info=sim_info,
+                                            alpha=AngularInterval(60, 15),
+                                            nh_grid=DEFAULT_NH_GRID)
+
+nh_distribution = ColumnDensityDistribution(nh_grid=DEFAULT_NH_GRID, histogram=histogram)
+
+==================================
+"""
+from __future__ import annotations
+from utils import *
+from agn_utils import AgnSimulationInfo
+from agn_processing_policy import TOTAL_DIRECTIONS
+from colum_density_utils import ColumnDensityGrid, get_hydrogen_concentration
+
+
+def is_inside_smooth_torus(points: np.ndarray, r1: float, r2: float, theta: float) -> np.ndarray:
+    """Checks which points are inside the smooth torus.
+
+    Args:
+        points (np.ndarray): (n, 3) points
+        r1 (float): internal radius of the torus
+        r2 (float): external radius of the torus
+        theta (float): half opening angle of the torus
+
+    Returns:
+        np.ndarray: (n,) booleans
+    """
+    r = np.linalg.norm(points, axis=-1)
+    return (r1 <= r) & (r <= r2) & (np.abs(points[..., 2]) <= np.cos(theta)*r)
+
+
+def _quadratic_roots(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Real roots of a*t^2 + b*t + c = 0 (nan where there are none).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        discriminant = b**2 - 4*a*c
+        root = np.sqrt(discriminant)
+        # numerically stable form, see Numerical Recipes 5.6
+        q = -0.5*(b + np.copysign(root, b))
+        t_1 = np.where(a != 0, q/a, -c/b)
+        t_2 = np.where((a != 0) & (q != 0), c/q, np.nan)
+        no_roots = discriminant < 0
+        return np.where(no_roots, np.nan, t_1), np.where(no_roots, np.nan, t_2)
+
+
+def smooth_torus_path_lengths(origins: np.ndarray, directions: np.ndarray, r1: float, r2: float, theta: float) -> np.ndarray:
+    """Returns the length of the rays inside the smooth torus.
+
+    The rays start at the origins and go to infinity along the (unit) directions.
+    The ray is split at its intersections with both spheres and with the
+    cones, and the pieces inside the torus are summed up.
+
+    Args:
+        origins (np.ndarray): (n, 3) origins of the rays
+        directions (np.ndarray): (n, 3) unit directions of the rays
+        r1 (float): internal radius of the torus
+        r2 (float): external radius of the torus
+        theta (float): half opening angle of the torus
+
+    Returns:
+        np.ndarray: (n,) path lengths
+    """
+    directions = np.asarray(directions, dtype=float)
+    origins = np.broadcast_to(np.asarray(
+        origins, dtype=float), directions.shape)
+
+    o_d = np.sum(origins*directions, axis=1)
+    o_o = np.sum(origins**2, axis=1)
+    cos2 = np.cos(theta)**2
+
+    roots = [*_quadratic_roots(np.ones(len(directions)), 2*o_d, o_o - r1**2),
+             *_quadratic_roots(np.ones(len(directions)), 2*o_d, o_o - r2**2),
+             *_quadratic_roots(directions[:, 2]**2 - cos2,
+                               2*(origins[:, 2]*directions[:, 2] - cos2*o_d),
+                               origins[:, 2]**2 - cos2*o_o)]
+
+    # nothing is inside the torus beyond the exit of the external sphere
+    t_far = np.nan_to_num(np.fmax(roots[2], roots[3]), nan=0.0)
+    t_far = np.maximum(t_far, 0)
+
+    breakpoints = np.stack(
+        [np.zeros(len(directions)), t_far] + roots, axis=1)
+    breakpoints = np.clip(np.nan_to_num(breakpoints, nan=0.0),
+                          0, t_far[:, np.newaxis])
+    breakpoints.sort(axis=1)
+
+    mid_t = (breakpoints[:, 1:] + breakpoints[:, :-1])/2
+    mid_points = origins[:, np.newaxis, :] + \
+        mid_t[..., np.newaxis]*directions[:, np.newaxis, :]
+
+    inside = is_inside_smooth_torus(mid_points, r1, r2, theta)
+
+    return np.sum(np.diff(breakpoints, axis=1)*inside, axis=1)
+
+
+def smooth_torus_path_lengths_from_center(directions: np.ndarray, r1: float, r2: float, theta: float) -> np.ndarray:
+    """Returns the length inside the smooth torus of the rays that start at its center.
+
+    Args:
+        directions (np.ndarray): (n, 3) unit directions of the rays
+        r1 (float): internal radius of the torus
+        r2 (float): external radius of the torus
+        theta (float): half opening angle of the torus
+
+    Returns:
+        np.ndarray: (n,) path lengths
+    """
+    return np.where(np.abs(directions[:, 2]) <= np.cos(theta), r2 - r1, 0.0)
+
+
+def smooth_torus_covering_fraction(alpha: AngularInterval, theta: float) -> float:
+    """Fraction of the solid angle of the viewing angular interval
+    that is covered by the smooth torus.
+
+    Args:
+        alpha (AngularInterval): viewing angular interval (from the oz axis) in radians
+        theta (float): half opening angle of the torus
+
+    Returns:
+        float: the covered fraction
+    """
+    beg = max(alpha.beg, theta)
+    end = min(alpha.end, np.pi - theta)
+
+    if end <= beg:
+        return 0.0
+
+    return (np.cos(beg) - np.cos(end))/(np.cos(alpha.beg) - np.cos(alpha.end))
+
+
+def build_smooth_torus_nh_histogram(sim_info: AgnSimulationInfo,
+                                   alpha: AngularInterval,
+                                   nh_grid: ColumnDensityGrid,
+                                   n_directions: int = TOTAL_DIRECTIONS) -> Histo:
+    """Builds the (not normalized) histogram of the column densities of the smooth
+    torus as seen from its center in the given viewing angle, without sampling directions.
+
+    The directions through the torus have the column density n_H*(r2-r1), the rest
+    have no column density at all, thus they are counted in the underflow.
+
+    Args:
+        sim_info (AgnSimulationInfo): the simulation info of a smooth torus
+        alpha (AngularInterval): viewing angular interval in degrees, see AGN_VIEWING_DIRECTIONS_DEG
+        nh_grid (ColumnDensityGrid): the grid of the histogram
+        n_directions (int, optional): number of directions that the histogram represents. Defaults to TOTAL_DIRECTIONS.
+
+    Returns:
+        Histo: the histogram of the column densities
+    """
+    hydrogen_concentration = get_hydrogen_concentration(aver_column_density=sim_info.nh_aver,
+                                                        filling_factor=sim_info.phi,
+                                                        internal_torus_radius=sim_info.r1,
+                                                        external_torus_radius=sim_info.r2)
+
+    torus_nh = hydrogen_concentration*(sim_info.r2 - sim_info.r1)
+    fraction = smooth_torus_covering_fraction(
+        alpha=alpha.from_deg_to_rad(), theta=sim_info.theta)
+
+    counts, underflow, overflow = nh_grid.histogram(np.array([torus_nh]))
+
+    histogram = Histo(bins=np.array(nh_grid.nh_list),
+                      counts=counts*fraction*n_directions,
+                      counts_err=np.sqrt(counts*fraction*n_directions),
+                      raw_data=None,
+                      underflow=(underflow*fraction + (1-fraction))*n_directions,
+                      overflow=overflow*fraction*n_directions,
+                      raw_count=n_directions,
+                      raw_mean=fraction*torus_nh,
+                      raw_m2=n_directions*fraction*(1-fraction)*torus_nh**2)
+
+    histogram.underflow_err = histogram.underflow**0.5
+    histogram.overflow_err = histogram.overflow**0.5
+
+    return histogram
@@ -5,14 +5,15 @@ obtained from the simulations processed spectra.
 """
 from utils import AngularInterval
 from paths_in_this_machine import repo_directory
-from typing import Final, Dict, List
+from typing import Final, Dict, List, Tuple
 from agn_utils import *
 import os
 import numpy as np
 from colum_density_utils import ColumnDensityGrid, ColumnDensityDistribution
 from agn_processing_policy import *
 from spectrum_utils import SpectrumCount, PoissonSpectrumCountFactory
-from flux_density_utils import FluxDensityBuilder, FluxDensity
+from flux_density_utils import FluxDensityBuilder, FluxDensity, FluxDensityNormalizationContext
+from fluorescent_line_utils import FLUORESCENT_LINES
 
 
 IRON_ABUNDANCES = {
@@ -55,11 +56,23 @@ def simulations_root_dir(nh_aver: float) -> str:
             f'The simulation directory for nh={nh_aver} cannot be determined!')
 
 
+SPECTRA_LABELLING_VERSION: Final[int] = 2
+"""Version of the NH labelling of the spectra on grid. Version 2 keeps the
+photons without column density (nh=0) and the ones out of the grid out of
+the grid bins, the directories printed by the version 1 put them in the first
+bin and must not be reused."""
+
+
+def get_spectra_directory_name_for_label(alpha_label: str, grid: ColumnDensityGrid) -> str:
+    return (f'THETA_{alpha_label}_nh_grid_{grid.n_intervals}_{grid.left:0.2g}_{grid.right:0.2g}'
+            f'_v{SPECTRA_LABELLING_VERSION}')
+
+
 def get_spectra_directory_name(alpha: AngularInterval, grid: ColumnDensityGrid) -> str:
 
     for label in AGN_VIEWING_DIRECTIONS_DEG:
         if AGN_VIEWING_DIRECTIONS_DEG[label] == alpha:
-            return f'THETA_{label}_nh_grid_{grid.n_intervals}_{grid.left:0.2g}_{grid.right:0.2g}'
+            return get_spectra_directory_name_for_label(alpha_label=label, grid=grid)
 
 
 def get_spectra_directories(simulations: List[AgnSimulationInfo], alpha: AngularInterval, grid: ColumnDensityGrid):
@@ -113,112 +126,171 @@ def get_grouped_spectra_files(spectra_dirs: List[str]) -> Dict[SpectrumKind, Lis
     return spectra
 
 
-def build_continuum_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount]) -> Dict[SpectrumKind, SpectrumCount]:
-
-    data_map: Dict[SpectrumKind, SpectrumCount] = {}
+@dataclass
+class SpectrumComponent:
+    """Describes how a spectral component (continuum, transmitted, etc)
+    is assembled from the grouped spectra of the simulations.
 
-    for spectrum_key in grouped_spectra:
+    A grouped spectrum contributes to the component if its type label
+    is in type_labels (or type_labels is None) and its line label
+    equals line_label (or line_label is None).
+    """
 
-        if spectrum_key.type_label in ('NOINTERACTION', 'SCATTERING'):
+    component_type_label: str
+    """type label of the resulting spectrum, for example: CONTINUUM
+    """
 
-            continuum_spectrum_key = SpectrumKind(
-                grid_id=None, type_label='CONTINUUM', line_label='NONE')
+    component_line_label: str
+    """line label of the resulting spectrum, for example: NONE/FeKalpha
+    """
 
-            continuum_spectrum_key.grid_id = spectrum_key.grid_id
+    type_labels: Tuple[str, ...] = None
+    """accepted photon type labels, None accepts every type
+    """
 
-            if continuum_spectrum_key not in data_map:
-                data_map[continuum_spectrum_key] = grouped_spectra[spectrum_key]
-            else:
-                data_map[continuum_spectrum_key].y += grouped_spectra[spectrum_key].y
-                data_map[continuum_spectrum_key].y_err = data_map[continuum_spectrum_key].y**0.5
+    line_label: str = None
+    """accepted line label, None accepts every line
+    """
 
-    return data_map
+    def accepts(self, spectrum_kind: SpectrumKind) -> bool:
+        if self.type_labels is not None and spectrum_kind.type_label not in self.type_labels:
+            return False
+        if self.line_label is not None and spectrum_kind.line_label != self.line_label:
+            return False
+        return True
+
+    def build_key(self, grid_id: int) -> SpectrumKind:
+        return SpectrumKind(grid_id=grid_id,
+                            type_label=self.component_type_label,
+                            line_label=self.component_line_label)
+
+
+SPECTRUM_COMPONENTS: Final[Dict[str, SpectrumComponent]] = {
+    'CONTINUUM': SpectrumComponent(component_type_label='CONTINUUM', component_line_label='NONE',
+                                   type_labels=('NOINTERACTION', 'SCATTERING')),
+    'FEKALPHA': SpectrumComponent(component_type_label='FLUORESCENT', component_line_label='FeKalpha',
+                                  line_label='FeKalpha'),
+    'TRANSMITTED': SpectrumComponent(component_type_label='TRANSMITTED', component_line_label='NONE',
+                                     type_labels=('NOINTERACTION', 'SOURCE')),
+    'COMPTON': SpectrumComponent(component_type_label='COMPTON', component_line_label='NONE',
+                                 type_labels=('SCATTERING',)),
+    **{label.upper(): SpectrumComponent(component_type_label='FLUORESCENT', component_line_label=label,
+                                        line_label=label)
+       for label in FLUORESCENT_LINES if label != 'FeKalpha'},
+}
+"""The spectral components that we extract from the grouped spectra,
+in the order in which they are written to the spectral_data/ directories.
+There is a fluorescent component for every registered line (see FLUORESCENT_LINES).
+"""
 
 
-def build_transmitted_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount]) -> Dict[SpectrumKind, SpectrumCount]:
+def build_component_spectra_maps(grouped_spectra: Dict[SpectrumKind, SpectrumCount],
+                                 components: Dict[str, SpectrumComponent] = SPECTRUM_COMPONENTS) -> Dict[str, Dict[SpectrumKind, SpectrumCount]]:
+    """Builds all the spectral components in a single pass over the grouped spectra.
 
-    data_map: Dict[SpectrumKind, SpectrumCount] = {}
+    The counts of every component are accumulated into freshly allocated arrays,
+    so the grouped spectra are never modified and one component cannot
+    corrupt another. The Poisson errors are computed once, at the end.
 
-    for spectrum_key in grouped_spectra:
+    Example:
 
-        if spectrum_key.type_label in ('NOINTERACTION', 'SOURCE'):
+        component_spectra = build_component_spectra_maps(grouped_spectra)
 
-            continuum_spectrum_key = SpectrumKind(
-                grid_id=None, type_label='TRANSMITTED', line_label='NONE')
+        continuum_spectra = component_spectra['CONTINUUM']
 
-            continuum_spectrum_key.grid_id = spectrum_key.grid_id
+    Args:
+        grouped_spectra (Dict[SpectrumKind, SpectrumCount]): the grouped spectra, see group_spectra()
+        components (Dict[str, SpectrumComponent], optional): the components to build. Defaults to SPECTRUM_COMPONENTS.
 
-            if continuum_spectrum_key not in data_map:
-                data_map[continuum_spectrum_key] = grouped_spectra[spectrum_key]
-            else:
-                data_map[continuum_spectrum_key].y += grouped_spectra[spectrum_key].y
-                data_map[continuum_spectrum_key].y_err = data_map[continuum_spectrum_key].y**0.5
+    Raises:
+        ValueError: if two spectra contributing to the same component have different lengths.
 
-    return data_map
+    Returns:
+        Dict[str, Dict[SpectrumKind, SpectrumCount]]: {component_label -> {component_key -> spectrum}}
+    """
 
+    first_spectra: Dict[str, Dict[SpectrumKind, SpectrumCount]] = {
+        label: {} for label in components}
+    y_maps: Dict[str, Dict[SpectrumKind, np.ndarray]] = {
+        label: {} for label in components}
 
-def build_compton_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount]) -> Dict[SpectrumKind, SpectrumCount]:
+    for spectrum_key in grouped_spectra:
 
-    data_map: Dict[SpectrumKind, SpectrumCount] = {}
+        spectrum = grouped_spectra[spectrum_key]
 
-    for spectrum_key in grouped_spectra:
+        for component_label in components:
 
-        if spectrum_key.type_label in ('SCATTERING'):
+            component = components[component_label]
 
-            continuum_spectrum_key = SpectrumKind(
-                grid_id=None, type_label='COMPTON', line_label='NONE')
+            if not component.accepts(spectrum_key):
+                continue
 
-            continuum_spectrum_key.grid_id = spectrum_key.grid_id
+            component_key = component.build_key(spectrum_key.grid_id)
+            y_map = y_maps[component_label]
 
-            if continuum_spectrum_key not in data_map:
-                data_map[continuum_spectrum_key] = grouped_spectra[spectrum_key]
+            if component_key not in y_map:
+                first_spectra[component_label][component_key] = spectrum
+                y_map[component_key] = np.array(spectrum.y, dtype=float)
+            elif not first_spectra[component_label][component_key].same_grid(spectrum):
+                raise ValueError(
+                    f'The spectrum {spectrum_key} cannot be added to {component_key}: the energy grids are different!')
             else:
-                data_map[continuum_spectrum_key].y += grouped_spectra[spectrum_key].y
-                data_map[continuum_spectrum_key].y_err = data_map[continuum_spectrum_key].y**0.5
+                y_map[component_key] += spectrum.y
 
-    return data_map
+    return {
+        component_label: {
+            component_key: _build_component_spectrum(first_spectra[component_label][component_key],
+                                                     y_maps[component_label][component_key])
+            for component_key in y_maps[component_label]}
+        for component_label in components}
 
 
-def build_fekalpha_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount]) -> Dict[SpectrumKind, SpectrumCount]:
+def _build_component_spectrum(first_spectrum: SpectrumCount, y: np.ndarray) -> SpectrumCount:
+    if first_spectrum.grid is not None:
+        return SpectrumCount(None, y, np.sqrt(y), grid=first_spectrum.grid, grid_offset=first_spectrum.grid_offset)
 
-    data_map: Dict[SpectrumKind, SpectrumCount] = {}
+    return SpectrumCount(np.array(first_spectrum.x, dtype=float), y, np.sqrt(y))
 
-    for spectrum_key in grouped_spectra:
 
-        if spectrum_key.line_label == 'FeKalpha':
+def _build_component_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount], component_label: str) -> Dict[SpectrumKind, SpectrumCount]:
+    return build_component_spectra_maps(grouped_spectra=grouped_spectra,
+                                        components={component_label: SPECTRUM_COMPONENTS[component_label]})[component_label]
 
-            continuum_spectrum_key = SpectrumKind(
-                grid_id=spectrum_key.grid_id, type_label='FLUORESCENT', line_label='FeKalpha')
 
-            if continuum_spectrum_key not in data_map:
-                data_map[continuum_spectrum_key] = grouped_spectra[spectrum_key]
-            else:
-                data_map[continuum_spectrum_key].y += grouped_spectra[spectrum_key].y
-                data_map[continuum_spectrum_key].y_err = data_map[continuum_spectrum_key].y**0.5
+def build_continuum_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount]) -> Dict[SpectrumKind, SpectrumCount]:
+    return _build_component_spectra_map(grouped_spectra, 'CONTINUUM')
 
-    return data_map
+
+def build_transmitted_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount]) -> Dict[SpectrumKind, SpectrumCount]:
+    return _build_component_spectra_map(grouped_spectra, 'TRANSMITTED')
+
+
+def build_compton_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount]) -> Dict[SpectrumKind, SpectrumCount]:
+    return _build_component_spectra_map(grouped_spectra, 'COMPTON')
+
+
+def build_fekalpha_spectra_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount]) -> Dict[SpectrumKind, SpectrumCount]:
+    return _build_component_spectra_map(grouped_spectra, 'FEKALPHA')
 
 
 def build_key_spectrum_flux_density_map(grouped_spectra: Dict[SpectrumKind, SpectrumCount], nh_distribution: ColumnDensityDistribution, source_spectrum: SpectrumCount, alpha_deg: AngularInterval) -> Dict[SpectrumKind, Tuple[SpectrumCount, FluxDensity]]:
 
-    data_map = {}
+    context = FluxDensityNormalizationContext.build(norm_spectrum=source_spectrum,
+                                                    angle_interval=alpha_deg.from_deg_to_rad())
 
-    for spectrum_key in grouped_spectra:
+    # the spectra that are not on the energy grid of the source spectrum cannot be normalized
+    spectrum_keys = [spectrum_key for spectrum_key in grouped_spectra if FluxDensityBuilder.is_on_context_grid(
+        grouped_spectra[spectrum_key], context)]
 
-        nh = nh_distribution.grid.nh_list[spectrum_key.grid_id]
-        spectrum = grouped_spectra[spectrum_key]
-        try:
-            flux_density = FluxDensityBuilder.build_flux_density_for_given_nh(spectrum_count=spectrum,
-                                                                              norm_spectrum=source_spectrum,
-                                                                              angle_interval=alpha_deg.from_deg_to_rad(),
-                                                                              nh=nh,
-                                                                              nh_distribution=nh_distribution)
-
-            data_map[spectrum_key] = (spectrum, flux_density)
-        except:
-            continue
-
-    return data_map
+    flux_densities = FluxDensityBuilder.build_flux_densities_for_given_nhs(
+        spectra_counts=[grouped_spectra[spectrum_key]
+                        for spectrum_key in spectrum_keys],
+        nhs=[nh_distribution.grid.bin_nh(spectrum_key.grid_id)
+             for spectrum_key in spectrum_keys],
+        nh_distribution=nh_distribution,
+        context=context)
+
+    return {spectrum_key: (grouped_spectra[spectrum_key], flux_density) for spectrum_key, flux_density in zip(spectrum_keys, flux_densities)}
 
 
 def get_nh_aver_label(sims_root_dir: str):
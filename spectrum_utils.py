@@ -4,10 +4,12 @@ from utils import *
 from agn_utils import AgnSimulationInfo, AGN_SOURCE_DATA_STORAGE_PREFIX
 from colum_density_utils import ColumnDensityGrid, get_hydrogen_concentration
 from agn_processing_policy import *
+from energy_grid_utils import EnergyGrid, log_interval_index
 from photon_register_policy import PhotonInfo, PhotonType, AgnPhotonUnitsPolicy
+from escape_lines_utils import load_escape_lines, is_photon_line
 from io import TextIOWrapper
 import os
-import subprocess
+from job_runner_utils import Job, run_jobs, print_jobs_summary
 from paths_in_this_machine import PATH_TO_CREATE_SOURCE_SPECTRA_DIR, ERRORS_LOG_FILE
 
 """TODO"""
@@ -34,14 +36,55 @@ def get_interval_index_log(value: float, value_interval: Interval2D, num_of_inte
     The whole value interval is in a log10 scale
 
     Args:
-        value (float): energy withing the interval
+        value (float): energy withing the interval, it can also be an array of energies
         value_interval (Interval2D): Full value interval
         num_of_intervals (int): number of bins
 
     Returns:
         int: the value interval index
     """
-    return int(num_of_intervals * (np.log10(value/value_interval.left))/(np.log10(value_interval.right/value_interval.left)))
+    return log_interval_index(value, value_interval.left, value_interval.right, num_of_intervals)
+
+
+@dataclass
+class SpectrumPrefixSums:
+    """
+    The cumulative sums of a spectrum, so the sums and the (trapezoid)
+    areas on any window x[start:stop] are just two lookups.
+    """
+
+    area: np.ndarray
+    """area[i] is the trapezoid area of the first i+1 points
+    """
+
+    y: np.ndarray
+    """y[i] is the sum of the first i values
+    """
+
+    y_err2: np.ndarray
+    """y_err2[i] is the sum of the first i squared errors
+    """
+
+    @staticmethod
+    def build(spectrum: SpectrumBase) -> SpectrumPrefixSums:
+        x, y, y_err = (np.asarray(a, dtype=float)
+                       for a in (spectrum.x, spectrum.y, spectrum.y_err))
+
+        def cumsum0(values):
+            return np.concatenate(([0.0], np.cumsum(values)))
+
+        return SpectrumPrefixSums(area=cumsum0((y[1:] + y[:-1])*np.diff(x)/2),
+                                  y=cumsum0(y),
+                                  y_err2=cumsum0(y_err**2))
+
+    def get_area(self, start: int, stop: int) -> float:
+        return self.area[stop-1] - self.area[start] if stop - start >= 2 else 0.0
+
+    def get_sum(self, start: int, stop: int) -> float:
+        return self.y[stop] - self.y[start]
+
+    def get_err2_sum(self, start: int, stop: int) -> float:
+        return self.y_err2[stop] - self.y_err2[start]
 
 
 class SpectrumBase:
@@ -53,23 +96,37 @@ class SpectrumBase:
 
         y_err: the error on y values, for example the standard deviation
 
-        Both x,y,y_err are grouped into @SpectrumBaseItem objects
+        Both x,y,y_err can be accessed as @SpectrumBaseItem objects (built on demand)
+
+        grid: the energy grid of the spectrum (optional), in this case
+              x are the centers grid.centers[grid_offset:grid_offset+len(y)]
 
     The user has to determine the meaning and units of x and y.
 
     The spectrum is also iterable.
+
+    The window queries (area, average, flux) use cumulative sums that are built
+    on the first query, thus call invalidate_prefix_sums() after modifying y or y_err.
     """
 
     def __init__(self, x: Iterable[float],
                  y: Iterable[float],
-                 y_err: Iterable[float], interval: Interval2D = None):
+                 y_err: Iterable[float], interval: Interval2D = None,
+                 grid: EnergyGrid = None, grid_offset: int = 0):
         """Creates an instance of the class.
 
         Args:
-            x (Iterable[float]): the x coordinate values, for example energy
+            x (Iterable[float]): the x coordinate values, for example energy. It can be None if the grid is given.
             y (Iterable[float]): the spectrum values, for example flux-density
             y_err (Iterable[float]): the error on y values, for example the standard deviation
+            grid (EnergyGrid, optional): the energy grid of the spectrum. Defaults to None.
+            grid_offset (int, optional): index of the first bin of the spectrum on the grid. Defaults to 0.
         """
+        if x is None and grid is not None:
+            x = grid.centers[grid_offset:grid_offset+len(y)]
+
+        x, y, y_err = np.asarray(x), np.asarray(y), np.asarray(y_err)
+
         if len(x) == len(y) == len(y_err):
             self.length = len(x)
             self.pos = 0
@@ -77,24 +134,33 @@ class SpectrumBase:
             self.x = x
             self.y = y
             self.y_err = y_err
+            self.grid = grid
+            self.grid_offset = grid_offset
+            self._x_is_sorted = None
+            self._prefix_sums = None
 
             if interval:
                 self.interval = interval
-            else:
+            elif len(x) > 0:
                 self.interval = Interval2D(x[0], x[-1])
 
-            self.spectrum_list = np.empty(len(x), dtype=SpectrumBaseItem)
-            for i in range(len(x)):
-                self.spectrum_list[i] = SpectrumBaseItem(x[i], y[i], y_err[i])
-
         else:
-            raise ValueAndError('The length of x,y, and y_err must be equal!')
+            raise ValueError('The length of x,y, and y_err must be equal!')
+
+    @property
+    def spectrum_list(self) -> np.ndarray:
+        """the spectrum as an array of SpectrumBaseItem objects (built on every call)
+        """
+        spectrum_list = np.empty(self.length, dtype=SpectrumBaseItem)
+        for i in range(self.length):
+            spectrum_list[i] = self[i]
+        return spectrum_list
 
     def __next__(self):
         pos = self.pos
         if pos < self.length:
             self.pos += 1
-            return self.spectrum_list[pos]
+            return self[pos]
         else:
             self.pos = 0
             raise StopIteration
@@ -104,10 +170,10 @@ class SpectrumBase:
 
     def __getitem__(self, index: int) -> SpectrumBaseItem:
 
-        return self.spectrum_list[index]
+        return SpectrumBaseItem(self.x[index], self.y[index], self.y_err[index])
 
     def __len__(self) -> int:
-        return len(self.spectrum_list)
+        return self.length
 
     # def components(self) -> Tuple[Iterable[float], Iterable[float], Iterable[float]]:
     #     """Returns a tuple with the copy of
@@ -119,30 +185,178 @@ class SpectrumBase:
     #     """
     #     return self.x, self.y, self.y_err
 
+    def same_grid(self, other: SpectrumBase) -> bool:
+        """Checks if both spectra are defined on the same energy bins.
+
+        Args:
+            other (SpectrumBase): the other spectrum
+
+        Returns:
+            bool: True if both spectra share the grid and the bins
+        """
+        if self.grid is not None and other.grid is not None:
+            return self.grid is other.grid and self.grid_offset == other.grid_offset and len(self) == len(other)
+
+        return len(self) == len(other) and np.array_equal(self.x, other.x)
+
+    def grid_widths(self) -> np.ndarray:
+        """Returns the widths of the energy bins of the spectrum,
+        it requires the spectrum to be on a grid.
+        """
+        return self.grid.widths[self.grid_offset:self.grid_offset+len(self)]
+
     def algebraic_area(self):
         return np.trapz(x=self.x, y=self.y)
 
+    def prefix_sums(self) -> SpectrumPrefixSums:
+        """Returns the cumulative sums of the spectrum (built once).
+        """
+        if self._prefix_sums is None:
+            self._prefix_sums = SpectrumPrefixSums.build(self)
+        return self._prefix_sums
+
+    def invalidate_prefix_sums(self):
+        """Call it after modifying the spectrum in place.
+        """
+        self._prefix_sums = None
+
+    def window(self, energy_interval: EnergyInterval) -> Tuple[int, int]:
+        """Returns start, stop such that the spectrum on energy_interval is x[start:stop],
+        or None if x is not sorted (the window is not contiguous).
+        """
+        if self.grid is not None:
+            start, stop = self.grid.index_range(energy_interval)
+            start = min(max(start - self.grid_offset, 0), len(self))
+            stop = min(max(stop - self.grid_offset, start), len(self))
+            return start, stop
+
+        if not self._is_x_sorted():
+            return None
+
+        return self._index_range(energy_interval.left, energy_interval.right)
+
+    def area(self, energy_interval: EnergyInterval = None) -> float:
+        """Returns the trapezoid area of the spectrum on the given interval.
+
+        Args:
+            energy_interval (EnergyInterval, optional): the interval. Defaults to the whole spectrum.
+
+        Returns:
+            float: the area
+        """
+        if energy_interval is None:
+            return self.algebraic_area()
+
+        window = self.window(energy_interval)
+
+        if window is None:
+            return self.get_cpy_on_interval(energy_interval).algebraic_area()
+
+        return self.prefix_sums().get_area(*window)
+
+    def _weights_window(self, energy_interval: EnergyInterval) -> Tuple[int, int]:
+        if energy_interval is None:
+            return 0, len(self)
+
+        window = self.window(energy_interval)
+
+        if window is None:
+            raise ValueError(
+                'the weights of a window need the energies to be sorted!')
+
+        return window
+
+    def area_weights(self, energy_interval: EnergyInterval = None) -> np.ndarray:
+        """Returns the weights w such that w @ y is the area of the spectrum on the
+        given interval (see area()), to evaluate the area of many y at once.
+
+        Args:
+            energy_interval (EnergyInterval, optional): the interval. Defaults to the whole spectrum.
+
+        Raises:
+            ValueError: if the energies are not sorted.
+
+        Returns:
+            np.ndarray: the weights, one per bin
+        """
+        start, stop = self._weights_window(energy_interval)
+        half_widths = np.diff(np.asarray(self.x, dtype=float)[start:stop])/2
+
+        weights = np.zeros(len(self))
+        weights[start:stop-1] += half_widths
+        weights[start+1:stop] += half_widths
+
+        return weights
+
+    def average_weights(self, energy_interval: EnergyInterval = None) -> np.ndarray:
+        """Returns the weights w such that w @ y is the average of y on the given
+        interval (see average()).
+
+        Raises:
+            ValueError: if the energies are not sorted.
+        """
+        start, stop = self._weights_window(energy_interval)
+
+        if stop == start:
+            return np.full(len(self), np.nan)
+
+        weights = np.zeros(len(self))
+        weights[start:stop] = 1/(stop - start)
+
+        return weights
+
     # def algebraic_area_err(self):
     #     return np.sqrt(np.trapz(x=self.x, y=self.y_err**2))
 
     def get_cpy_on_interval(self, energy_interval: EnergyInterval):
-        """Returns the portion of the spectrum on the given interval
+        """Returns the portion of the spectrum on the given interval.
+
+        The portion shares the memory with this spectrum (the arrays
+        are views), so copy it before modifying it in place.
 
         Args:
-            left (float): left value of the interval
-            right (float): right value of the interval
+            energy_interval (EnergyInterval): the interval [left, right]
 
         Returns:
             SpectrumBase: portion of the spectrum on [left, right]
         """
-        cpy = self._get_cpy_on_interval(
-            energy_interval.left, energy_interval.right, None)
+        window = self.window(energy_interval)
+
+        if window is None:
+            inside = (energy_interval.left <= self.x) & (
+                self.x <= energy_interval.right)
+            return type(self)(x=self.x[inside], y=self.y[inside], y_err=self.y_err[inside])
+
+        return self._get_view(*window, type(self))
+
+    def _is_x_sorted(self) -> bool:
+        if self._x_is_sorted is None:
+            self._x_is_sorted = bool(np.all(self.x[1:] >= self.x[:-1]))
+        return self._x_is_sorted
+
+    def _index_range(self, left: float, right: float) -> Tuple[int, int]:
+        """start, stop such that x[start:stop] is in [left, right], for a sorted x.
+        """
+        start = int(np.searchsorted(self.x, left, side='left'))
+        stop = int(np.searchsorted(self.x, right, side='right'))
+        return start, max(start, stop)
+
+    def _get_view(self, start: int, stop: int, spectrum_type: type = None) -> SpectrumBase:
+        spectrum_type = spectrum_type if spectrum_type else SpectrumBase
 
-        return type(self)(x=cpy.x, y=cpy.y, y_err=cpy.y_err)
+        if self.grid is not None:
+            return spectrum_type(x=self.x[start:stop],
+                                 y=self.y[start:stop],
+                                 y_err=self.y_err[start:stop],
+                                 grid=self.grid,
+                                 grid_offset=self.grid_offset+start)
+
+        return spectrum_type(x=self.x[start:stop], y=self.y[start:stop], y_err=self.y_err[start:stop])
 
     def _get_cpy_on_interval(self, left: float, right: float = None, hole: bool = None):
         """
-        This function returns the spectrum on the given interval.
+        This function returns the spectrum on the given interval (it requires a sorted x).
+        The resulting spectrum shares the memory with this spectrum.
 
         If the right parameter is not passed and hole=True, then the right
         energy bound will be so that the height at that point
@@ -151,62 +365,53 @@ class SpectrumBase:
         starting at the left point.
         """
 
-        x, y, y_err = self.x, self.y, self.y_err
-
-        new_x = []
-        new_y = []
-        new_y_err = []
-        zipped = zip(x, y, y_err)
-        if right != None:
-            for x_i, y_i, y_err in zipped:
-                if(left <= x_i <= right):
-                    new_x += [x_i]
-                    new_y += [y_i]
-                    new_y_err += [y_err]
-        elif hole:
-            max_height = 0
-            for x_i, y_i, y_err in zipped:
-                if left <= x_i:
-                    if(max_height > 0 and y_i >= max_height):
-                        break
-                    new_x += [x_i]
-                    new_y += [y_i]
-                    new_y_err += [y_err]
-                    if(max_height <= 0):
-                        max_height = new_y[0]
-
-        elif hole == False:
-            max_height = 0
-            for x_i, y_i, y_err in zipped:
-                if left <= x_i:
-                    if(max_height > 0 and y_i <= max_height):
-                        break
-                    new_x += [x_i]
-                    new_y += [y_i]
-                    new_y_err += [y_err]
-
-                    if(max_height <= 0):
-                        max_height = new_y[0]
-
-        return SpectrumBase(np.array(new_x), np.array(new_y), np.array(new_y_err))
+        if right is not None:
+            return self._get_view(*self._index_range(left, right))
+
+        if hole is None:
+            return self._get_view(0, 0)
+
+        start = int(np.searchsorted(self.x, left, side='left'))
+
+        if start >= self.length or self.y[start] <= 0:
+            return self._get_view(start, self.length)
+
+        # the first point after start that reaches (hole) or falls to (peak) the first height
+        rest = self.y[start+1:]
+        reached = rest >= self.y[start] if hole else rest <= self.y[start]
+        ends = np.flatnonzero(reached)
+
+        stop = start + 1 + int(ends[0]) if len(ends) else self.length
+
+        return self._get_view(start, stop)
 
     def average_y(self, energy_interval: EnergyInterval) -> float:
-        subspectrum = self.get_cpy_on_interval(energy_interval)
-        return np.sum(subspectrum.y)/len(subspectrum.y)
+        return self.average(energy_interval).value
 
     def average(self, energy_interval: EnergyInterval = None) -> ValueAndError:
 
         if energy_interval == None:
             energy_interval = EnergyInterval(self.x[0], self.x[-1])
 
-        subspectrum = self.get_cpy_on_interval(energy_interval)
+        window = self.window(energy_interval)
+
+        if window is None:
+            subspectrum = self.get_cpy_on_interval(energy_interval)
+            aver_y = np.sum(subspectrum.y)/len(subspectrum.y)
+            aver_y_err = np.sqrt(np.sum(subspectrum.y_err**2)) / \
+                len(subspectrum.y_err)
+
+            return ValueAndError(value=aver_y, err=aver_y_err)
+
+        start, stop = window
+        n = stop - start
 
-        aver_x = np.sum(subspectrum.x)/len(subspectrum.x)
-        index = get_interval_index_log(aver_x, Interval2D(
-            energy_interval.left, energy_interval.right), len(subspectrum.x))
-        aver_y = np.sum(subspectrum.y)/len(subspectrum.y)
-        aver_y_err = np.sqrt(np.sum(subspectrum.y_err**2)) / \
-            len(subspectrum.y_err)
+        if n == 0:
+            return ValueAndError(value=np.nan, err=np.nan)
+
+        prefix_sums = self.prefix_sums()
+        aver_y = prefix_sums.get_sum(start, stop)/n
+        aver_y_err = np.sqrt(prefix_sums.get_err2_sum(start, stop))/n
 
         return ValueAndError(value=aver_y, err=aver_y_err)
 
@@ -217,6 +422,28 @@ class SpectrumBase:
         return self.x[0], self.x[-1]
 
 
+def window_sums(spectra: List[SpectrumBase], weights: List[np.ndarray], err_weights: List[np.ndarray]) -> List[UncertainArray]:
+    """Returns the weighted sums y @ w of every spectrum, with the errors sqrt(y_err**2 @ w_err**2),
+    one UncertainArray (one element per spectrum) per weight (see area_weights(), average_weights()).
+    The spectra are not stacked, so the memory doesn't grow with the number of spectra.
+
+    Args:
+        spectra (List[SpectrumBase]): the spectra, on the same energy bins
+        weights (List[np.ndarray]): the weights of the values, one per sum
+        err_weights (List[np.ndarray]): the weights of the errors, one per sum
+
+    Returns:
+        List[UncertainArray]: the sums, in the order of the weights
+    """
+    weights_matrix = np.transpose(weights)
+    err_weights2_matrix = np.transpose(err_weights)**2
+
+    sums = UncertainArray(value=[spectrum.y @ weights_matrix for spectrum in spectra],
+                          err=[np.sqrt(spectrum.y_err**2 @ err_weights2_matrix) for spectrum in spectra])
+
+    return [sums[:, i] for i in range(len(weights))]
+
+
 class SpectrumCount(SpectrumBase):
     """This class represents a the distribution-count
     of particles on the given x-coordinates. The x-coordinates
@@ -226,16 +453,19 @@ class SpectrumCount(SpectrumBase):
 
     def __init__(self, x: Iterable[float],
                  y: Iterable[float],
-                 y_err: Iterable[float], interval: Interval2D = None):
+                 y_err: Iterable[float], interval: Interval2D = None,
+                 grid: EnergyGrid = None, grid_offset: int = 0):
         """Creates an instance of the spectrum counts
 
         Args:
             x (Iterable[float]): spectrum x coordinates
             y (Iterable[float]): spectrum values
             y_err (Iterable[float]): errors on the spectrum values
+            grid (EnergyGrid, optional): the energy grid of the spectrum. Defaults to None.
+            grid_offset (int, optional): index of the first bin of the spectrum on the grid. Defaults to 0.
         """
 
-        super().__init__(x, y, y_err, interval)
+        super().__init__(x, y, y_err, interval, grid, grid_offset)
 
 
 class PoissonSpectrumCountFactory:
@@ -266,28 +496,23 @@ class PoissonSpectrumCountFactory:
 
         y_error = np.sqrt(y)
 
-        return SpectrumCount(x, y, y_error)
+        grid = EnergyGrid.find(x)
+
+        return SpectrumCount(x if grid is None else None, y, y_error, grid=grid)
 
     @staticmethod
     def build_log_empty_spectrum_count(hv_left: float, hv_right: float, n_intervals: int) -> SpectrumCount:
 
-        d_nh_expo = (np.log10(hv_right)-np.log10(hv_left))/n_intervals
-        hv_list = []
+        grid = EnergyGrid.build(left=hv_left, right=hv_right,
+                                n_intervals=n_intervals)
 
-        for i in range(n_intervals):
-            hv_ip1 = hv_left*10**(d_nh_expo*(i+1))
-            hv_i = hv_left*10**(d_nh_expo*i)
-            d_hv = hv_ip1 - hv_i
-            hv_list += [hv_i + (d_hv/2)]
+        y = np.zeros(n_intervals)
+        y_err = np.zeros(n_intervals)
 
-        x = np.array(hv_list)
-        y = np.zeros(len(x))
-        y_err = np.zeros(len(x))
+        return SpectrumCount(None, y, y_err, EnergyInterval(hv_left, hv_right), grid=grid)
 
-        return SpectrumCount(x, y, y_err, EnergyInterval(hv_left, hv_right))
 
-
-def _validate_index(index: int, hv: float, log_info: any = None) -> int:
+def _validate_index(index: int, hv: float, log_info: any = None, n_intervals: int = HV_N_INTERVALS) -> int:
     """There might be rare cases when the energy of the photon is out of the bounds.
     When this happens we can get exceptions in python when using the corresponding
     wrong indexes, thus we need to check the index values before using them.
@@ -301,11 +526,12 @@ def _validate_index(index: int, hv: float, log_info: any = None) -> int:
         index (int): Apparent Index of the photon, which we seek to validate
         hv (float): Energy of the photon, for login info
         log_info (any, optional): Extra log info. Defaults to None.
+        n_intervals (int, optional): Number of bins of the energy grid. Defaults to HV_N_INTERVALS.
 
     Returns:
         int: The validated index.
     """
-    if index >= 2000:
+    if index >= n_intervals:
 
         if os.path.getsize(ERRORS_LOG_FILE) > 1E9:
             os.remove(ERRORS_LOG_FILE)
@@ -322,7 +548,7 @@ def _validate_index(index: int, hv: float, log_info: any = None) -> int:
             f.write(
                 '========================================================================\n')
 
-        index = 1999
+        index = n_intervals - 1
 
     if index < 0:
         if os.path.getsize(ERRORS_LOG_FILE) > 1E9:
@@ -345,11 +571,17 @@ def _validate_index(index: int, hv: float, log_info: any = None) -> int:
 
 def count_photon_into_log_spectrum(spectrum: SpectrumCount, hv: float, optional_log_info: any = None):
 
-    index = _validate_index(index=get_interval_index_log(
-        hv, spectrum.interval, len(spectrum)), hv=hv, log_info=optional_log_info)
+    if spectrum.grid is not None:
+        index = spectrum.grid.index(hv)
+    else:
+        index = get_interval_index_log(hv, spectrum.interval, len(spectrum))
+
+    index = _validate_index(index=index, hv=hv,
+                            log_info=optional_log_info, n_intervals=len(spectrum))
 
-    spectrum[index].y += 1
-    spectrum[index].y_err = spectrum[index].y**0.5
+    spectrum.y[index] += 1
+    spectrum.y_err[index] = spectrum.y[index]**0.5
+    spectrum.invalidate_prefix_sums()
     return index
 
 
@@ -372,8 +604,9 @@ class NHPhotonRegistrationPolicy(PhotonRegistrationPolicy):
         self.grid = nh_grid
 
     def get_label_for_photon(self, photon_info: PhotonInfo) -> str:
-
-        nh_grid_index = self.grid.index(
+        # the photons out of the grid (the unabsorbed ones too) have the underflow and
+        # overflow bins of the column density distribution, see ColumnDensityGrid.bin_index()
+        nh_grid_index = self.grid.bin_index(
             photon_info.effective_column_density(self.hydrogen_concentration))
 
         return f'{nh_grid_index}_{photon_info.photon_type}_{photon_info.line}'
@@ -436,12 +669,18 @@ class SpectraBuilder:
                        file: TextIOWrapper, file_label: str,
                        angular_interval: AngularInterval,
                        log_every_n_photons: int,
-                       spectra: Dict[str, SpectrumCount]):
+                       spectra: Dict[str, SpectrumCount],
+                       escape_lines: np.ndarray = None):
+
+        for photon_counter, line in enumerate(filter(is_photon_line, file)):
 
-        for photon_counter, line in enumerate(file):
+            if escape_lines is not None and photon_counter >= len(escape_lines):
+                raise ValueError(
+                    f'The escape lines of {file_label} do not match its photons!')
 
             photon_info = PhotonInfo.build_photon_info(
-                raw_info=line, policy=self.photon_units_policy)
+                raw_info=line, policy=self.photon_units_policy,
+                escape_line=escape_lines[photon_counter] if escape_lines is not None else None)
 
             if photon_info.phi in angular_interval:
                 self.__register_photon(
@@ -463,7 +702,8 @@ class SpectraBuilder:
                                     file_label=file_path_i,
                                     angular_interval=angular_interval,
                                     log_every_n_photons=log_every_n_photons,
-                                    spectra=spectra)
+                                    spectra=spectra,
+                                    escape_lines=load_escape_lines(file_path_i))
 
     def __generate_spectrum(self, spectra: Dict[str, SpectrumCount], label: str):
         spectra[label] = PoissonSpectrumCountFactory.build_log_empty_spectrum_count(
@@ -493,34 +733,67 @@ def print_spectra(output_dir: str, spectra: Dict[str, SpectrumCount]):
     print('done!')
 
 
+SOURCE_SPECTRUM_GENERATORS: Final[Dict[int, str]] = {
+    2000: 'create_source',
+    5000: 'create_source_5k',
+    10_000: 'create_source_10k',
+    30_000: 'create_source_30k',
+}
+"""The external binary that creates the source spectrum for each number of bins.
+"""
+
+
 class SourceSpectrumCountFileGenerator:
 
     def __init__(self, root_dir):
         self.root_dir = root_dir
 
+    def get_path(self, num_of_photons: float, bins: int = 2000) -> str:
+        return os.path.join(self.root_dir, f"source_S_{int(bins/1000)}k_{int(num_of_photons/1e6)}M.txt")
+
+    def build_job(self, num_of_photons: float, bins: int = 2000) -> Job:
+
+        if bins not in SOURCE_SPECTRUM_GENERATORS:
+            raise ValueError(
+                f'There is no source spectrum generator for {bins} bins!')
+
+        return Job(label=f'source {bins} bins {num_of_photons:0.3g} photons',
+                   args=[os.path.join(PATH_TO_CREATE_SOURCE_SPECTRA_DIR, SOURCE_SPECTRUM_GENERATORS[bins]),
+                         str(num_of_photons), self.get_path(num_of_photons, bins=bins)])
+
     def generate(self, num_of_photons: float, bins: int = 2000) -> str:
+        return self.generate_all([num_of_photons], bins=bins)[0]
+
+    def generate_all(self, num_of_photons_list: Iterable[float], bins: int = 2000, max_concurrency: int = None) -> List[str]:
+        """Generates (concurrently) the missing source spectra files.
+
+        Args:
+            num_of_photons_list (Iterable[float]): the number of photons of each source spectrum
+            bins (int, optional): number of bins of the source spectra. Defaults to 2000.
+            max_concurrency (int, optional): number of generators running at the same time. Defaults to os.cpu_count().
+
+        Raises:
+            ValueError: if there is no generator for the given bins, or if some generator fails.
+
+        Returns:
+            List[str]: the paths to the source spectra files
+        """
+        num_of_photons_list = list(num_of_photons_list)
+        paths = [self.get_path(num_of_photons, bins=bins)
+                 for num_of_photons in num_of_photons_list]
+
+        jobs = [self.build_job(num_of_photons, bins=bins)
+                for num_of_photons, path in zip(num_of_photons_list, paths) if not os.path.exists(path)]
+
+        if jobs:
+            results = run_jobs(
+                jobs, max_concurrency=max_concurrency, verbose=False)
+
+            if not all(result.succeeded for result in results):
+                print_jobs_summary(results)
+                raise ValueError('Some source spectra could not be generated!')
 
-        new_source = f"source_S_{int(bins/1000)}k_{int(num_of_photons/1e6)}M.txt"
-
-        path = os.path.join(self.root_dir, new_source)
-
-        if not os.path.exists(path):
-            if bins == 2000:
-                subprocess.call([os.path.join(PATH_TO_CREATE_SOURCE_SPECTRA_DIR, 'create_source'),
-                                str(num_of_photons), path])
-            elif bins == 5000:
-                subprocess.call([os.path.join(PATH_TO_CREATE_SOURCE_SPECTRA_DIR, 'create_source_5k'),
-                                str(num_of_photons), path])
-            elif bins == 10_000:
-                subprocess.call([os.path.join(PATH_TO_CREATE_SOURCE_SPECTRA_DIR, 'create_source_10k'),
-                                str(num_of_photons), path])
-            elif bins == 30_000:
-                subprocess.call([os.path.join(PATH_TO_CREATE_SOURCE_SPECTRA_DIR, 'create_source_30k'),
-                                str(num_of_photons), path])
-            else:
-                ValueAndError
-
-        return path
+        return paths
 
 
 def generate_source_spectrum_count_file(num_of_photons: float, bins=2000) -> str:
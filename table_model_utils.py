@@ -0,0 +1,409 @@
+"""
+This module builds the table model of the torus: the flux densities of the
+spectral_data/ directories (see build_spectral_data.py) stacked into one
+memory-mapped array
+
+    cube[nh_aver, n_aver, a_fe, alpha, nh, energy]
+
+on the shared EnergyGrid, so the spectrum at any parameter vector is a
+multilinear interpolation between the grid points (log10 for nh_aver and nh),
+and can be exported to an OGIP (XSPEC) additive table model.
+
+The smooth torus (n_aver = -1) is not a point of the n_aver axis of the clumpy
+tori, interpolating between them would mix a smooth and a clumpy torus: it is
+a separate table model (smooth=True), whose n_aver axis is only -1.
+
+The table model directory holds
+
+    model.npy:  the cube (float32, NaN where there is no spectral data)
+    axes.json:  the parameter values, the energy grid, the components and the
+                number of missing grid points
+
+alpha is the center of the viewing angular interval (degrees).
+
+==================================
+
+Example-01: 'how to build and load a table model'
+
+build_table_model_files('/path/to/table_model', *root_dirs)
+build_table_model_files('/path/to/smooth_table_model', *root_dirs, smooth=True)
+
+model = TableModel.build_table_model('/path/to/table_model')
+
+==================================
+
+Example-02: 'how to evaluate many parameter vectors at once'
+
+y = model.interpolate({'nh_aver': [3e23, 4e23], 'n_aver': [5, 5], 'a_fe': [1, 1.2],
+                       'alpha': [70, 80], 'nh': [1e23, 2e24]},
+                      energy_interval=EnergyInterval(2000, 10000))
+
+print(y.shape, model.energies(EnergyInterval(2000, 10000)).shape)
+
+==================================
+
+Example-03: 'how to export the table model for XSPEC'
+
+write_ogip_table_model(model, '/path/to/agn_torus.fits', model_name='agntorus')
+
+(if the grid is sparse, model.missing_points > 0, the spectrum of the missing
+points must be given explicitly, for example fill_value=0.0)
+
+==================================
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Final, Dict, List, Tuple, Union
+from itertools import product
+from os import listdir, path
+from energy_grid_utils import EnergyGrid
+from spectrum_utils import parse_spectral_data_files
+from colum_density_utils import ColumnDensityGrid, DEFAULT_NH_GRID
+from agn_simulation_policy import AGN_NH_AVERAGE, AGN_IRON_ABUNDANCE, AGN_VIEWING_DIRECTIONS_DEG
+from fluorescent_line_utils import FLUORESCENT_LINES
+from measurements import SpectralDataFileInfo, spectral_data_file_label
+from fits_utils import FitsColumn, write_fits_header, write_bintable, primary_header_cards
+from utils import EnergyInterval
+import numpy as np
+import json
+import os
+
+TABLE_MODEL_PARAMETERS: Final[Tuple[str, ...]] = (
+    'nh_aver', 'n_aver', 'a_fe', 'alpha', 'nh')
+"""The axes of the cube, in order
+"""
+
+TABLE_MODEL_LOG_PARAMETERS: Final[Tuple[str, ...]] = ('nh_aver', 'nh')
+"""The parameters interpolated in log10
+"""
+
+TABLE_MODEL_COMPONENTS: Final[Tuple[Tuple[str, str], ...]] = (('CONTINUUM', 'NONE'),) + \
+    tuple(('FLUORESCENT', label) for label in FLUORESCENT_LINES)
+"""The (type_label, line_label) of the flux densities added into the model: the continuum and every line
+"""
+
+SMOOTH_N_AVER = -1
+"""The n_aver of the smooth torus, see AgnSimulationPolicy.get_aver_n_clouds()
+"""
+
+TABLE_MODEL_CUBE_FILENAME = 'model.npy'
+TABLE_MODEL_AXES_FILENAME = 'axes.json'
+
+TABLE_MODEL_CHUNK_SIZE = 256
+"""Parameter vectors interpolated at once, it bounds the memory of interpolate()
+"""
+
+
+def get_table_model_parameters(spectral_info: SpectralDataFileInfo, nh_grid: ColumnDensityGrid = DEFAULT_NH_GRID) -> Tuple[float, ...]:
+    """Returns the parameter values (see TABLE_MODEL_PARAMETERS) of a spectral data file.
+    """
+    alpha = AGN_VIEWING_DIRECTIONS_DEG[spectral_info.alpha]
+
+    return (AGN_NH_AVERAGE[spectral_info.nh_aver],
+            int(spectral_info.n_aver),
+            AGN_IRON_ABUNDANCE[spectral_info.a_fe],
+            alpha.beg + alpha.length/2,
+            nh_grid.nh_list[spectral_info.grid_id])
+
+
+@dataclass
+class TableModel:
+    """
+    The cube of the flux densities of the grid points, see the module docstring.
+    """
+
+    cube: np.ndarray
+    """(nh_aver, n_aver, a_fe, alpha, nh, energy) flux densities, NaN where there is no spectral data
+    """
+
+    axes: Dict[str, np.ndarray]
+    """parameter -> sorted grid values
+    """
+
+    grid: EnergyGrid
+
+    components: List[Tuple[str, str]]
+
+    missing_points: int = 0
+    """number of grid points without spectral data
+    """
+
+    @staticmethod
+    def build_table_model(table_model_dir: str, mmap: bool = True) -> TableModel:
+        with open(path.join(table_model_dir, TABLE_MODEL_AXES_FILENAME)) as axes_file:
+            metadata = json.load(axes_file)
+
+        return TableModel(cube=np.load(path.join(table_model_dir, TABLE_MODEL_CUBE_FILENAME), mmap_mode='r' if mmap else None),
+                          axes={name: np.array(metadata['axes'][name], dtype=float)
+                                for name in TABLE_MODEL_PARAMETERS},
+                          grid=EnergyGrid.build(**metadata['grid']),
+                          components=[tuple(component) for component in metadata['components']],
+                          missing_points=metadata.get('missing_points', 0))
+
+    def energies(self, energy_interval: EnergyInterval = None) -> np.ndarray:
+        start, stop = self._energy_range(energy_interval)
+        return self.grid.centers[start:stop]
+
+    def _energy_range(self, energy_interval: EnergyInterval) -> Tuple[int, int]:
+        if energy_interval is None:
+            return 0, len(self.grid)
+
+        return self.grid.index_range(energy_interval)
+
+    def _axis_weights(self, name: str, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the lower grid index and the weight of the upper one of every value.
+        """
+        axis = self.axes[name]
+
+        if name in TABLE_MODEL_LOG_PARAMETERS:
+            axis, values = np.log10(axis), np.log10(values)
+
+        if np.any(~((values >= axis[0] - 1e-9) & (values <= axis[-1] + 1e-9))):
+            raise ValueError(
+                f'{name} must be within [{self.axes[name][0]}, {self.axes[name][-1]}]!')
+
+        if len(axis) == 1:
+            return np.zeros(len(values), dtype=int), np.zeros(len(values))
+
+        lower = np.clip(np.searchsorted(axis, values, side='right') - 1,
+                        0, len(axis) - 2)
+        weights = np.clip((values - axis[lower])/(axis[lower + 1] - axis[lower]), 0, 1)
+
+        return lower, weights
+
+    def interpolate(self, parameters: Union[Dict[str, np.ndarray], np.ndarray], energy_interval: EnergyInterval = None,
+                    chunk_size: int = TABLE_MODEL_CHUNK_SIZE) -> np.ndarray:
+        """Returns the multilinearly interpolated flux densities of many parameter vectors.
+
+        Only the corners of the grid cells with a non zero weight are read from the cube,
+        and only the bins of the energy interval.
+
+        Args:
+            parameters (Union[Dict[str, np.ndarray], np.ndarray]): parameter -> values, or a
+                (vectors, parameters) array in the order of TABLE_MODEL_PARAMETERS
+            energy_interval (EnergyInterval, optional): the energies, see energies(). Defaults to the whole grid.
+            chunk_size (int, optional): vectors interpolated at once. Defaults to TABLE_MODEL_CHUNK_SIZE.
+
+        Raises:
+            ValueError: if a parameter is out of the grid.
+
+        Returns:
+            np.ndarray: (vectors, energies) flux densities, NaN if a corner has no spectral data
+        """
+        if isinstance(parameters, dict):
+            parameters = np.column_stack([np.atleast_1d(np.asarray(parameters[name], dtype=float))
+                                          for name in TABLE_MODEL_PARAMETERS])
+
+        parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+        lowers, weights = zip(*[self._axis_weights(name, parameters[:, i])
+                                for i, name in enumerate(TABLE_MODEL_PARAMETERS)])
+
+        start, stop = self._energy_range(energy_interval)
+        result = np.zeros((len(parameters), stop - start))
+
+        for chunk_start in range(0, len(parameters), chunk_size):
+            chunk = slice(chunk_start, min(
+                chunk_start + chunk_size, len(parameters)))
+
+            for corner in product((0, 1), repeat=len(TABLE_MODEL_PARAMETERS)):
+                corner_weights = np.prod([w[chunk] if upper else 1 - w[chunk]
+                                          for upper, w in zip(corner, weights)], axis=0)
+                used = corner_weights > 0
+
+                if not np.any(used):
+                    continue
+
+                index = tuple(lower[chunk][used] + upper
+                              for upper, lower in zip(corner, lowers))
+                rows = np.flatnonzero(used) + chunk_start
+
+                result[rows] += corner_weights[used, np.newaxis] * \
+                    self.cube[index + (slice(start, stop),)]
+
+        return result
+
+
+def _find_table_model_flux_densities(*root_dirs: str, components: Tuple[Tuple[str, str], ...],
+                                     nh_grid: ColumnDensityGrid, smooth: bool) -> List[SpectralDataFileInfo]:
+    spectral_infos = [SpectralDataFileInfo.build_spectral_data_info(path.join(root_dir, spectral_data_file_label, filename))
+                      for root_dir in root_dirs
+                      if path.isdir(path.join(root_dir, spectral_data_file_label))
+                      for filename in sorted(listdir(path.join(root_dir, spectral_data_file_label)))]
+
+    return [spectral_info for spectral_info in spectral_infos
+            if spectral_info.file_data_type == 'fluxdensity'
+            and (spectral_info.type_label, spectral_info.line_label) in components
+            and (int(spectral_info.n_aver) == SMOOTH_N_AVER) == smooth
+            # the underflow and overflow bins are not points of the nh axis
+            and 0 <= spectral_info.grid_id < nh_grid.n_intervals]
+
+
+def has_table_model_flux_densities(*root_dirs: str, components: Tuple[Tuple[str, str], ...] = TABLE_MODEL_COMPONENTS,
+                                   nh_grid: ColumnDensityGrid = DEFAULT_NH_GRID, smooth: bool = False) -> bool:
+    """Whether there are flux densities for the table model, see build_table_model_files().
+    """
+    return len(_find_table_model_flux_densities(*root_dirs, components=components, nh_grid=nh_grid, smooth=smooth)) > 0
+
+
+def build_table_model_files(table_model_dir: str, *root_dirs: str,
+                            components: Tuple[Tuple[str, str], ...] = TABLE_MODEL_COMPONENTS,
+                            nh_grid: ColumnDensityGrid = DEFAULT_NH_GRID, smooth: bool = False) -> TableModel:
+    """Stacks the flux densities of the spectral_data directories of the root directories
+    into the table model directory: every grid point is the sum of its components.
+    The clumpy and the smooth tori are separate table models, see the module docstring.
+
+    Args:
+        table_model_dir (str): the output directory, created if it doesn't exist
+        components (Tuple[Tuple[str, str], ...], optional): the (type_label, line_label) of the flux densities
+            added into the model. Defaults to TABLE_MODEL_COMPONENTS.
+        nh_grid (ColumnDensityGrid, optional): the NH grid of the spectral data. Defaults to DEFAULT_NH_GRID.
+        smooth (bool, optional): the table model of the smooth torus instead of the clumpy ones. Defaults to False.
+
+    Raises:
+        ValueError: if there are no flux densities, or they are not on the same energy grid.
+
+    Returns:
+        TableModel: the table model, memory-mapped
+    """
+    spectral_infos = _find_table_model_flux_densities(*root_dirs, components=components,
+                                                      nh_grid=nh_grid, smooth=smooth)
+
+    if not spectral_infos:
+        raise ValueError('there are no flux densities for the table model!')
+
+    points = [get_table_model_parameters(spectral_info, nh_grid)
+              for spectral_info in spectral_infos]
+    axes = {name: np.unique([point[i] for point in points])
+            for i, name in enumerate(TABLE_MODEL_PARAMETERS)}
+
+    grid = None
+    cube = None
+    filled = None
+
+    os.makedirs(table_model_dir, exist_ok=True)
+
+    for spectral_info, point in zip(spectral_infos, points):
+        x, y, _ = parse_spectral_data_files(spectral_info.path_to_file)
+        file_grid = EnergyGrid.find(x)
+
+        if file_grid is None or len(x) != len(file_grid) or (grid is not None and file_grid is not grid):
+            raise ValueError(
+                f'the flux density {spectral_info.path_to_file} is not on the energy grid of the table model!')
+
+        if cube is None:
+            grid = file_grid
+            cube = np.lib.format.open_memmap(path.join(table_model_dir, TABLE_MODEL_CUBE_FILENAME), mode='w+', dtype=np.float32,
+                                             shape=tuple(len(axes[name]) for name in TABLE_MODEL_PARAMETERS) + (len(grid),))
+            cube[...] = np.nan
+            filled = np.zeros(cube.shape[:-1], dtype=bool)
+
+        index = tuple(int(np.searchsorted(axes[name], value))
+                      for name, value in zip(TABLE_MODEL_PARAMETERS, point))
+
+        if filled[index]:
+            cube[index] += y
+        else:
+            cube[index] = y
+            filled[index] = True
+
+    cube.flush()
+    del cube
+
+    with open(path.join(table_model_dir, TABLE_MODEL_AXES_FILENAME), 'w') as axes_file:
+        json.dump({'parameters': list(TABLE_MODEL_PARAMETERS),
+                   'axes': {name: axes[name].tolist() for name in TABLE_MODEL_PARAMETERS},
+                   'log_parameters': list(TABLE_MODEL_LOG_PARAMETERS),
+                   'grid': {'left': grid.left, 'right': grid.right, 'n_intervals': grid.n_intervals},
+                   'components': [list(component) for component in components],
+                   'missing_points': int(np.count_nonzero(~filled))}, axes_file, indent=4)
+
+    return TableModel.build_table_model(table_model_dir)
+
+
+@dataclass
+class _OgipSpectraRows:
+    """The rows of the SPECTRA extension, read from the cube when they are written.
+    """
+
+    cube: np.ndarray
+    start: int
+    stop: int
+    widths: np.ndarray
+    fill_value: float
+
+    def __len__(self) -> int:
+        return int(np.prod(self.cube.shape[:-1]))
+
+    def __getitem__(self, rows: slice) -> np.ndarray:
+        spectra = np.asarray(self.cube.reshape(len(self), -1)[rows, self.start:self.stop], dtype=float)
+        return np.where(np.isfinite(spectra), spectra, self.fill_value)*self.widths
+
+
+def write_ogip_table_model(model: TableModel, fits_filepath: str, model_name: str = 'agntorus',
+                           energy_interval: EnergyInterval = None, fill_value: float = None):
+    """Exports the table model as an OGIP additive table model (OGIP/92-009): the PARAMETERS,
+    ENERGIES (keV) and SPECTRA (photons/cm^2/s per bin: flux density times bin width) extensions,
+    with the last parameter varying fastest.
+
+    Args:
+        model (TableModel): the table model
+        fits_filepath (str): the output .fits file
+        model_name (str, optional): MODLNAME. Defaults to 'agntorus'.
+        energy_interval (EnergyInterval, optional): the exported energies. Defaults to the whole grid.
+        fill_value (float, optional): the spectrum of the grid points without spectral data, XSPEC
+            interpolates toward it. Defaults to None (a sparse grid is not exported).
+
+    Raises:
+        ValueError: if there are grid points without spectral data and no fill_value.
+    """
+    if model.missing_points > 0 and fill_value is None:
+        raise ValueError(f'the table model has {model.missing_points} grid points without spectral data, '
+                         'give their fill_value explicitly to export it!')
+
+    start, stop = model._energy_range(energy_interval)
+    edges = model.grid.edges[start:stop + 1]
+    widths = model.grid.widths[start:stop]
+
+    n_values = max(len(model.axes[name]) for name in TABLE_MODEL_PARAMETERS)
+
+    def padded(values: np.ndarray) -> np.ndarray:
+        return np.concatenate((values, np.zeros(n_values - len(values))))
+
+    parameters_columns = [FitsColumn('NAME', np.array(TABLE_MODEL_PARAMETERS)),
+                          FitsColumn('METHOD', np.array([1 if name in TABLE_MODEL_LOG_PARAMETERS else 0
+                                                         for name in TABLE_MODEL_PARAMETERS])),
+                          FitsColumn('INITIAL', np.array([model.axes[name][len(model.axes[name])//2] for name in TABLE_MODEL_PARAMETERS])),
+                          FitsColumn('DELTA', np.array([(model.axes[name][-1] - model.axes[name][0])/100 if len(model.axes[name]) > 1 else -1.0
+                                                        for name in TABLE_MODEL_PARAMETERS])),
+                          *[FitsColumn(column, np.array([model.axes[name][index] for name in TABLE_MODEL_PARAMETERS]))
+                            for column, index in (('MINIMUM', 0), ('BOTTOM', 0), ('TOP', -1), ('MAXIMUM', -1))],
+                          FitsColumn('NUMBVALS', np.array(
+                              [len(model.axes[name]) for name in TABLE_MODEL_PARAMETERS])),
+                          FitsColumn('VALUE', np.stack([padded(model.axes[name]) for name in TABLE_MODEL_PARAMETERS]))]
+
+    points = np.array(
+        list(product(*[model.axes[name] for name in TABLE_MODEL_PARAMETERS])))
+
+    spectra = _OgipSpectraRows(model.cube, start, stop, widths,
+                               fill_value=np.nan if fill_value is None else fill_value)
+
+    ogip_keywords = {'HDUCLASS': 'OGIP', 'HDUCLAS1': 'XSPEC TABLE MODEL', 'HDUVERS': '1.0.0'}
+
+    with open(fits_filepath, 'wb') as fits_file:
+        write_fits_header(fits_file, primary_header_cards({'MODLNAME': model_name[:12],
+                                                           'MODLUNIT': 'photons/cm^2/s',
+                                                           'REDSHIFT': False,
+                                                           'ADDMODEL': True,
+                                                           **ogip_keywords}))
+
+        write_bintable(fits_file, 'PARAMETERS', parameters_columns,
+                       keywords={**ogip_keywords, 'HDUCLAS2': 'PARAMETERS',
+                                 'NINTPARM': len(TABLE_MODEL_PARAMETERS), 'NADDPARM': 0})
+
+        write_bintable(fits_file, 'ENERGIES', [FitsColumn('ENERG_LO', edges[:-1]/1000, unit='keV'),
+                                               FitsColumn('ENERG_HI', edges[1:]/1000, unit='keV')],
+                       keywords={**ogip_keywords, 'HDUCLAS2': 'ENERGIES'})
+
+        write_bintable(fits_file, 'SPECTRA', [FitsColumn('PARAMVAL', points),
+                                              FitsColumn('INTPSPEC', spectra, unit='photons/cm^2/s')],
+                       keywords={**ogip_keywords, 'HDUCLAS2': 'MODEL SPECTRA'})
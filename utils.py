@@ -131,6 +131,129 @@ class ValueAndError:
     err: float
 
 
+@dataclass
+class UncertainArray:
+    """
+    Values with their (independent, gaussian) errors, as arrays: the arithmetic
+    (+, -, *, /, **, log10) is element-wise and propagates the errors to first
+    order, so a derived quantity of many measurements is one numpy expression.
+
+    The operands can be UncertainArray, ValueAndError, or exact numbers and arrays.
+
+    For example:
+
+        line = UncertainArray.build_weighted_sum(y, y_err, weights)
+
+        ew = line/continuum
+
+        print(ew.value, ew.err, ew.to_values_and_errors()[0])
+    """
+
+    value: np.ndarray
+    err: np.ndarray
+
+    def __post_init__(self):
+        self.value = np.asarray(self.value, dtype=float)
+        self.err = np.broadcast_to(np.asarray(self.err, dtype=float),
+                                   self.value.shape).copy()
+
+    @staticmethod
+    def build_uncertain_array(values_and_errors: Iterable[ValueAndError]) -> UncertainArray:
+        values_and_errors = list(values_and_errors)
+        return UncertainArray(value=[item.value for item in values_and_errors],
+                              err=[item.err for item in values_and_errors])
+
+    @staticmethod
+    def build_weighted_sum(y: np.ndarray, y_err: np.ndarray, weights: np.ndarray, err_weights: np.ndarray = None) -> UncertainArray:
+        """Returns the sums y @ weights of the rows of y, with the errors
+        sqrt(y_err**2 @ err_weights**2).
+
+        Args:
+            y (np.ndarray): (..., bins) the values
+            y_err (np.ndarray): (..., bins) the errors
+            weights (np.ndarray): (bins,) the weights of the values
+            err_weights (np.ndarray, optional): (bins,) the weights of the errors. Defaults to weights.
+
+        Returns:
+            UncertainArray: the sums
+        """
+        err_weights = weights if err_weights is None else err_weights
+        return UncertainArray(value=np.asarray(y, dtype=float) @ weights,
+                              err=np.sqrt(np.asarray(y_err, dtype=float)**2 @ err_weights**2))
+
+    def to_value_and_error(self) -> ValueAndError:
+        return ValueAndError(value=float(self.value), err=float(self.err))
+
+    def to_values_and_errors(self) -> List[ValueAndError]:
+        return [ValueAndError(value=value, err=err) for value, err in
+                zip(self.value.ravel().tolist(), self.err.ravel().tolist())]
+
+    def relative_error(self) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.err/np.abs(self.value)
+
+    def log10(self) -> UncertainArray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return UncertainArray(value=np.log10(self.value),
+                                  err=self.err/(np.abs(self.value)*np.log(10)))
+
+    def __len__(self) -> int:
+        return len(self.value)
+
+    def __getitem__(self, index) -> UncertainArray:
+        return UncertainArray(value=self.value[index], err=self.err[index])
+
+    def __neg__(self) -> UncertainArray:
+        return UncertainArray(value=-self.value, err=self.err)
+
+    def __add__(self, other) -> UncertainArray:
+        other = _as_uncertain_array(other)
+        return UncertainArray(value=self.value + other.value, err=np.hypot(self.err, other.err))
+
+    def __sub__(self, other) -> UncertainArray:
+        other = _as_uncertain_array(other)
+        return UncertainArray(value=self.value - other.value, err=np.hypot(self.err, other.err))
+
+    def __mul__(self, other) -> UncertainArray:
+        other = _as_uncertain_array(other)
+        return UncertainArray(value=self.value*other.value,
+                              err=np.hypot(self.err*other.value, self.value*other.err))
+
+    def __truediv__(self, other) -> UncertainArray:
+        other = _as_uncertain_array(other)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = self.value/other.value
+            return UncertainArray(value=value,
+                                  err=np.hypot(self.err/other.value, value*other.err/other.value))
+
+    def __pow__(self, exponent: float) -> UncertainArray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return UncertainArray(value=self.value**exponent,
+                                  err=np.abs(exponent*self.value**(exponent - 1))*self.err)
+
+    def __radd__(self, other) -> UncertainArray:
+        return self + other
+
+    def __rsub__(self, other) -> UncertainArray:
+        return _as_uncertain_array(other) - self
+
+    def __rmul__(self, other) -> UncertainArray:
+        return self*other
+
+    def __rtruediv__(self, other) -> UncertainArray:
+        return _as_uncertain_array(other)/self
+
+
+def _as_uncertain_array(data) -> UncertainArray:
+    if isinstance(data, UncertainArray):
+        return data
+
+    if isinstance(data, ValueAndError):
+        return UncertainArray(value=data.value, err=data.err)
+
+    return UncertainArray(value=data, err=0.0)
+
+
 @dataclass
 class Interval2D:
     left: float
@@ -233,6 +356,50 @@ class Histo:
     counts_err: np.ndarray
     raw_data: np.ndarray
 
+    underflow: float = 0.0
+    """counts below the first bin
+    """
+
+    underflow_err: float = 0.0
+
+    overflow: float = 0.0
+    """counts above the last bin
+    """
+
+    overflow_err: float = 0.0
+
+    raw_count: int = 0
+    """number of values accumulated by add_raw_moments()
+    """
+
+    raw_mean: float = 0.0
+    """mean of the values accumulated by add_raw_moments()
+    """
+
+    raw_m2: float = 0.0
+    """sum of the squared deviations from the mean of the values accumulated by add_raw_moments()
+    """
+
+    def add_raw_moments(self, values: np.ndarray):
+        """Accumulates the mean and the spread of the given values, so that the
+        mean and std can be calculated when the histogram holds no raw data.
+
+        Args:
+            values (np.ndarray): a chunk of the raw data
+        """
+        n = len(values)
+        if n == 0:
+            return
+
+        mean_ = np.mean(values)
+        m2 = np.sum((values-mean_)**2)
+        total = self.raw_count + n
+        delta = mean_ - self.raw_mean
+
+        self.raw_mean += delta*n/total
+        self.raw_m2 += m2 + delta**2*self.raw_count*n/total
+        self.raw_count = total
+
     def mean(self) -> float:
         """Get the mean of the raw data described by the histogram.
 
@@ -243,6 +410,8 @@ class Histo:
         Returns:
             float: mean value of the raw data.
         """
+        if self.raw_data is None:
+            return self.raw_mean
 
         return np.mean(self.raw_data)
 
@@ -256,13 +425,17 @@ class Histo:
         Returns:
             float: standard deviation of the raw data.
         """
+        if self.raw_data is None:
+            return np.sqrt(self.raw_m2/self.raw_count)/self.raw_mean
+
         mean_ = self.mean()
         n = len(self.raw_data)
-        return np.sqrt(sum(((self.raw_data-mean_)**2)/n))/mean_
+        return np.sqrt(np.sum(((self.raw_data-mean_)**2)/n))/mean_
 
 
 def product_transport_err(data: Iterable[ValueAndError]) -> float:
-    """Get the error of a product or division.
+    """Get the relative error of a product or division
+    (see UncertainArray for the element-wise version).
 
     Args:
         data (Iterable[ValueAndError]): list of ValueAndError to calculate the total error.